@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""asyncio OCM driver (python 3 only).
+
+AsyncOCM drives an OCM from an event loop, waiting for the device to become
+readable rather than blocking a thread, so one loop can drive many OCMs. Each
+command has a timeout and can be cancelled, responses are matched to commands
+by msgid so a late response to an abandoned command is discarded.
+
+LoopOCM provides the synchronous OCM API on top of an AsyncOCM running in an
+event loop thread.
+"""
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import asyncio
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+import jdsuocm.device as device
+import jdsuocm.error as jerror
+from jdsuocm.error import OCMError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30.0                                      # Seconds to wait for a response
+READ_SIZE = 65536
+
+
+class FdStream (object):
+    "A non-blocking file descriptor, e.g., a serial port"
+
+    def __init__ (self, fd):
+        self.fd = fd
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.txbuf = bytearray()
+        self.loop = None
+        self.data_received = None
+        self.connection_lost = None
+
+    def start (self, loop, data_received, connection_lost):
+        self.loop = loop
+        self.data_received = data_received
+        self.connection_lost = connection_lost
+        loop.add_reader(self.fd, self._readable)
+
+    def stop (self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.loop = None
+
+    def write (self, data):
+        if not self.txbuf:
+            try:
+                count = os.write(self.fd, data)
+            except (BlockingIOError, InterruptedError):
+                count = 0
+            if count == len(data):
+                return
+            data = data[count:]
+            self.loop.add_writer(self.fd, self._writable)
+        self.txbuf += data
+
+    def _writable (self):
+        try:
+            count = os.write(self.fd, self.txbuf)
+        except (BlockingIOError, InterruptedError):
+            return
+        del self.txbuf[:count]
+        if not self.txbuf:
+            self.loop.remove_writer(self.fd)
+
+    def _readable (self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            self.stop()
+            self.connection_lost()
+        else:
+            self.data_received(data)
+
+
+class ChannelStream (object):
+    "An SSH channel, e.g., to sercat running on the OCM host"
+
+    def __init__ (self, chan):
+        self.chan = chan
+        self.fd = chan.fileno()
+        self.loop = None
+        self.data_received = None
+        self.connection_lost = None
+
+    def start (self, loop, data_received, connection_lost):
+        self.loop = loop
+        self.data_received = data_received
+        self.connection_lost = connection_lost
+        loop.add_reader(self.fd, self._readable)
+
+    def stop (self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop = None
+
+    def write (self, data):
+        # Command frames are small so this won't block on the channel window.
+        self.chan.sendall(bytes(data))
+
+    def _readable (self):
+        while self.chan.recv_ready():
+            self.data_received(self.chan.recv(READ_SIZE))
+        if self.chan.closed or self.chan.eof_received:
+            self.stop()
+            self.connection_lost()
+
+
+class ThreadStream (object):
+    """A blocking send/recv transport with no file descriptor to wait on, e.g., the
+    OCMSimulator. A helper thread blocks in recv and hands the data to the loop."""
+
+    def __init__ (self, transport):
+        self.transport = transport
+        self.loop = None
+        self.thread = None
+
+    def start (self, loop, data_received, connection_lost):
+        self.loop = loop
+
+        def threadmain ():
+            while self.loop is not None:
+                data = self.transport.recv(READ_SIZE)
+                loop = self.loop
+                if loop is None:
+                    return
+                if not data:
+                    loop.call_soon_threadsafe(connection_lost)
+                    return
+                loop.call_soon_threadsafe(data_received, data)
+
+        self.thread = threading.Thread(name="ThreadStream", target=threadmain)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop (self):
+        self.loop = None
+
+    def write (self, data):
+        self.transport.send(bytes(data))
+
+
+def get_stream (transport):
+    "Return the stream to use for a transport, a serial port, SSH session or send/recv object"
+    chan = getattr(transport, "chan", transport)            # sshutil sessions wrap a paramiko channel
+    if hasattr(chan, "recv_ready") and hasattr(chan, "fileno"):
+        return ChannelStream(chan)
+    if hasattr(transport, "fileno") and not hasattr(transport, "recv"):
+        return FdStream(transport.fileno())
+    return ThreadStream(transport)
+
+
+class AsyncOCM (object):
+    """An OCM driven from an asyncio event loop.
+
+    The transport is a serial port, an SSH session to sercat or any send/recv
+    transport (see get_stream). Call `await open()` to initialize the device the
+    same way OCM does, or just `start()` to only start reading.
+    """
+
+    def __init__ (self, transport, loop=None, debug=False, timeout=DEFAULT_TIMEOUT):
+        self.transport = transport
+        self.loop = loop
+        self.debug = debug
+        self.timeout = timeout
+        self.stream = get_stream(transport)
+        self.rxbuf = bytearray()
+        self.resync = False
+        self.pending = {}                                   # Futures for responses by msgid
+        self.lock = None
+        self.commands = dict(device.commands_common)
+        self.templates = device.compile_commands(self.commands)
+        self.devtype = None
+        self.nports = None
+
+    def start (self):
+        "Start reading from the device, must be called from the loop"
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        self.lock = asyncio.Lock()
+        self.stream.start(self.loop, self._data_received, self._connection_lost)
+
+    def close (self):
+        self.stream.stop()
+        self._connection_lost()
+        close = getattr(self.transport, "close", None)
+        if close is not None:
+            close()
+
+    async def open (self):
+        "Start reading and initialize the device, mirrors OCM.__init__"
+        self.start()
+
+        idn = await self.get_idn_data()
+        if len(idn) > 4 and idn[4] == 'cal04':
+            self.devtype = device.DEVTYPE_4PORT
+            self.nports = 4
+            self.commands.update(device.commands_4port)
+        else:
+            self.devtype = device.DEVTYPE_TFOCM
+            self.nports = 1
+            self.commands.update(device.commands_1port)
+        self.templates = device.compile_commands(self.commands)
+
+        if not self.is_safe_mode(idn):
+            await self.reset()
+        idn = await self.get_idn_data()
+        if self.is_safe_mode(idn):
+            await self.activate()
+        await self.self_test()
+        return self
+
+    #-------------
+    # Frame layer
+    #-------------
+
+    def _data_received (self, data):
+        rxbuf = self.rxbuf
+        rxbuf += data
+        offset = 0
+        while True:
+            # While resynchronizing only consider headers for the commands we're waiting on.
+            flen = device.check_frame(rxbuf, self.pending if self.resync else None, offset)
+            if not flen:
+                break
+            if flen < 0:
+                # Invalid frame, scan forward a byte at a time for a valid one.
+                if not self.resync:
+                    logger.error("Invalid response frame, resynchronizing")
+                    self.resync = True
+                offset += 1
+                continue
+            if self.resync:
+                logger.warning("Resynchronized response stream")
+                self.resync = False
+
+            msgid, unused, result = struct.unpack_from(device.RESP_HDR, rxbuf, offset)
+            frame = bytes(rxbuf[offset + 6:offset + flen - 2])
+            offset += flen
+            future = self.pending.get(msgid)
+            if future is None or future.done():
+                logger.warning("Discarding response with unexpected msgid %d", msgid)
+                continue
+            future.set_result((result, frame))
+        del rxbuf[:offset]
+
+    def _connection_lost (self):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(EOFError("OCM connection lost"))
+
+    async def run_frame (self, msgid, frame, timeout=None):
+        """Send a command frame and return its (error, data), (ETIMEOUT, b"") if no
+        response arrives within timeout (default self.timeout) seconds"""
+        async with self.lock:
+            future = self.loop.create_future()
+            self.pending[msgid] = future
+            try:
+                self.stream.write(frame)
+                return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+            except asyncio.TimeoutError:
+                logger.error("Timeout waiting for response to msgid %d", msgid)
+                # Whatever partial frame we have is never going to complete.
+                del self.rxbuf[:]
+                return jerror.ETIMEOUT, b""
+            finally:
+                del self.pending[msgid]
+
+    async def run_cmd_status (self, cmdname, data=b"", instance=None, timeout=None):
+        if cmdname not in self.commands:
+            return jerror.EBADCMD, b""
+        try:
+            msgid, frame = device.encode_cmd(self.templates, cmdname, data, instance, debug=self.debug)
+        except AssertionError:
+            return jerror.EBADCMD, b""
+
+        error, data = await self.run_frame(msgid, frame, timeout)
+        if error:
+            logger.debug("Command %s failed with result: %s", cmdname, jerror.get_error_result(error))
+        return error, data
+
+    async def run_cmd (self, cmdname, data=b"", instance=None, timeout=None):
+        error, data = await self.run_cmd_status(cmdname, data, instance, timeout)
+        if error:
+            raise OCMError(error)
+        return data
+
+    #--------------
+    # Device API
+    #--------------
+
+    def is_safe_mode (self, idn):
+        for elm in idn:
+            if "safe" in elm.lower():
+                return True
+        return False
+
+    async def set_factory_default (self):
+        await self.run_cmd("SET-FACTORY-DEFAULT")
+
+    async def reset (self):
+        if self.devtype != device.DEVTYPE_4PORT:
+            return await self.set_factory_default()
+        await self.run_cmd("RESET")
+
+    async def activate (self):
+        await self.run_cmd("ACTIVATE")
+
+    async def self_test (self):
+        await self.run_cmd("START-SELF-TEST")
+
+    async def get_idn_string (self):
+        return device.decode_idn_string(await self.run_cmd("GET-IDN-MSG"))
+
+    async def get_idn_data (self):
+        return (await self.get_idn_string()).split(",")
+
+    async def get_temp (self):
+        return device.unpack_data_words(await self.run_cmd("GET-MODULE-TEMP"))[0] / 10
+
+    async def get_channel_profile (self, profile_id):
+        assert self.devtype == device.DEVTYPE_4PORT
+        return device.decode_channel_profile(await self.run_cmd("READ-PROFILE", instance=profile_id))
+
+    async def get_itu_scan (self, hires):
+        assert self.devtype == device.DEVTYPE_TFOCM
+        hival = 2 if hires else 1
+        return device.decode_itu_scan(await self.run_cmd("FULL-ITU-SCAN", struct.pack(">H", hival)), hires)
+
+    async def get_itu_power_scan (self, hires):
+        assert self.devtype == device.DEVTYPE_TFOCM
+        hival = 2 if hires else 1
+        data = await self.run_cmd("FULL-ITU-POWER-SCAN", struct.pack(">H", hival))
+        return device.decode_itu_power_scan(data, hires)
+
+    async def get_full_scan (self, instance=0b1111, asarray=False):
+        assert self.devtype == device.DEVTYPE_4PORT
+        data = await self.run_cmd("FULL-SPECTRUM-SCAN", instance=instance)
+        return device.decode_full_scan(data, instance, asarray, self.debug)
+
+    async def get_full_125_scan (self, instance=0b1111, asarray=False):
+        assert self.devtype == device.DEVTYPE_4PORT
+        data = await self.run_cmd("FULL-12-SCAN", instance=instance)
+        return device.decode_full_125_scan(data, instance, asarray, self.debug)
+
+
+async def open_local_ocm (devname, loop=None, debug=False, timeout=DEFAULT_TIMEOUT):
+    "Open and initialize an AsyncOCM on a local serial port"
+    return await AsyncOCM(device.open_serial(devname), loop, debug, timeout).open()
+
+
+class LoopOCM (device.OCM):
+    """The synchronous OCM API run on an AsyncOCM.
+
+    `loop` must be running in another thread, any number of LoopOCMs and
+    AsyncOCMs can share it. Commands are run lock-step, the device's responses
+    are waited for on the loop rather than by polling the transport.
+    """
+
+    def __init__ (self, transport, loop, debug=False, cache_ttl=device.DEFAULT_CACHE_TTL, timeout=DEFAULT_TIMEOUT):
+        self.loop = loop
+        self.aocm = AsyncOCM(transport, loop, debug, timeout)
+        self._run(self._start())
+        super(LoopOCM, self).__init__(transport, debug=debug, cache_ttl=cache_ttl, pipeline_window=1)
+
+    async def _start (self):
+        self.aocm.start()
+
+    def _run (self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close (self):
+        self.loop.call_soon_threadsafe(self.aocm.close)
+
+    def run_cmd_status (self, cmdname, data=b"", instance=None):
+        if cmdname not in self.commands:
+            self.stats.record(cmdname, 0, 0, jerror.EBADCMD)
+            return jerror.EBADCMD, b""
+        try:
+            msgid, frame = device.encode_cmd(self.templates, cmdname, data, instance, debug=self.debug)
+        except AssertionError:
+            self.stats.record(cmdname, 0, 0, jerror.EBADCMD)
+            return jerror.EBADCMD, b""
+
+        start = time.time()
+        error, data = self._run(self.aocm.run_frame(msgid, frame))
+        # The loop doesn't report when the response started, count the round trip as device time.
+        elapsed = time.time() - start
+        resplen = 0 if error == jerror.ETIMEOUT else len(data) + 8
+        self.stats.record(cmdname, len(frame), resplen, error, 0.0, elapsed, elapsed)
+        if error:
+            logger.debug("Command %s failed with result: %s", cmdname, jerror.get_error_result(error))
+        return error, data
+
+    def run_cmd_stream (self, cmdname, data=b"", instance=None):
+        # Responses are only handed over from the loop once complete.
+        return device.DataStream(self.run_cmd(cmdname, data, instance))
+
+    def run_cmd_batch_status (self, cmds, window=None):
+        # Pipelining reads the transport directly, run lock-step on the loop instead.
+        return super(LoopOCM, self).run_cmd_batch_status(cmds, 1)
+
+    def drain_serial_read_queue (self):
+        # Data that arrives with no command waiting is discarded by the loop.
+        return None
+
+
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import jdsuocm.device as device
+from jdsuocm.scheduler import ScanResult
+from jdsuocm.simulator import SimulatedOCM
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"))
+    malloc_trim = libc.malloc_trim
+except (ImportError, OSError, AttributeError, TypeError):
+    malloc_trim = None
+
+logger = logging.getLogger(__name__)
+
+BENCH_USERNAME = "admin"
+BENCH_PASSWORD = "admin"
+
+
+class NullTransport (object):
+    "A transport that discards everything sent"
+
+    def send (self, data):
+        return len(data)
+
+
+class ReplayTransport (object):
+    """A transport that answers every command with a recorded response frame.
+
+    The msgid and checksum of the response are rewritten to match the command so
+    that only the driver's own encode and decode cost is measured.
+    """
+
+    def __init__ (self, response):
+        self.response = bytearray(response)
+        self.cksum = struct.unpack_from(">H", response, len(response) - 2)[0]
+        self.msgid = struct.unpack_from(">H", response)[0]
+        self.offset = len(response)
+
+    def send (self, data):
+        msgid = struct.unpack_from(">H", data)[0]
+        struct.pack_into(">H", self.response, 0, msgid)
+        cksum = (self.cksum - self.msgid + msgid) & 0xFFFF
+        struct.pack_into(">H", self.response, len(self.response) - 2, cksum)
+        self.offset = 0
+        return len(data)
+
+    def recv_ready (self):
+        return self.offset < len(self.response)
+
+    def recv_into (self, view, nbytes=0):
+        if not nbytes:
+            nbytes = len(view)
+        count = min(nbytes, len(self.response) - self.offset)
+        view[:count] = self.response[self.offset:self.offset + count]
+        self.offset += count
+        return count
+
+    def recv (self, nbytes=4096):
+        count = min(nbytes, len(self.response) - self.offset)
+        data = bytes(self.response[self.offset:self.offset + count])
+        self.offset += count
+        return data
+
+
+def record_response (ocm, cmdname, data=b"", instance=None):
+    "Run a command on a simulated OCM and return the raw response frame"
+    simulator = ocm.simulator
+    device.send_cmd(simulator, ocm.templates, cmdname, data, instance)
+    view = device.new_frame_buffer()
+    unused, unused, rdata = device.read_var_resp(simulator, view)
+    return view[:len(rdata) + 8].tobytes()
+
+
+def replay_ocm (ocm, cmdname, data=b"", instance=None):
+    "Return a copy of the OCM attached to a ReplayTransport for the command's response"
+    replay = device.OCM.__new__(type(ocm))
+    replay.__dict__.update(ocm.__dict__)
+    replay.device = ReplayTransport(record_response(ocm, cmdname, data, instance))
+    replay.reader = device.ResponseReader(replay.device)
+    return replay
+
+
+def build_scan_tree (result):
+    "Build a scan reply one element per value, the way replies were built before streaming"
+    from netconf import util as ncutil
+    data = ncutil.elm("data")
+    for port, points in result:
+        portelm = ncutil.subelm(data, "j:port")
+        portelm.append(ncutil.leaf_elm("j:port-index", port))
+        for freq, power in points:
+            ptelm = ncutil.subelm(portelm, "j:point")
+            ptelm.append(ncutil.leaf_elm("j:frequency", freq))
+            ptelm.append(ncutil.leaf_elm("j:power", "{:.2f}".format(power.dBm)))
+    return data
+
+
+class BenchResult (object):
+    def __init__ (self, name, latencies, peak_bytes, peak_rss_bytes=None):
+        latencies = sorted(latencies)
+        self.name = name
+        self.iterations = len(latencies)
+        self.total = sum(latencies)
+        self.ops_per_sec = self.iterations / self.total if self.total else 0
+        self.p50 = latencies[int(0.50 * (self.iterations - 1))]
+        self.p99 = latencies[int(0.99 * (self.iterations - 1))]
+        self.peak_bytes = peak_bytes
+        self.peak_rss_bytes = peak_rss_bytes
+
+    def as_dict (self):
+        return {
+            "name": self.name,
+            "iterations": self.iterations,
+            "ops_per_sec": self.ops_per_sec,
+            "p50_usec": self.p50 * 1e6,
+            "p99_usec": self.p99 * 1e6,
+            "peak_memory_bytes": self.peak_bytes,
+            "peak_rss_bytes": self.peak_rss_bytes,
+        }
+
+    def __str__ (self):
+        peak = "{:.1f}".format(self.peak_bytes / 1024) if self.peak_bytes is not None else "-"
+        peak_rss = "{:.1f}".format(self.peak_rss_bytes / 1024) if self.peak_rss_bytes is not None else "-"
+        return "{:<32} {:>8} {:>12.1f} {:>12.1f} {:>12.1f} {:>10} {:>10}".format(self.name,
+                                                                               self.iterations,
+                                                                               self.ops_per_sec,
+                                                                               self.p50 * 1e6,
+                                                                               self.p99 * 1e6,
+                                                                               peak,
+                                                                               peak_rss)
+
+
+def get_status_kib (key):
+    "Return the KiB value of key in /proc/self/status"
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(key + ":"):
+                return int(line.split()[1])
+    raise KeyError(key)
+
+
+def measure_peak_rss (func):
+    """Return the bytes of resident memory func adds at its peak, or None if it can't be measured.
+
+    Unlike tracemalloc this includes memory allocated outside of python, e.g., libxml2's
+    trees. Freed memory is first returned to the OS so func can't reuse it unseen. This
+    needs Linux, for resetting the peak RSS, and glibc's malloc_trim.
+    """
+    if malloc_trim is None:
+        return None
+    try:
+        malloc_trim(0)
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")                           # Reset VmHWM to VmRSS
+        base = get_status_kib("VmRSS")
+        func()
+        return max(get_status_kib("VmHWM") - base, 0) * 1024
+    except (IOError, OSError, KeyError):
+        return None
+
+
+def run_benchmark (name, func, iterations, duration):
+    "Run func up to iterations times or for duration seconds, then to measure peak python memory and RSS"
+    func()                                                  # Warm up
+    latencies = []
+    end = time.time() + duration
+    for unused in range(iterations):
+        start = time.time()
+        func()
+        now = time.time()
+        latencies.append(now - start)
+        if now > end:
+            break
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return BenchResult(name, latencies, peak, measure_peak_rss(func))
+
+
+def get_driver_benchmarks ():
+    "Return a list of (name, func) benchmarks of the driver encode, decode and scan parsers"
+    ocm4 = SimulatedOCM("cal04")
+    ocm1 = SimulatedOCM("cal02")
+    benchmarks = []
+
+    null = NullTransport()
+    benchmarks.append(("encode-read-profile",
+                       lambda: device.send_cmd(null, ocm4.templates, "READ-PROFILE", instance=1)))
+    powerdata = ocm1._freq_power_param(193400)
+    benchmarks.append(("encode-get-single-power",
+                       lambda: device.send_cmd(null, ocm1.templates, "GET-SINGLE-POWER", powerdata)))
+
+    replay = ReplayTransport(record_response(ocm4, "FULL-12-SCAN", instance=0b1111))
+    view = device.new_frame_buffer()
+
+    def decode ():
+        replay.offset = 0
+        device.read_var_resp(replay, view)
+    benchmarks.append(("decode-full-125-scan-frame", decode))
+
+    scans = [
+        ("parse-full-scan", ocm4, "FULL-SPECTRUM-SCAN", b"", 0b1111, lambda o: o.get_full_scan()),
+        ("parse-full-scan-array", ocm4, "FULL-SPECTRUM-SCAN", b"", 0b1111,
+         lambda o: o.get_full_scan(asarray=True)),
+        ("parse-full-125-scan", ocm4, "FULL-12-SCAN", b"", 0b1111, lambda o: o.get_full_125_scan()),
+        ("parse-full-125-scan-array", ocm4, "FULL-12-SCAN", b"", 0b1111,
+         lambda o: o.get_full_125_scan(asarray=True)),
+        ("parse-channel-profile", ocm4, "READ-PROFILE", b"", 1, lambda o: o.get_channel_profile(1)),
+        ("parse-itu-scan", ocm1, "FULL-ITU-SCAN", struct.pack(">H", 2), None, lambda o: o.get_itu_scan(True)),
+        ("parse-itu-power-scan", ocm1, "FULL-ITU-POWER-SCAN", struct.pack(">H", 1), None,
+         lambda o: o.get_itu_power_scan(False)),
+    ]
+    for name, ocm, cmdname, data, instance, method in scans:
+        rocm = replay_ocm(ocm, cmdname, data, instance)
+        benchmarks.append((name, lambda method=method, rocm=rocm: method(rocm)))
+    return benchmarks
+
+
+def get_server_benchmarks (tmpdir, debug=False):
+    "Return a list of (name, func) benchmarks of the NETCONF server against a simulated device"
+    from lxml import etree
+    from paramiko import RSAKey
+    from netconf import client
+    import jdsuocm.server as server
+
+    host_key = os.path.join(tmpdir, "host_key")
+    RSAKey.generate(2048).write_private_key_file(host_key)
+
+    ocm = SimulatedOCM("cal04")
+    ncserver = server.NetconfServer(ocm,
+                                    host_key,
+                                    ssh_port=0,
+                                    username=BENCH_USERNAME,
+                                    password=BENCH_PASSWORD,
+                                    debug=debug)
+    session = client.NetconfSSHSession("localhost",
+                                       port=ncserver.server.port,
+                                       username=BENCH_USERNAME,
+                                       password=BENCH_PASSWORD,
+                                       debug=debug)
+    scan125 = ScanResult(ocm.get_full_125_scan(asarray=True))
+    points125 = [ (port, spectrum.points()) for port, spectrum in scan125.result ]
+
+    def stream_reply ():
+        output = io.StringIO()
+        server.write_scan_start(output, scan125)
+        for port, spectrum in scan125.result:
+            server.write_port_spectrum(output, port, spectrum)
+        server.write_scan_end(output)
+        return ncserver._scan_reply(output).text
+
+    benchmarks = [
+        ("xml-full-scan", lambda: ncserver.rpc_full_scan(None, None)),
+        ("xml-full-125-scan", lambda: ncserver.rpc_full_125_scan(None, None)),
+        # Element per value tree vs streamed reply text of the same scan, including serialization. Only the
+        # peak RSS includes the tree's libxml2 elements.
+        ("xml-full-125-reply-tree", lambda: etree.tounicode(build_scan_tree(points125))),
+        ("xml-full-125-reply-stream", stream_reply),
+        ("rpc-get", lambda: session.send_rpc("<get/>")),
+        ("rpc-full-scan", lambda: session.send_rpc("<full-scan/>")),
+        ("rpc-full-125-scan", lambda: session.send_rpc("<full-125-scan/>")),
+        ("rpc-packed-125-scan",
+         lambda: session.send_rpc("<packed-scan><scan-type>full-125</scan-type></packed-scan>")),
+    ]
+    return benchmarks, session
+
+
+def main (*margs):
+    parser = argparse.ArgumentParser("JDSU-OCM Benchmarks")
+
+    parser.add_argument("--iterations", type=int, default=1000, help="Maximum iterations per benchmark")
+    parser.add_argument("--duration", type=float, default=2.0, help="Maximum seconds per benchmark")
+    parser.add_argument("--filter", help="Only run benchmarks whose name contains this string")
+    parser.add_argument("--no-server", action="store_true", help="Skip the NETCONF server benchmarks")
+    parser.add_argument("--json", help="Write the results as JSON to this file ('-' for stdout)")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debug logging")
+    args = parser.parse_args(*margs)
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    tmpdir = tempfile.mkdtemp()
+    session = None
+    try:
+        benchmarks = get_driver_benchmarks()
+        if not args.no_server:
+            server_benchmarks, session = get_server_benchmarks(tmpdir, args.debug)
+            benchmarks.extend(server_benchmarks)
+
+        if args.json != "-":
+            print("{:<32} {:>8} {:>12} {:>12} {:>12} {:>10} {:>10}".format("benchmark", "iters", "ops/sec",
+                                                                           "p50 usec", "p99 usec", "peak KiB",
+                                                                           "RSS KiB"))
+        results = []
+        for name, func in benchmarks:
+            if args.filter and args.filter not in name:
+                continue
+            result = run_benchmark(name, func, args.iterations, args.duration)
+            results.append(result)
+            if args.json != "-":
+                print(str(result))
+                sys.stdout.flush()
+    finally:
+        if session is not None:
+            session.close()
+        shutil.rmtree(tmpdir)
+
+    if args.json:
+        output = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "results": [ result.as_dict() for result in results ],
+        }
+        if args.json == "-":
+            json.dump(output, sys.stdout, indent=2)
+        else:
+            with open(args.json, "w") as outfile:
+                json.dump(output, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
+
+
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
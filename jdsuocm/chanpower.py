@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+RESOLUTION_BANDWIDTH = 12.5                             # GHz, each 12.5GHz scan slice is the power in this filter
+OSNR_REFERENCE_BANDWIDTH = 12.5                         # GHz, 0.1nm at 1550nm
+
+# Per channel arrays, power and peak in dBm and OSNR in dB, NaN where not measurable.
+ChannelPowers = collections.namedtuple("ChannelPowers", [ "power", "peak", "peak_frequency", "osnr" ])
+
+
+def profile_channels (profile):
+    "Return the (centre, width) list in GHz of the (start, end) list in 100MHz units from get_channel_profile"
+    return [ ((start + end) / 20, (end - start) / 10) for start, end in profile ]
+
+
+def channel_powers (spectrum, centres, widths, rbw=RESOLUTION_BANDWIDTH):
+    """Return the ChannelPowers of the channels at centres with widths (in GHz) in
+    the Spectrum of a 12.5GHz scan, slices of rbw GHz.
+
+    Each slice is taken to cover the frequencies half way to its neighbours and
+    the channel power is the sum of the slices weighted by how much of that
+    overlaps the channel, scaled from the resolution bandwidth. The OSNR is
+    estimated from the noise at the channel edges, the lower of the slices
+    nearest to them, referred to 0.1nm.
+    """
+    if np is None:
+        raise ImportError("channel power requires numpy")
+    frequency = np.asarray(spectrum.frequency, dtype=np.float64)
+    dbm = np.asarray(spectrum.dbm, dtype=np.float64)
+    centres = np.asarray(centres, dtype=np.float64)
+    widths = np.asarray(widths, dtype=np.float64)
+    low = centres - widths / 2
+    high = centres + widths / 2
+
+    if len(frequency) < 2:
+        nan = np.full(len(centres), np.nan)
+        return ChannelPowers(nan, nan, nan, nan)
+
+    mw = 10 ** (dbm / 10)
+    edges = np.concatenate(([ frequency[0] - (frequency[1] - frequency[0]) / 2 ],
+                            (frequency[:-1] + frequency[1:]) / 2,
+                            [ frequency[-1] + (frequency[-1] - frequency[-2]) / 2 ]))
+    # GHz of each slice (columns) inside each channel (rows)
+    overlap = np.clip(np.minimum(high[:, np.newaxis], edges[np.newaxis, 1:]) -
+                      np.maximum(low[:, np.newaxis], edges[np.newaxis, :-1]), 0, None)
+    inside = overlap > 0
+    measured = inside.any(axis=1)
+
+    total_mw = overlap.dot(mw) / rbw
+    peak_idx = np.where(inside, dbm[np.newaxis, :], -np.inf).argmax(axis=1)
+    low_idx = np.abs(frequency[np.newaxis, :] - low[:, np.newaxis]).argmin(axis=1)
+    high_idx = np.abs(frequency[np.newaxis, :] - high[:, np.newaxis]).argmin(axis=1)
+    noise_mw = np.minimum(mw[low_idx], mw[high_idx])
+    signal_mw = total_mw - noise_mw * widths / rbw
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        power = np.where(measured, 10 * np.log10(total_mw), np.nan)
+        osnr = np.where(measured & (signal_mw > 0),
+                        10 * np.log10(signal_mw / (noise_mw * OSNR_REFERENCE_BANDWIDTH / rbw)), np.nan)
+    peak = np.where(measured, dbm[peak_idx], np.nan)
+    peak_frequency = np.where(measured, frequency[peak_idx], np.nan)
+    return ChannelPowers(power, peak, peak_frequency, osnr)
+
+
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
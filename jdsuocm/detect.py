@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import collections
+import logging
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POWER_THRESHOLD = 3.0                           # dB change in a point's power that is reported
+
+# A change in a scan, change is "added" or "dropped" for an ITU channel's
+# presence, otherwise "power" for a power excursion. port is None for ITU scans.
+SpectrumChange = collections.namedtuple("SpectrumChange", [ "port", "frequency", "change", "power", "previous" ])
+
+
+class ChangeDetector (object):
+    """Find the changes between each scan of a device and the last one reported.
+
+    A point's power is a change when it differs from the power last reported for
+    it by at least power_threshold dB, only changed points are updated so slow
+    drift is reported once it adds up. ITU scans with presence also report
+    channels being added and dropped. The first scan of each kind and port (and
+    the first after its frequencies change) sets the baseline and reports nothing.
+    """
+
+    def __init__ (self, power_threshold=DEFAULT_POWER_THRESHOLD):
+        if np is None:
+            raise ImportError("change detection requires numpy")
+        self.power_threshold = power_threshold
+        self.lock = threading.Lock()
+        # (frequency, power, presence) by (kind, port)
+        self.baselines = {}
+
+    def check (self, kind, result):
+        """Return the SpectrumChange list for a scan of kind, result is a (port,
+        Spectrum) list for full scans or the points of an ITU scan."""
+        with self.lock:
+            if kind.startswith("itu"):
+                return self._check_itu(kind, result)
+            changes = []
+            for port, spectrum in result:
+                changes.extend(self._check_port(kind, port, spectrum.frequency, spectrum.dbm, None))
+            return changes
+
+    def _check_itu (self, kind, points):
+        frequency = [ x[0] for x in points ]
+        power = [ x[-1].dBm for x in points ]
+        presence = [ x[1] for x in points ] if points and len(points[0]) == 3 else None
+        return self._check_port(kind, None, frequency, power, presence)
+
+    def _check_port (self, kind, port, frequency, power, presence):
+        frequency = np.asarray(frequency, dtype=np.float64)
+        power = np.array(power, dtype=np.float64)
+        if presence is not None:
+            presence = np.asarray(presence, dtype=bool)
+
+        baseline = self.baselines.get((kind, port))
+        if baseline is None or not np.array_equal(baseline[0], frequency):
+            self.baselines[(kind, port)] = [ frequency, power, presence ]
+            return []
+
+        unused, last_power, last_presence = baseline
+        changes = []
+        if presence is not None:
+            if last_presence is not None:
+                for idx in np.flatnonzero(presence != last_presence).tolist():
+                    changes.append(SpectrumChange(port, frequency[idx], "added" if presence[idx] else "dropped",
+                                                  power[idx], last_power[idx]))
+                    last_power[idx] = power[idx]
+            baseline[2] = presence
+
+        moved = np.flatnonzero(np.abs(power - last_power) >= self.power_threshold)
+        for idx in moved.tolist():
+            changes.append(SpectrumChange(port, frequency[idx], "power", power[idx], last_power[idx]))
+        last_power[moved] = power[moved]
+        return changes
+
+
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
@@ -18,18 +18,29 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import errno
 import logging
 import os
-import pdb
+import select
+import socket
 import struct
+import time
 from pkg_resources import Requirement, resource_filename
 from sshutil.host import Host
 from sshutil.conn import SSHCommandSession
 from opticalutil.power import Power, Gain
 from opticalutil.dwdm import frequency_to_wavelen_precise, wavelen_to_frequency
 from jdsuocm.error import OCMError, get_error_result
+from jdsuocm.history import ScanHistory
+from jdsuocm.spectrum import Spectrum, TAP_GAIN
+from jdsuocm.stats import DeviceStats
 import jdsuocm.error as jerror
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 logger = logging.getLogger(__name__)
 
 from netconf import nsmap_update
@@ -59,6 +70,7 @@ MINRESPLEN = 2                                                # + 2 for frame
 MAXRESPLEN = 41004
 MINCMDLEN = 5                                                 # + 2 for frame
 MAXCMDLEN = 100
+RXBUF_LEN = (MAXRESPLEN + 4) * 2                              # + msgid, len, error, cksum
 
 TFOCM_DEFAULT_START_FREQ = 190700
 TFOCM_DEFAULT_STOP_FREQ = 190700 + (128 * 50)
@@ -66,6 +78,75 @@ TFOCM_DEFAULT_STOP_FREQ = 190700 + (128 * 50)
 DEVTYPE_4PORT = 0
 DEVTYPE_TFOCM = 1
 
+# Cache policy for device attributes, CACHE_UNTIL_RESET values never change until the device is
+# reset or activated, CACHE_TTL values are kept for the OCM's cache_ttl seconds.
+CACHE_UNTIL_RESET = 0
+CACHE_TTL = 1
+DEFAULT_CACHE_TTL = 5.0
+
+# Number of command frames written before waiting for responses in run_cmd_batch, pipelining
+# is off by default until it has been checked on the hardware.
+DEFAULT_PIPELINE_WINDOW = 1
+
+# Errors returned for a frame that arrived while the device was busy, i.e., it doesn't pipeline.
+PIPELINE_REJECT_ERRORS = (jerror.EFRAMECKSUM, jerror.EPROTOCOL)
+# Errors reading pipelined responses, a device may silently drop frames sent while it's busy.
+PIPELINE_LOST_ERRORS = (jerror.ETIMEOUT, jerror.EBADRESP)
+
+# Seconds from sending a command until its response must start, scans, resets and
+# downloads take seconds, other actions and reads should be answered almost at once.
+DEFAULT_ACTION_DEADLINE = 1.0
+DEFAULT_READ_DEADLINE = 0.5
+SLOW_COMMAND_DEADLINES = {
+    'START-SELF-TEST': 5.0,
+    'ACTIVATE': 10.0,
+    'RESET': 10.0,
+    'SET-FACTORY-DEFAULT': 5.0,
+    'DOWNLOAD-INIT': 5.0,
+    'DOWNLOAD': 5.0,
+    'CALIB-INIT': 5.0,
+    'CALIB-DOWNLOAD': 5.0,
+    'APPLY-CALIB': 10.0,
+    'GET-RAW-POWER-DATA': 5.0,
+    'GET-SINGLE-POWER': 2.0,
+    'FULL-ITU-SCAN': 5.0,
+    'FULL-ITU-POWER-SCAN': 5.0,
+    'SCAN-ITU-GAUSS-FIT': 5.0,
+    'SCAN': 10.0,
+    'FULL-SPECTRUM-SCAN': 10.0,
+    'FULL-12-SCAN': 10.0,
+    'FULL-12-CH-SCAN': 10.0,
+    'SCAN-DETECT-CHAN': 10.0,
+    'SCAN-SPEC-DENSITY': 10.0,
+    'SCAN-SPEC-DENSITY-CHAN': 10.0,
+}
+
+# Once a response has started the longest gap allowed between bytes.
+DEFAULT_INTER_BYTE_TIMEOUT = 0.5
+
+# Read commands don't change the device state, they are retried up to this many times if
+# their response doesn't arrive or is corrupt.
+CMD_TYPE_ACTION = 1
+CMD_TYPE_READ = 2
+DEFAULT_READ_RETRIES = 2
+RETRY_ERRORS = (jerror.ETIMEOUT, jerror.EBADRESP)
+
+cache_policy = {
+    'idn': CACHE_UNTIL_RESET,
+    'app-version': CACHE_UNTIL_RESET,
+    'safe-version': CACHE_UNTIL_RESET,
+    'calib-version': CACHE_UNTIL_RESET,
+    'module-info': CACHE_UNTIL_RESET,
+    'temp': CACHE_TTL,
+    'fail-reg': CACHE_TTL,
+    'fail-reg-temp': CACHE_TTL,
+}
+
+FULL_SCAN_FREQ_BASE = 1900000                                  # 100MHz units
+FULL_125_START_FREQ = 191000                                   # GHz
+FULL_125_STEP_FREQ = 6.25                                      # GHz
+FULL_125_NPOINTS = 839
+
 """
 for 12.5GHz wide scan every 6.25Ghz, total 839 slices
 1910000 -> 1962500 yields 5250.0 Ghz band
@@ -182,40 +263,272 @@ commands_4port = {
 }
 
 
-def read_exact_len (jdsu, rlen):
-    buf = b""
+def get_command_deadlines (commands):
+    "Return the response start deadline in seconds for each of the commands by name"
+    deadlines = {}
+    for cmdname, cmdinfo in commands.items():
+        if cmdname in SLOW_COMMAND_DEADLINES:
+            deadlines[cmdname] = SLOW_COMMAND_DEADLINES[cmdname]
+        elif cmdinfo[0] == CMD_TYPE_ACTION:
+            deadlines[cmdname] = DEFAULT_ACTION_DEADLINE
+        else:
+            deadlines[cmdname] = DEFAULT_READ_DEADLINE
+    return deadlines
+
+
+# Structs for decoding by format and count, e.g., ("h", 839) for the powers of a 12.5GHz
+# scan port, built the first time they're needed.
+decode_structs = {}
+MAX_DECODE_STRUCTS = 256
+
+
+def get_struct (fmt, count=1):
+    "Return the big-endian struct for `count` repeats of `fmt`, e.g., get_struct('Hh', npoints)"
+    key = (fmt, count)
+    try:
+        return decode_structs[key]
+    except KeyError:
+        if len(decode_structs) >= MAX_DECODE_STRUCTS:
+            decode_structs.clear()
+        if len(fmt) == 1:
+            dstruct = struct.Struct(">{}{}".format(count, fmt))
+        else:
+            dstruct = struct.Struct(">" + fmt * count)
+        decode_structs[key] = dstruct
+        return dstruct
+
+
+def new_frame_buffer ():
+    "Allocate a buffer large enough to hold the largest response frame"
+    return memoryview(bytearray(RXBUF_LEN))
+
+
+def read_exact_into (jdsu, view, times=None):
+    """Fill all of the memoryview `view` from the device, using recv_into if available.
+
+    If `times` is a list the time the first bytes were received is appended to it.
+    """
+    recv_into = getattr(jdsu, "recv_into", None)
+    rlen = len(view)
     blen = 0
     while blen < rlen:
         leftover = rlen - blen
-        nbuf = jdsu.recv(leftover)
-        nblen = len(nbuf)
+        if recv_into is not None:
+            nblen = recv_into(view[blen:], leftover)
+        else:
+            nbuf = jdsu.recv(leftover)
+            nblen = len(nbuf)
+            view[blen:blen + nblen] = nbuf
         assert nblen <= leftover
-        buf += nbuf
+        if times is not None and nblen and not blen:
+            times.append(time.time())
         blen += nblen
-    return buf
-
-
-def read_var_resp (jdsu):
-    hdr = read_exact_len(jdsu, 6)
-    if len(hdr) != 6:
-        pdb.set_trace()
-    msgid, mlen, result = struct.unpack('>HHH', hdr)
-    assert mlen >= 2
-    mlen -= 1
-    rest = read_exact_len(jdsu, mlen * 2)
-    if mlen > 1:
-        data = rest[:-2]
-    else:
-        data = ""
+    return view
 
-    cksum = struct.unpack(">H", rest[-2:])[0]
-    oursum = sum(unpack_data_words(rest[:-2])) + msgid + mlen + 1 + result
-    oursum &= 0xFFFF
-    if oursum != cksum:
-        logger.error("BAD CKSUM: %s %s", str(unpack_data_words(hdr)), str(unpack_data_words(rest)))
-        logger.error("BAD CKSUM: ours: %d theres: %d", oursum, cksum)
 
-    return msgid, result, data
+def read_exact_len (jdsu, rlen):
+    return read_exact_into(jdsu, memoryview(bytearray(rlen))).tobytes()
+
+
+def get_frame_len (buf, msgids=None, offset=0):
+    """Return the length of the response frame whose header is at `offset` in `buf`, 0 if
+    `buf` is too short to tell or -1 if it isn't a valid header (for one of `msgids` if given)"""
+    if len(buf) - offset < 6:
+        return 0
+    msgid, mlen = struct.unpack_from(">HH", buf, offset)
+    if not MINRESPLEN <= mlen <= MAXRESPLEN + 2:
+        return -1
+    if msgids is not None and msgid not in msgids:
+        return -1
+    return 4 + mlen * 2
+
+
+def check_frame (buf, msgids=None, offset=0):
+    """Check for a response frame at `offset` in `buf`, return its length if it is
+    complete with a valid checksum, 0 if more data is needed to tell or -1 if it isn't
+    a valid frame (for one of `msgids` if given)"""
+    flen = get_frame_len(buf, msgids, offset)
+    if flen <= 0 or len(buf) - offset < flen:
+        return min(flen, 0)
+    words = get_struct("H", flen // 2).unpack_from(buf, offset)
+    cksum = (sum(words) - words[-1]) & 0xFFFF
+    if cksum != words[-1]:
+        logger.error("BAD CKSUM: msgid %d ours: %d theres: %d", words[0], cksum, words[-1])
+        return -1
+    return flen
+
+
+class ResponseReader (object):
+    """Read response frames from a transport into a buffer.
+
+    The length and checksum of every frame are verified. If a frame is invalid,
+    e.g., a byte was dropped, the reader resynchronizes by scanning forward a byte
+    at a time for a valid frame, bytes read past that frame are kept for the next
+    read. Returned data is a memoryview into the buffer, it is only valid until the
+    next read.
+    """
+
+    def __init__ (self, jdsu, view=None):
+        self.jdsu = jdsu
+        self.view = new_frame_buffer() if view is None else view
+        self.start = 0                                      # Bytes read past the last frame
+        self.end = 0
+        self.resyncs = 0
+        self.skipped_bytes = 0
+
+    def clear (self):
+        "Discard any buffered bytes, e.g., after draining the transport"
+        self.start = self.end = 0
+
+    def _fill (self, blen, rlen, times=None):
+        if blen < rlen:
+            read_exact_into(self.jdsu, self.view[blen:rlen], times)
+        return max(blen, rlen)
+
+    def _compact (self):
+        "Move bytes left from the last read to the front, returning their length"
+        blen = self.end - self.start
+        if self.start:
+            self.view[:blen] = self.view[self.start:self.end]
+        self.start = self.end = 0
+        return blen
+
+    def _shift (self, pos, blen):
+        "Move the bytes from pos to blen to the front of the buffer, returning their length"
+        if pos:
+            self.view[:blen - pos] = self.view[pos:blen]
+        return blen - pos
+
+    def read (self, msgids=None, times=None):
+        """Read the next valid frame for one of `msgids` (any if None) returning (msgid, result, data).
+
+        Valid frames for other msgids, e.g., the late response to an abandoned command,
+        are discarded. Raises OCMError(EBADRESP) if no valid frame is found within a
+        buffer's worth of bytes, transports also raise OCMError if their deadline passes.
+        """
+        view = self.view
+        blen = self._fill(self._compact(), 6, times)
+        pos = 0                                             # Where the next frame is looked for
+
+        resync = False
+        skipped = 0
+        while True:
+            # While resynchronizing only consider headers we're waiting for.
+            flen = get_frame_len(view[:blen], msgids if resync else None, pos)
+            if flen > 0:
+                if pos + flen > len(view):
+                    blen, pos = self._shift(pos, blen), 0
+                blen = self._fill(blen, pos + flen)
+                flen = check_frame(view[:blen], None, pos)
+            if flen > 0:
+                msgid, unused, result = struct.unpack_from(RESP_HDR, view, pos)
+                if msgids is None or msgid in msgids:
+                    if resync:
+                        logger.warning("Resynchronized response stream after skipping %d bytes", skipped)
+                    blen = self._shift(pos, blen)
+                    self.start, self.end = flen, blen
+                    return msgid, result, view[6:flen - 2]
+                logger.warning("Discarding response with unexpected msgid %d", msgid)
+                pos += flen
+            else:
+                if not resync:
+                    logger.error("Invalid response frame, resynchronizing")
+                    self.resyncs += 1
+                    resync = True
+                pos += 1
+                skipped += 1
+                self.skipped_bytes += 1
+                if skipped > RXBUF_LEN:
+                    raise OCMError(jerror.EBADRESP)
+            # Bytes are only moved once the buffer is used up rather than for every byte skipped.
+            if pos + 6 > len(view):
+                blen, pos = self._shift(pos, blen), 0
+            blen = self._fill(blen, pos + 6)
+
+    def read_stream (self, msgids=None, times=None):
+        """Read the header of the next frame for one of `msgids` returning a ResponseStream.
+
+        If the header isn't valid or is for another msgid the frame is read whole as
+        with read (resynchronizing or discarding it) and the stream is of that frame.
+        """
+        view = self.view
+        blen = self._fill(self._compact(), 6, times)
+        flen = get_frame_len(view[:blen])
+        if flen > 0:
+            msgid, unused, result = struct.unpack_from(RESP_HDR, view)
+            if msgids is None or msgid in msgids:
+                return ResponseStream(self, msgid, result, flen, blen)
+
+        self.end = blen
+        msgid, result, data = self.read(msgids)
+        return ResponseStream(self, msgid, result, len(data) + 8, self.end)
+
+
+class ResponseStream (object):
+    """A response frame whose data is read from the transport as it's needed.
+
+    fill(nbytes) returns the frame's data once at least the first nbytes of it have
+    been read, finish() reads the rest of the frame and verifies its checksum. The
+    data is only valid until the reader's next read.
+    """
+
+    def __init__ (self, reader, msgid, result, flen, blen):
+        self.reader = reader
+        self.msgid = msgid
+        self.result = result
+        self.flen = flen
+        self.blen = blen
+        self.data = reader.view[6:flen - 2]
+        self.data_len = flen - 8
+        self.finished = False
+        self.on_finish = None                               # Called with the error result when finished
+
+    def fill (self, nbytes):
+        rlen = min(6 + nbytes, self.flen)
+        if self.blen < rlen:
+            self.blen = self.reader._fill(self.blen, rlen)
+        return self.data
+
+    def finish (self):
+        self.fill(self.data_len + 2)
+        self.finished = True
+        error = jerror.ENOERR
+        if check_frame(self.reader.view[:self.flen]) < 0:
+            self.reader.clear()
+            error = jerror.EBADRESP
+        else:
+            self.reader.start, self.reader.end = self.flen, self.blen
+        if self.on_finish is not None:
+            self.on_finish(error)
+        if error:
+            raise OCMError(error)
+        return self.data
+
+
+class DataStream (object):
+    "The ResponseStream interface on the data of a complete response"
+
+    finished = True
+
+    def __init__ (self, data):
+        self.data = data
+        self.data_len = len(data)
+
+    def fill (self, unused_nbytes):
+        return self.data
+
+    def finish (self):
+        return self.data
+
+
+def read_var_resp (jdsu, view=None, times=None):
+    """Read a variable length response frame into `view` (or a new buffer).
+
+    The returned data is a memoryview into the buffer, it is only valid until the
+    buffer is reused for the next response. `times` is passed to read_exact_into
+    for the header.
+    """
+    return ResponseReader(jdsu, view).read(times=times)
 
 
 def instance_to_ports (bits):
@@ -232,22 +545,19 @@ def instance_to_ports (bits):
 def unpack_data_words (wordstring):
     wlen = len(wordstring)
     assert (wlen % 2) == 0
-    wlen = wlen // 2
-    return struct.unpack(">" + str(wlen) + "H", wordstring)
+    return get_struct("H", wlen // 2).unpack(wordstring)
 
 
 def unpack_unsigned_longs (wordstring):
     wlen = len(wordstring)
     assert (wlen % 4) == 0
-    wlen = wlen // 4
-    return struct.unpack(">" + str(wlen) + "L", wordstring)
+    return get_struct("L", wlen // 4).unpack(wordstring)
 
 
 def unpack_signed_longs (wordstring):
     wlen = len(wordstring)
     assert (wlen % 4) == 0
-    wlen = wlen // 4
-    return struct.unpack(">" + str(wlen) + "l", wordstring)
+    return get_struct("l", wlen // 4).unpack(wordstring)
 
 
 def unpack_data_string (wordstring):
@@ -261,75 +571,302 @@ def unpack_data_string (wordstring):
 
 def unpack_signed_unsigned(data):
     nval = len(data) // 2
-    spoints = struct.unpack(">" + str(nval) + "h", data)
-    upoints = struct.unpack(">" + str(nval) + "H", data)
+    spoints = get_struct("h", nval).unpack(data)
+    upoints = get_struct("H", nval).unpack(data)
     return spoints, upoints
 
 
 def unpack_signed(data):
-    nval = len(data) // 2
-    spoints = struct.unpack(">" + str(nval) + "h", data)
-    return spoints
+    return get_struct("h", len(data) // 2).unpack(data)
 
 
 def unpack_unsigned(data):
-    nval = len(data) // 2
-    upoints = struct.unpack(">" + str(nval) + "H", data)
-    return upoints
+    return get_struct("H", len(data) // 2).unpack(data)
+
+
+if np is not None:
+    FULL_SCAN_DTYPE = np.dtype([ (str("frequency"), ">u2"), (str("power"), ">i2") ])
+
+
+def decode_full_scan_port (data, offset, npoints):
+    "Decode the (frequency, power) word pairs of a full scan port at `offset` in `data`"
+    if np is not None:
+        words = np.frombuffer(data, dtype=FULL_SCAN_DTYPE, count=npoints, offset=offset)
+        frequency = words["frequency"].astype(np.uint32) + FULL_SCAN_FREQ_BASE
+        dbm = words["power"] / 100 + TAP_GAIN
+    else:
+        words = get_struct("Hh", npoints).unpack_from(data, offset)
+        frequency = [ FULL_SCAN_FREQ_BASE + x for x in words[::2] ]
+        dbm = [ x / 100 + TAP_GAIN for x in words[1::2] ]
+    return Spectrum(frequency, dbm)
+
+
+def decode_full_125_scan_port (data, offset, npoints):
+    "Decode the power words of a 12.5GHz scan port at `offset` in `data`, the frequencies are implied"
+    if np is not None:
+        frequency = FULL_125_START_FREQ + FULL_125_STEP_FREQ * np.arange(npoints)
+        dbm = np.frombuffer(data, dtype=">i2", count=npoints, offset=offset) / 100 + TAP_GAIN
+    else:
+        frequency = [ FULL_125_START_FREQ + FULL_125_STEP_FREQ * x for x in range(npoints) ]
+        dbm = [ x / 100 + TAP_GAIN for x in get_struct("h", npoints).unpack_from(data, offset) ]
+    return Spectrum(frequency, dbm)
+
+
+def decode_idn_string (wordstring):
+    "Decode a GET-IDN-MSG response, the IDN is made of of ASCII characters in 16 bit values"
+    data = "".join([ chr(x) for x in unpack_data_words(wordstring) ])
+    return data.encode('ascii').decode('ascii')
+
+
+def decode_module_info (wordstring):
+    """Decode a GET-MODULE-INFO response, ASCII characters in 16 bit values padded
+    with NULs. If it isn't printable ASCII the words are returned in hex."""
+    words = unpack_data_words(wordstring)
+    data = "".join([ chr(x) for x in words ]).rstrip("\0")
+    if all([ " " <= x <= "~" for x in data ]):
+        return data
+    return " ".join([ "{:04x}".format(x) for x in words ])
+
+
+def iter_full_scan_ports (stream, instance, asarray=False, debug=False):
+    """Decode a FULL-SPECTRUM-SCAN response stream, yields (port, Spectrum) if asarray otherwise
+    (port, points) for each port as soon as its data has been read"""
+    data = stream.fill(2)
+    nports = struct.unpack_from(">H", data)[0]
+    offset = 2
+    if debug:
+        logger.debug("FSCAN: Port Count: %d", nports)
+
+    for port in instance_to_ports(instance):
+        data = stream.fill(offset + 2)
+        npoints = struct.unpack_from(">H", data, offset)[0]
+        offset += 2
+
+        if stream.data_len - offset < 4 * npoints:
+            raise ValueError("Returned points {} different from expected {}".format((stream.data_len - offset) // 4,
+                                                                                   npoints))
+        data = stream.fill(offset + 4 * npoints)
+        spectrum = decode_full_scan_port(data, offset, npoints)
+        offset += 4 * npoints
+
+        if debug:
+            logger.debug("FSCAN PORT %s points %d", port, npoints)
+
+        yield (port, spectrum if asarray else spectrum.points())
+
+    # Want better error here.
+    if offset != stream.data_len:
+        raise ValueError("Extra data form OCM of len: {}".format(stream.data_len - offset))
+    stream.finish()
+
+
+def iter_full_125_scan_ports (stream, instance, asarray=False, debug=False):
+    """Decode a FULL-12-SCAN response stream, yields (port, Spectrum) if asarray otherwise
+    (port, points) for each port as soon as its data has been read"""
+    data = stream.fill(2)
+    nports = struct.unpack_from(">H", data)[0]
+    offset = 2
+    if debug:
+        logger.debug("FSCAN125x625: Port Count: %s", str(nports))
+
+    for port in instance_to_ports(instance):
+        data = stream.fill(offset + 2)
+        npoints = struct.unpack_from(">H", data, offset)[0]
+        offset += 2
+        if npoints != FULL_125_NPOINTS:
+            raise ValueError("Too man points {} (not {}) in 12.5x6.25 scan".format(npoints, FULL_125_NPOINTS))
+
+        if stream.data_len - offset < 2 * npoints:
+            raise ValueError("Returned points {} different from expected {}".format((stream.data_len - offset) // 2,
+                                                                                   npoints))
+        data = stream.fill(offset + 2 * npoints)
+        spectrum = decode_full_125_scan_port(data, offset, npoints)
+        offset += 2 * npoints
+
+        if debug:
+            logger.debug("FSCAN125x625 PORT %d points %d", port, npoints)
+
+        yield (port, spectrum if asarray else spectrum.points())
+
+    if offset != stream.data_len:
+        raise ValueError("Extra data form OCM of len: {}".format(stream.data_len - offset))
+    stream.finish()
+
+
+def decode_full_scan (data, instance, asarray=False, debug=False):
+    "Decode a FULL-SPECTRUM-SCAN response, returns (port, Spectrum) if asarray otherwise (port, points)"
+    return list(iter_full_scan_ports(DataStream(data), instance, asarray, debug))
+
+
+def decode_full_125_scan (data, instance, asarray=False, debug=False):
+    "Decode a FULL-12-SCAN response, returns (port, Spectrum) if asarray otherwise (port, points)"
+    return list(iter_full_125_scan_ports(DataStream(data), instance, asarray, debug))
+
+
+def decode_channel_profile (data):
+    "Decode a READ-PROFILE response into a list of (start, end) frequencies"
+    nchan = struct.unpack_from(">H", data)[0]
+    if len(data) - 2 != nchan * 4:
+        raise ValueError("Frequencies returned {} different from expected {}".format((len(data) - 2) // 2,
+                                                                                    nchan * 2))
+    freqlist = [ x + 1900000 for x in get_struct("H", nchan * 2).unpack_from(data, 2) ]
+    if len(freqlist) % 1 != 0:
+        raise ValueError("Channel frequencies not paired, total frequency count {}".format(len(freqlist)))
+    freqlist = list(zip(freqlist[::2], freqlist[1::2]))
+    return freqlist
+
+
+ITU_NCHANNELS = 128
+# Frequencies (msw, lsw of the wavelength in pm if hires, else 10pm above 1500nm), presence and power.
+ITU_SCAN_HIRES_STRUCT = struct.Struct(">{0}L{0}H{0}h".format(ITU_NCHANNELS))
+ITU_SCAN_STRUCT = struct.Struct(">{0}H{0}H{0}h".format(ITU_NCHANNELS))
+
+
+def decode_itu_scan (data, hires):
+    "Decode a FULL-ITU-SCAN response into a list of (frequency, presence, power)"
+    if hires:
+        words = ITU_SCAN_HIRES_STRUCT.unpack_from(data)
+        frequency = [ wavelen_to_frequency(float(x) / 1000.0) if x > 0 else 0 for x in words[:ITU_NCHANNELS] ]
+    else:
+        words = ITU_SCAN_STRUCT.unpack_from(data)
+        frequency = [ wavelen_to_frequency((float(x) / 100.0) + 1500.0) for x in words[:ITU_NCHANNELS] ]
+
+    presence = words[ITU_NCHANNELS:2 * ITU_NCHANNELS]
+    scale = 100 if hires else 10
+    power = [ Power(x / scale) for x in words[2 * ITU_NCHANNELS:] ]
+    return list(zip(frequency, presence, power))
+
+
+def decode_itu_power_scan (data, hires):
+    "Decode a FULL-ITU-POWER-SCAN response into a list of (frequency, power)"
+    scale = 100 if hires else 10
+    power = [ Power(x / scale) for x in get_struct("h", ITU_NCHANNELS).unpack_from(data) ]
+
+    # XXX Are the start and stop frequency or the interval affected by the user settings?
+    # or always constant b/c it's the ITU variant of the commands
+    return list(zip(range(TFOCM_DEFAULT_START_FREQ, TFOCM_DEFAULT_STOP_FREQ + 1, 50),
+                    power))
 
 
 def get_next_msgid ():
     this_id = get_next_msgid.next
-    get_next_msgid.next += 1
+    get_next_msgid.next = (this_id % 0xFFFF) + 1            # msgids are 16 bits, 0 is skipped
     return this_id
 get_next_msgid.next = 1
 
 
-def send_cmd(jdsu, commands, cmdname, data=b"", instance=None, debug=False):
-    cmdinfo = commands[cmdname]
-    cmd = list(cmdinfo[0:4])
-    if cmd[2] == INST_MAP_TAG:
-        assert instance is not None
-        cmd[2] = inst_map[instance]
-    elif cmd[2] == PROFILE_ID_TAG:
-        assert instance is not None
-        cmd[2] = instance
-    elif cmd[2] == PORT_NUM_TAG:
-        assert instance is not None
-        cmd[2] = instance
-
-    if data:
-        assert cmdinfo[4]
-    else:
-        assert not cmdinfo[4]
-    dlen = len(data)
-    assert (dlen % 2) == 0
-    dwlen = dlen // 2
-    clen = len(cmd) + dwlen + 1                             # +1 cksum
-    rawcmd = [ get_next_msgid(), clen ] + list(cmd)
-    cksum = sum(rawcmd)
-    rawdata = struct.pack(">6H", *rawcmd)
-    if data:
-        cksum += sum(unpack_unsigned(data))
-    rawdata += data + struct.pack(">H", cksum & 0xFFFF)
-    rlen = len(rawdata) // 2
-    assert clen == rlen - 2
+CMD_STRUCT = struct.Struct(">7H")                          # msgid, len, cmd, obj, inst, param, cksum
+
+
+class CommandTemplate (object):
+    """A command compiled for encoding.
+
+    The checksum of the words that are the same for every frame is computed
+    once, encoding is a single pack and a small add. Frames with data use a
+    struct for each data length, created the first time that length is sent.
+    """
+
+    def __init__ (self, cmdname, cmdinfo):
+        self.cmdname = cmdname
+        self.cmd, self.obj, inst, self.param, self.has_data = cmdinfo[0:5]
+        if inst < 0:
+            self.inst_tag, self.inst = inst, None
+        else:
+            self.inst_tag, self.inst = None, inst
+        self.partial = self.cmd + self.obj + self.param
+        self.data_structs = {}
+        # Data bytes of a successful fixed length response, None if variable.
+        respfmt = cmdinfo[5]
+        self.resp_data_len = struct.calcsize(respfmt) - 8 if respfmt else None
+
+    def get_data_structs (self, dlen):
+        "Return the (frame, data words) structs for frames with `dlen` bytes of data"
+        try:
+            return self.data_structs[dlen]
+        except KeyError:
+            assert (dlen % 2) == 0
+            structs = (struct.Struct(">6H{}sH".format(dlen)), struct.Struct(">{}H".format(dlen // 2)))
+            self.data_structs[dlen] = structs
+            return structs
+
+    def encode (self, msgid, data=b"", instance=None):
+        "Return the command frame, asserts if the arguments are invalid"
+        inst = self.inst
+        if inst is None:
+            assert instance is not None
+            inst = inst_map[instance] if self.inst_tag == INST_MAP_TAG else instance
+        if not data:
+            assert not self.has_data
+            cksum = self.partial + msgid + inst + 5                     # len: cmd, obj, inst, param, cksum
+            return CMD_STRUCT.pack(msgid, 5, self.cmd, self.obj, inst, self.param, cksum & 0xFFFF)
+
+        assert self.has_data
+        fstruct, dstruct = self.get_data_structs(len(data))
+        clen = 5 + dstruct.size // 2
+        cksum = self.partial + msgid + inst + clen + sum(dstruct.unpack(data))
+        return fstruct.pack(msgid, clen, self.cmd, self.obj, inst, self.param, data, cksum & 0xFFFF)
+
+
+def compile_commands (commands):
+    "Return a CommandTemplate for each of the commands by name"
+    return dict([ (cmdname, CommandTemplate(cmdname, cmdinfo)) for cmdname, cmdinfo in commands.items() ])
+
+
+def encode_cmd (commands, cmdname, data=b"", instance=None, debug=False):
+    """Return the msgid and command frame for a command, asserts if the arguments are invalid.
+
+    `commands` is a dictionary of command tuples or CommandTemplates (see compile_commands) by name.
+    """
+    template = commands[cmdname]
+    if not isinstance(template, CommandTemplate):
+        template = CommandTemplate(cmdname, template)
+    msgid = get_next_msgid()
+    rawdata = template.encode(msgid, data, instance)
     if debug:
         logger.debug("sending: %s", str(cmdname))
         logger.debug("sending: %s", str(unpack_unsigned(rawdata)))
+    return msgid, rawdata
+
+
+def send_cmd(jdsu, commands, cmdname, data=b"", instance=None, debug=False):
+    msgid, rawdata = encode_cmd(commands, cmdname, data, instance, debug)
     jdsu.send(rawdata)
+    return msgid
 
 
 class OCM (object):
-    def __init__ (self, device, debug=False):
+    def __init__ (self, device, debug=False, cache_ttl=DEFAULT_CACHE_TTL, pipeline_window=DEFAULT_PIPELINE_WINDOW,
+                  read_retries=DEFAULT_READ_RETRIES):
         self.device = device
         self.debug = debug
+        self.pipeline_window = pipeline_window
+        self.read_retries = read_retries
+        self.cache = {}
+        self.cache_ttl = cache_ttl
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Responses are read into the reader's buffer, returned data is only valid until the next command.
+        self.reader = ResponseReader(device)
+        # Transports that support it are given the deadline for each response.
+        self.set_deadline = getattr(device, "set_deadline", None)
+        # Set when a response was abandoned, it may still arrive before the next command.
+        self.timed_out = False
+        # The last ResponseStream returned by run_cmd_stream.
+        self.stream = None
+        # Per command counts, byte counts, errors and timings of all device I/O.
+        self.stats = DeviceStats()
+        # Recent scans if enabled with enable_history.
+        self.history = None
+        # Called with each scan taken, see add_scan_listener.
+        self.scan_listeners = []
         assert not self.drain_serial_read_queue()
 
         # single port safe: [u'JDSU', u'TFOCM', u'50GHz', u'safe00.04.68']
         # single port app:  [u'JDSU', u'TFOCM', u'50GHz', u'hw46', u'cal02', u'appfw03.08.94']
 
         self.commands = dict(commands_common.items())
+        self.deadlines = get_command_deadlines(self.commands)
+        self.templates = compile_commands(self.commands)
 
         idn = self.get_idn_data()
         if len(idn) > 4 and idn[4] == 'cal04':
@@ -340,6 +877,8 @@ class OCM (object):
             self.devtype = DEVTYPE_TFOCM
             self.nports = 1
             self.commands.update(commands_1port.items())
+        self.deadlines = get_command_deadlines(self.commands)
+        self.templates = compile_commands(self.commands)
 
         # reset the device on init, only works on 4 port.
         # For tf-ocm though we reset to factory default a poor man's reset
@@ -374,38 +913,237 @@ class OCM (object):
 
     def run_cmd_status(self, cmdname, data=b"", instance=None):
         if cmdname not in self.commands:
+            self.stats.record(cmdname, 0, 0, jerror.EBADCMD)
             return jerror.EBADCMD, b""
 
         # XXX really need to catch any errors here and return an error instead to match API.
 
-        try:
-            send_cmd(self.device, self.commands, cmdname, data, instance, debug=self.debug)
-        except AssertionError:
-            return jerror.EBADCMD
-
-        respfmt = self.commands[cmdname][5]
-        if not respfmt:
-            unused, error, data = read_var_resp(self.device)
-        else:
-            resplen = (len(respfmt) - 1) * 2
-            rdata = read_exact_len(self.device, resplen)
-            unused_msgid, unused_mlen, error = struct.unpack('>HHH', rdata[:6])
-            data = rdata[6:-2]
-            cksum = rdata[-2:]
-            # XXX check cksum
-            # XXX verify len
+        retries = self.read_retries if self.commands[cmdname][0] == CMD_TYPE_READ else 0
+        while True:
+            error, rdata = self._run_cmd_once(cmdname, data, instance)
+            if error not in RETRY_ERRORS or not retries:
+                break
+            retries -= 1
+            logger.warning("Retrying command %s after: %s", cmdname, get_error_result(error))
         if error:
             logging.debug("Command %s failed with result: %s", cmdname, get_error_result(error))
 
+        return error, rdata
+
+    def run_cmd_stream (self, cmdname, data=b"", instance=None):
+        """Run a command returning a ResponseStream of its response, the data is read as
+        it's consumed, raises OCMError on error. The stream must be finished before the
+        next command. Read commands are retried if their response doesn't start."""
+        if cmdname not in self.commands:
+            self.stats.record(cmdname, 0, 0, jerror.EBADCMD)
+            raise OCMError(jerror.EBADCMD)
+
+        retries = self.read_retries if self.commands[cmdname][0] == CMD_TYPE_READ else 0
+        while True:
+            error, stream = self._run_cmd_once(cmdname, data, instance, True)
+            if error not in RETRY_ERRORS or not retries:
+                break
+            retries -= 1
+            logger.warning("Retrying command %s after: %s", cmdname, get_error_result(error))
+        if error:
+            if stream:
+                stream.finish()
+            raise OCMError(error)
+        return stream
+
+    def _drain_abandoned (self):
+        "Drain the transport if a response was abandoned, it may still arrive"
+        if self.stream is not None:
+            stream, self.stream = self.stream, None
+            if not stream.finished:
+                # Read the rest of the frame, still under its command's deadline.
+                try:
+                    stream.finish()
+                except OCMError:
+                    self.timed_out = True
+        if self.timed_out:
+            self.timed_out = False
+            self.drain_serial_read_queue()
+
+    def _run_cmd_once (self, cmdname, data, instance, stream=False):
+        self._drain_abandoned()
+        try:
+            msgid, rawdata = encode_cmd(self.templates, cmdname, data, instance, debug=self.debug)
+        except AssertionError:
+            self.stats.record(cmdname, 0, 0, jerror.EBADCMD)
+            return jerror.EBADCMD, b""
+        start = time.time()
+        if self.set_deadline is not None:
+            self.set_deadline(start + self.deadlines[cmdname])
+        self.device.send(rawdata)
+        sent = time.time() - start
+
+        times = []
+        try:
+            if stream:
+                return self._read_stream(cmdname, msgid, len(rawdata), start, sent, times)
+            # Responses to earlier abandoned commands are discarded by msgid.
+            unused, error, data = self.reader.read((msgid,), times)
+            resp_data_len = self.templates[cmdname].resp_data_len
+            if resp_data_len is not None and not error and len(data) != resp_data_len:
+                logger.error("Command %s response has %d data bytes expected %d", cmdname, len(data), resp_data_len)
+                raise OCMError(jerror.EBADRESP)
+        except OCMError as ex:
+            # Raised by the transport if the deadline passes or the reader if the response is bad.
+            logger.error("Command %s failed waiting for response: %s", cmdname, str(ex))
+            self.timed_out = True
+            self.stats.record(cmdname, len(rawdata), 0, ex.error, sent, times[0] - start if times else None)
+            return ex.error, b""
+        self.stats.record(cmdname, len(rawdata), len(data) + 8, error, sent, times[0] - start, time.time() - start)
         return error, data
 
+    def _read_stream (self, cmdname, msgid, reqlen, start, sent, times):
+        rstream = self.stream = self.reader.read_stream((msgid,), times)
+
+        def on_finish (error):
+            if error:
+                # The frame's length may have been bad too, drain before the next command.
+                self.timed_out = True
+            respbytes = rstream.flen if not error else 0
+            self.stats.record(cmdname, reqlen, respbytes, error or rstream.result, sent, times[0] - start,
+                              time.time() - start)
+        rstream.on_finish = on_finish
+        return rstream.result, rstream
+
     def run_cmd(self, cmdname, data=b"", instance=None):
         error, data = self.run_cmd_status(cmdname, data, instance)
         if error:
             raise OCMError(error)
         return data
 
+    def run_cmd_batch_status (self, cmds, window=None):
+        """Run a list of (cmdname, data, instance) commands returning a list of (error, data).
+
+        Up to `window` command frames are written back to back before the responses
+        are read and matched to their commands by msgid. If the device rejects a
+        frame sent while it was busy, or the responses stop arriving, pipelining is
+        disabled and the rejected or outstanding commands are re-run in lock-step.
+        Unlike run_cmd_status the returned data is a copy and remains valid.
+        """
+        if window is None:
+            window = self.pipeline_window
+        if window <= 1:
+            return [ self._copy_status(self.run_cmd_status(*cmd)) for cmd in cmds ]
+
+        results = [ None ] * len(cmds)
+        outstanding = {}
+        sendinfo = {}
+        rejected = []
+        cmditer = iter(enumerate(cmds))
+        while True:
+            if not outstanding:
+                self._drain_abandoned()
+
+            # Fill the window
+            while len(outstanding) < window and not rejected:
+                try:
+                    idx, (cmdname, data, instance) = next(cmditer)
+                except StopIteration:
+                    break
+                if cmdname not in self.commands:
+                    self.stats.record(cmdname, 0, 0, jerror.EBADCMD)
+                    results[idx] = (jerror.EBADCMD, b"")
+                    continue
+                try:
+                    msgid, rawdata = encode_cmd(self.templates, cmdname, data, instance, debug=self.debug)
+                except AssertionError:
+                    self.stats.record(cmdname, 0, 0, jerror.EBADCMD)
+                    results[idx] = (jerror.EBADCMD, b"")
+                    continue
+                start = time.time()
+                self.device.send(rawdata)
+                sendinfo[msgid] = (start, time.time() - start, len(rawdata))
+                outstanding[msgid] = idx
+            if not outstanding:
+                break
+
+            if self.set_deadline is not None:
+                self.set_deadline(time.time() + max([ self.deadlines[cmds[idx][0]] for idx in outstanding.values() ]))
+            times = []
+            try:
+                msgid, error, data = self.reader.read(outstanding, times)
+            except OCMError as ex:
+                logger.error("Batch failed waiting for %d responses: %s", len(outstanding), str(ex))
+                for msgid, idx in outstanding.items():
+                    start, sent, reqlen = sendinfo.pop(msgid)
+                    self.stats.record(cmds[idx][0], reqlen, 0, ex.error, sent)
+                    if ex.error in PIPELINE_LOST_ERRORS:
+                        rejected.append(idx)
+                    else:
+                        results[idx] = (ex.error, b"")
+                outstanding.clear()
+                self.timed_out = True
+                continue
+            idx = outstanding.pop(msgid)
+            # The first byte latency of pipelined commands includes waiting on those ahead of them.
+            start, sent, reqlen = sendinfo.pop(msgid)
+            self.stats.record(cmds[idx][0], reqlen, len(data) + 8, error, sent, times[0] - start, time.time() - start)
+            if error in PIPELINE_REJECT_ERRORS:
+                rejected.append(idx)
+            else:
+                results[idx] = (error, data.tobytes())
+
+        # Rejected commands and those whose response was lost are re-run lock-step, which retries reads.
+        if rejected:
+            logger.warning("Device rejected or dropped pipelined commands, falling back to lock-step")
+            self.pipeline_window = 1
+            rejected.extend([ idx for idx, unused in cmditer ])
+            for idx in sorted(rejected):
+                results[idx] = self._copy_status(self.run_cmd_status(*cmds[idx]))
+        return results
+
+    def run_cmd_batch (self, cmds, window=None):
+        "Run a list of (cmdname, data, instance) commands returning a list of data, raise OCMError on any error"
+        results = self.run_cmd_batch_status(cmds, window)
+        for error, unused in results:
+            if error:
+                raise OCMError(error)
+        return [ data for unused, data in results ]
+
+    @staticmethod
+    def _copy_status (status):
+        error, data = status
+        return error, bytes(data)
+
+    def get_cached (self, key, method):
+        "Return the value of `method` from the cache according to the cache policy for `key`"
+        now = time.time()
+        try:
+            value, expires = self.cache[key]
+            if expires is None or now < expires:
+                self.cache_hits += 1
+                return value
+        except KeyError:
+            pass
+
+        self.cache_misses += 1
+        value = method()
+        if cache_policy[key] == CACHE_UNTIL_RESET:
+            self.cache[key] = (value, None)
+        elif self.cache_ttl:
+            self.cache[key] = (value, now + self.cache_ttl)
+        return value
+
+    def clear_cache (self):
+        self.cache.clear()
+
+    def get_statistics (self):
+        "Return a dictionary of statistics by command name"
+        return self.stats.as_dict()
+
+    def clear_statistics (self):
+        self.stats.clear()
+
     def drain_serial_read_queue (self):
+        self.reader.clear()
+        # The deadline of an abandoned command has passed, don't let it fail the drain.
+        if self.set_deadline is not None:
+            self.set_deadline(None)
         while self.device.recv_ready():
             extra = self.device.recv()
             if extra:
@@ -424,22 +1162,21 @@ class OCM (object):
         self.run_cmd("SET-FACTORY-DEFAULT")
 
     def reset (self):
+        self.clear_cache()
         if self.devtype != DEVTYPE_4PORT:
             return self.set_factory_default()
         self.run_cmd("RESET")
         assert not self.drain_serial_read_queue()
 
     def activate (self):
+        self.clear_cache()
         self.run_cmd("ACTIVATE")
 
     def get_idn_string (self):
-        # IDN is made of of ASCII characters in 16 bit values.
-        wordstring = self.run_cmd("GET-IDN-MSG")
-        wlen = len(wordstring)
-        assert (wlen % 2) == 0
-        wlen = wlen // 2
-        data = "".join([ chr(x) for x in struct.unpack(">" + str(wlen) + "H", wordstring) ])
-        return data.encode('ascii').decode('ascii')
+        return self.get_cached('idn', self._get_idn_string)
+
+    def _get_idn_string (self):
+        return decode_idn_string(self.run_cmd("GET-IDN-MSG"))
 
     def get_idn_data (self):
         return self.get_idn_string().split(",")
@@ -464,10 +1201,17 @@ class OCM (object):
 
     def get_safe_version (self):
         assert self.devtype == DEVTYPE_4PORT
-        return "{}.{}.{}".format(*unpack_data_words(self.run_cmd("GET-SAFE-VERSION")))
+        return self.get_cached('safe-version', lambda: self._get_version("GET-SAFE-VERSION"))
 
     def get_app_version (self):
-        return "{}.{}.{}".format(*unpack_data_words(self.run_cmd("GET-APP-VERSION")))
+        return self.get_cached('app-version', lambda: self._get_version("GET-APP-VERSION"))
+
+    def get_calib_version (self):
+        assert self.devtype == DEVTYPE_4PORT
+        return self.get_cached('calib-version', lambda: self._get_version("GET-CALIB-VERSION"))
+
+    def _get_version (self, cmdname):
+        return "{}.{}.{}".format(*unpack_data_words(self.run_cmd(cmdname)))
 
     def get_channel_spacing (self):
         assert self.devtype == DEVTYPE_TFOCM
@@ -479,10 +1223,10 @@ class OCM (object):
         self.run_cmd("SET-CHAN-SPACING", struct.pack(">H", spacing))
 
     def get_fail_reg (self):
-        return unpack_data_words(self.run_cmd("READ-FAIL-REG"))[0]
+        return self.get_cached('fail-reg', lambda: unpack_data_words(self.run_cmd("READ-FAIL-REG"))[0])
 
     def get_fail_reg_temp (self):
-        data = unpack_data_words(self.run_cmd("READ-FAIL-REG-TEMP"))
+        data = self.get_cached('fail-reg-temp', lambda: unpack_data_words(self.run_cmd("READ-FAIL-REG-TEMP")))
         return data[0], data[1] / 10
 
     def get_start_freq (self):
@@ -496,16 +1240,13 @@ class OCM (object):
         return unpack_unsigned_longs(self.run_cmd("GET-STOP-FREQ"))[0]
 
     def get_temp (self):
-        return unpack_data_words(self.run_cmd("GET-MODULE-TEMP"))[0] / 10
+        return self.get_temp_int() / 10
 
     def get_temp_int (self):
-        return unpack_data_words(self.run_cmd("GET-MODULE-TEMP"))[0]
+        return self.get_cached('temp', lambda: unpack_data_words(self.run_cmd("GET-MODULE-TEMP"))[0])
 
     def get_module_info (self):
-        data = unpack_data_words(self.run_cmd("GET-MODULE-INFO"))
-        import pdb
-        pdb.set_trace()
-        return data
+        return self.get_cached('module-info', lambda: decode_module_info(self.run_cmd("GET-MODULE-INFO")))
 
     def get_raw_power_scan (self, hires=False):
         assert self.devtype == DEVTYPE_TFOCM
@@ -517,13 +1258,23 @@ class OCM (object):
     def get_freq_power (self, freq):
         "Get power level of a frequency in GHz"
         assert self.devtype == DEVTYPE_TFOCM
+        data = self.run_cmd("GET-SINGLE-POWER", self._freq_power_param(freq))
+        power = Power(unpack_signed(data)[0] / 10)
+        return power
+
+    def get_freq_powers (self, freqs):
+        "Get power levels of a list of frequencies in GHz using pipelined commands"
+        assert self.devtype == DEVTYPE_TFOCM
+        cmds = [ ("GET-SINGLE-POWER", self._freq_power_param(freq), None) for freq in freqs ]
+        return [ Power(unpack_signed(data)[0] / 10) for data in self.run_cmd_batch(cmds) ]
+
+    @staticmethod
+    def _freq_power_param (freq):
         val = int(frequency_to_wavelen_precise(int(freq)) * 1000)
         msw = (val >> 16) & 0xFFFF
         lsw = (val & 0xFFFF)
         # This seems to ignore our resolution request and always returns low
-        data = self.run_cmd("GET-SINGLE-POWER", struct.pack(">HHHH", 1, msw, lsw, 2))
-        power = Power(unpack_signed(data)[0] / 10)
-        return power
+        return struct.pack(">HHHH", 1, msw, lsw, 2)
 
     def get_wavelen_power (self, wavelen):
         "Get power level of a wavelen in nanometers (non-int ok)"
@@ -538,158 +1289,133 @@ class OCM (object):
 
     def get_channel_profile (self, profile_id):
         assert self.devtype == DEVTYPE_4PORT
-        data = self.run_cmd("READ-PROFILE", instance=profile_id)
-        nchan = struct.unpack(">H", data[:2])[0]
-        data = data[2:]
-        if len(data) != nchan * 4:
-            raise ValueError("Frequencies returned {} different from expected {}".format(len(data) // 2, nchan * 2))
-        freqlist = [ x + 1900000 for x in unpack_unsigned(data) ]
-        if len(freqlist) % 1 != 0:
-            raise ValueError("Channel frequencies not paired, total frequency count {}".format(len(freqlist)))
-        freqlist = zip(freqlist[::2], freqlist[1::2])
-        return freqlist
+        return decode_channel_profile(self.run_cmd("READ-PROFILE", instance=profile_id))
+
+    def get_channel_profiles (self, profile_ids):
+        "Get a list of channel profiles using pipelined commands"
+        assert self.devtype == DEVTYPE_4PORT
+        cmds = [ ("READ-PROFILE", b"", profile_id) for profile_id in profile_ids ]
+        return [ decode_channel_profile(data) for data in self.run_cmd_batch(cmds) ]
+
+    def enable_history (self, size_mb, directory=None, name="default"):
+        "Record the scans taken in a history.ScanHistory of size_mb megabytes, see ScanHistory"
+        if self.devtype == DEVTYPE_4PORT:
+            kinds = ("full", "full-125")
+        else:
+            kinds = ("itu", "itu-high-resolution")
+        self.history = ScanHistory(size_mb, kinds, self.nports, directory, name)
+
+    def add_scan_listener (self, listener):
+        """Call listener(kind, timestamp, result) with each scan taken, kind is as for
+        enable_history and result is the (port, Spectrum) list of a full scan or the
+        points of an ITU scan. Listeners are called on the thread running the scan."""
+        self.scan_listeners.append(listener)
+
+    def _is_recording (self):
+        return self.history is not None or bool(self.scan_listeners)
+
+    def _notify_scan (self, kind, timestamp, result):
+        for listener in self.scan_listeners:
+            try:
+                listener(kind, timestamp, result)
+            except Exception:
+                logger.exception("Ignoring error in %s scan listener", kind)
+
+    def _record_itu_scan (self, hires, points):
+        kind = "itu-high-resolution" if hires else "itu"
+        timestamp = time.time()
+        if self.history is not None:
+            spectrum = Spectrum([ x[0] for x in points ], [ x[-1].dBm for x in points ])
+            self.history.record_port(kind, timestamp, 0, spectrum)
+        self._notify_scan(kind, timestamp, points)
+        return points
+
+    def _record_scan (self, kind, result, asarray):
+        if not self._is_recording():
+            return result
+        timestamp = time.time()
+        if self.history is not None:
+            self.history.record(kind, timestamp, result)
+        self._notify_scan(kind, timestamp, result)
+        return result if asarray else [ (port, spectrum.points()) for port, spectrum in result ]
 
     def get_itu_scan (self, hires):
         assert self.devtype == DEVTYPE_TFOCM
         hival = 2 if hires else 1
         data = self.run_cmd("FULL-ITU-SCAN", struct.pack(">H", hival))
-        if hires:
-            size = 512
-            # XXX this is probably msw lsw of channel wavelen
-            words = unpack_unsigned(data[:size])
-            it = iter(words)
-            uints = [ (((msw & 0xFFFF) << 16) + (lsw & 0xFFFF)) for msw, lsw in zip(it, it) ]
-            frequency = [ wavelen_to_frequency(float(x) / 1000.0) if x > 0 else 0 for x in uints ]
-            # frequency = [ float(x) / 1000.0 if x > 0 else 0 for x in uints ]
-        else:
-            size = 256
-            # frequency = [ wavelen_to_frequency(((x / 100.0) + 1500) if x > 0 else 0 for x in unpack_unsigned(data[:size]) ]
-            frequency = [ wavelen_to_frequency((float(x) / 100.0) + 1500.0) for x in unpack_unsigned(data[:size]) ]
-            # frequency = [ (float(x) / 100.0) + 1500.0 for x in unpack_unsigned(data[:size]) ]
-            # frequency = unpack_unsigned(data[:size])
-
-        data = data[size:]
-        presence = unpack_unsigned(data[:256])
-        data = data[256:]
-        if hires:
-            power = [ Power(x / 100) for x in unpack_signed(data[:256]) ]
-        else:
-            power = [ Power(x / 10) for x in unpack_signed(data[:256]) ]
-        return zip(frequency, presence, power)
+        return self._record_itu_scan(hires, decode_itu_scan(data, hires))
 
     def get_itu_power_scan (self, hires):
         assert self.devtype == DEVTYPE_TFOCM
         hival = 2 if hires else 1
         data = self.run_cmd("FULL-ITU-POWER-SCAN", struct.pack(">H", hival))
-        if hires:
-            power = [ Power(x / 100) for x in unpack_signed(data[:256]) ]
-        else:
-            power = [ Power(x / 10) for x in unpack_signed(data[:256]) ]
-
-        # XXX Are the start and stop frequency or the interval affected by the user settings?
-        # or always constant b/c it's the ITU variant of the commands
-        return zip(range(TFOCM_DEFAULT_START_FREQ, TFOCM_DEFAULT_STOP_FREQ + 1, 50),
-                   power)
+        return self._record_itu_scan(hires, decode_itu_power_scan(data, hires))
 
-    def get_full_scan (self, instance=0b1111):
+    def get_full_scan (self, instance=0b1111, asarray=False):
+        "Full scan of the instance ports, returns (port, Spectrum) if asarray otherwise (port, points)"
         assert self.devtype == DEVTYPE_4PORT
-        data = self.run_cmd("FULL-SPECTRUM-SCAN", instance=instance)
-
-        nports = struct.unpack(">H", data[0:2])[0]
-        data = data[2:]
-        if self.debug:
-            logger.debug("FSCAN: Port Count: %d", nports)
-
-        result = []
-        for port in instance_to_ports(instance):
-            npoints = struct.unpack(">H", data[:2])[0]
-            data = data[2:]
-
-            spoints, upoints = unpack_signed_unsigned(data[:4 * npoints])
-            data = data[4 * npoints:]
-
-            if self.debug:
-                logger.debug("FSCAN PORT %s points %d", port, npoints)
-
-            rpoints = []
-            for freq, power in zip(upoints[::2], spoints[1::2]):
-                power = Power(power / 100) + Gain(20)       # Tap is 1% so add 20dB
-                freq = 1900000 + freq
-                rpoints.append((freq, power))
-
-            lrpoints = len(rpoints)
-            if npoints != lrpoints:
-                raise ValueError("Returned points {} different from expected {}".format(lrpoints, npoints))
+        spectra = asarray or self._is_recording()
+        result = decode_full_scan(self.run_cmd("FULL-SPECTRUM-SCAN", instance=instance), instance, spectra,
+                                  self.debug)
+        return self._record_scan("full", result, asarray)
 
-            result.append((port, rpoints))
-
-        # Want better error here.
-        if data:
-            raise ValueError("Extra data form OCM of len: {}".format(len(data)))
-
-        return result
+    def get_full_125_scan (self, instance=0b1111, asarray=False):
+        "12.5GHz scan of the instance ports, returns (port, Spectrum) if asarray otherwise (port, points)"
+        assert self.devtype == DEVTYPE_4PORT
+        spectra = asarray or self._is_recording()
+        result = decode_full_125_scan(self.run_cmd("FULL-12-SCAN", instance=instance), instance, spectra,
+                                      self.debug)
+        return self._record_scan("full-125", result, asarray)
 
-    def get_full_125_scan (self, instance=0b1111):
+    def iter_full_scan (self, instance=0b1111, asarray=False):
+        "Full scan yielding each port's result as soon as it has been read, see get_full_scan"
         assert self.devtype == DEVTYPE_4PORT
-        data = self.run_cmd("FULL-12-SCAN", instance=instance)
+        return self._iter_scan("full", "FULL-SPECTRUM-SCAN", iter_full_scan_ports, instance, asarray)
 
-        nports = struct.unpack(">H", data[0:2])[0]
-        data = data[2:]
-        if self.debug:
-            logger.debug("FSCAN125x625: Port Count: %s", str(nports))
+    def iter_full_125_scan (self, instance=0b1111, asarray=False):
+        "12.5GHz scan yielding each port's result as soon as it has been read, see get_full_125_scan"
+        assert self.devtype == DEVTYPE_4PORT
+        return self._iter_scan("full-125", "FULL-12-SCAN", iter_full_125_scan_ports, instance, asarray)
 
+    def _iter_scan (self, kind, cmdname, iter_ports, instance, asarray):
+        stream = self.run_cmd_stream(cmdname, instance=instance)
+        history = self.history
+        recording = self._is_recording()
+        timestamp = time.time()
         result = []
-        for port in instance_to_ports(instance):
-            npoints = struct.unpack(">H", data[:2])[0]
-            data = data[2:]
-            if npoints != 839:
-                raise ValueError("Too man points %d (not 839) in 12.5x6.25 scan", npoints)
-
-            spoints = struct.unpack(">" + str(npoints) + "h", data[:2 * npoints])
-            data = data[2 * npoints:]
-
-            if self.debug:
-                logger.debug("FSCAN125x625 PORT %d points %d", port, npoints)
-
-            rpoints = []
-            # Start of scan range
-            freq = 191000
-            for power in spoints:
-                rpoints.append((freq, Power(power / 100) + Gain(20)))
-                freq += 6.25
-
-            lrpoints = len(rpoints)
-            if npoints != lrpoints:
-                raise ValueError("Returned points {} different from expected {}".format(lrpoints, npoints))
-
-            result.append((port, rpoints))
-
-        if data:
-            raise ValueError("Extra data form OCM of len: {}".format(len(data)))
-
-        return result
+        for port, spectrum in iter_ports(stream, instance, asarray or recording, self.debug):
+            if recording:
+                if history is not None:
+                    history.record_port(kind, timestamp, port, spectrum)
+                result.append((port, spectrum))
+                if not asarray:
+                    spectrum = spectrum.points()
+            yield port, spectrum
+        if self.scan_listeners:
+            self._notify_scan(kind, timestamp, result)
 
     def dump_channel_scan (self):
         assert self.devtype == DEVTYPE_4PORT
         data = struct.pack(">HHHH", 2, 2, 2, 2)
-        data = self.run_cmd("FULL-12-CH-SCAN", data=data, instance=0b1111)
+        stream = self.run_cmd_stream("FULL-12-CH-SCAN", data=data, instance=0b1111)
 
-        nports = struct.unpack(">H", data[0:2])[0]
-        data = data[2:]
+        data = stream.fill(2)
+        nports = struct.unpack_from(">H", data)[0]
+        offset = 2
         print("FSCAN: Port Count: {}".format(nports))
 
         port = 1
-        while data:
-            nchan = struct.unpack(">H", data[:2])[0]
-            data = data[2:]
+        while offset < stream.data_len:
+            data = stream.fill(offset + 2)
+            nchan = struct.unpack_from(">H", data, offset)[0]
+            offset += 2
             print("FSCAN PORT {} Channel count {}".format(port, nchan))
 
-            chandata = data[:nchan * 3 * 2]
-            data = data[nchan * 3 * 2:]
-            spoints = struct.unpack(">" + str(nchan * 3) + "h", chandata)
-            upoints = struct.unpack(">" + str(nchan * 3) + "H", chandata)
+            data = stream.fill(offset + nchan * 3 * 2 + 2)
+            words = get_struct("HhH", nchan).unpack_from(data, offset)
+            offset += nchan * 3 * 2
             with open("fpcs-{}.csv".format(port), "w") as f:
-                for freq, power, present in zip(upoints[::3], spoints[1::3], upoints[2::3]):
+                for freq, power, present in zip(words[::3], words[1::3], words[2::3]):
                     power = Power(power / 100) + Gain(20)
                     freq = (1900000 + freq) / 10
                     if True or power > Power(-25):
@@ -698,12 +1424,12 @@ class OCM (object):
                                                                                   power,
                                                                                   present))
                     f.write("{}\t{}\n".format(freq, power))
-            npoints = struct.unpack(">H", data[:2])[0]
-            data = data[2:]
+            npoints = struct.unpack_from(">H", data, offset)[0]
+            offset += 2
 
-            pdata = data[:npoints * 2]
-            data = data[2 * npoints:]
-            spoints = struct.unpack(">" + str(npoints) + "h", pdata)
+            data = stream.fill(offset + 2 * npoints)
+            spoints = get_struct("h", npoints).unpack_from(data, offset)
+            offset += 2 * npoints
 
             # print("FSCAN PORT {} points {}".format(port, npoints))
             # for idx, power in enumerate(spoints):
@@ -713,26 +1439,29 @@ class OCM (object):
             #                                                              idx,
             #                                                              power))
             port += 1
+        stream.finish()
 
     def dump_spectral_density (self):
         assert self.devtype == DEVTYPE_4PORT
         data = struct.pack(">HHHH", 2, 2, 2, 2)
-        data = self.run_cmd("SCAN-SPEC-DENSITY", data=data, instance=0b1111)
+        stream = self.run_cmd_stream("SCAN-SPEC-DENSITY", data=data, instance=0b1111)
 
-        nports = struct.unpack(">H", data[0:2])[0]
-        data = data[2:]
+        data = stream.fill(2)
+        nports = struct.unpack_from(">H", data)[0]
+        offset = 2
         print("FSCAN: Port Count: {}".format(nports))
 
         port = 1
-        while data:
-            npoints = struct.unpack(">H", data[:2])[0]
-            data = data[2:]
-            spoints = struct.unpack(">" + str(npoints * 3) + "h", data[:6 * npoints])
-            upoints = struct.unpack(">" + str(npoints * 3) + "H", data[:6 * npoints])
-            data = data[6 * npoints:]
+        while offset < stream.data_len:
+            data = stream.fill(offset + 2)
+            npoints = struct.unpack_from(">H", data, offset)[0]
+            offset += 2
+            data = stream.fill(offset + 6 * npoints)
+            words = get_struct("Hhh", npoints).unpack_from(data, offset)
+            offset += 6 * npoints
             print("SPDENSE PORT {} points {}".format(port, npoints))
             with open("sd-{}.csv".format(port), "w") as f:
-                for freq, avgpower, maxpower in zip(upoints[::3], spoints[1::3], spoints[2::3]):
+                for freq, avgpower, maxpower in zip(words[::3], words[1::3], words[2::3]):
                     avgpower = Power(avgpower / 100) + Gain(20)
                     maxpower = Power(maxpower / 100) + Gain(20)
                     freq = (1900000 + freq) / 10
@@ -744,6 +1473,7 @@ class OCM (object):
                                                                  maxpower))
                     f.write("{}\t{}\t{}\n".format(freq, avgpower, maxpower))
             port += 1
+        stream.finish()
 
     def read_channel_profile (self):
         assert self.devtype == DEVTYPE_4PORT
@@ -761,21 +1491,154 @@ class OCM (object):
             nchan += 1
 
         data = struct.pack(">H", nchan)
-        data += struct.pack(">" + str(nchan * 2) + "H", *freqlist)
+        data += get_struct("H", nchan * 2).pack(*freqlist)
         self.run_cmd("SET-PROFILE", data=data, instance=2)
 
 
+class DeadlineTransport (object):
+    """Deadline handling shared by the transports.
+
+    If the deadline given with set_deadline() passes before a response starts, or
+    once it has started no byte arrives within inter_byte_timeout seconds, the
+    read raises OCMError(ETIMEOUT).
+    """
+
+    def __init__ (self, inter_byte_timeout=DEFAULT_INTER_BYTE_TIMEOUT):
+        self.inter_byte_timeout = inter_byte_timeout
+        self.deadline = None
+        self.receiving = False
+
+    def set_deadline (self, deadline):
+        "Set the time.time() by which the next response must start, None for no deadline"
+        self.deadline = deadline
+        self.receiving = False
+
+    def _get_wait_time (self):
+        timeout = None
+        if self.deadline is not None and not self.receiving:
+            timeout = self.deadline - time.time()
+        elif self.receiving and self.inter_byte_timeout:
+            timeout = self.inter_byte_timeout
+        return timeout
+
+
+class SerialTransport (DeadlineTransport):
+    """The send/recv transport interface on a serial port.
+
+    Reads wait on the port's fd with select rather than polling it, see
+    DeadlineTransport for the timeouts.
+    """
+
+    def __init__ (self, serdev, inter_byte_timeout=DEFAULT_INTER_BYTE_TIMEOUT):
+        super(SerialTransport, self).__init__(inter_byte_timeout)
+        self.serial = serdev
+        self.fd = serdev.fileno()
+
+    def send (self, data):
+        return self.serial.write(data)
+
+    def recv_ready (self):
+        return self.serial.in_waiting > 0
+
+    def recv (self, nbytes=4096):
+        view = memoryview(bytearray(nbytes))
+        return view[:self.recv_into(view, nbytes)].tobytes()
+
+    def recv_into (self, view, nbytes=0):
+        "Wait for data and copy up to nbytes of it into view"
+        if not nbytes:
+            nbytes = len(view)
+        readable = False
+        while True:
+            # With no data a tty in raw mode returns nothing rather than EAGAIN.
+            try:
+                data = os.read(self.fd, nbytes)
+            except OSError as error:
+                if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    raise
+                data = b""
+            if data:
+                view[:len(data)] = data
+                self.receiving = True
+                return len(data)
+            if readable:
+                raise EOFError("Serial device readable but returned no data")
+
+            timeout = self._get_wait_time()
+            if timeout is not None and timeout <= 0:
+                raise OCMError(jerror.ETIMEOUT)
+            try:
+                readable = bool(select.select([ self.fd ], [], [], timeout)[0])
+            except (select.error, OSError) as error:
+                if error.args[0] != errno.EINTR:
+                    raise
+
+    def close (self):
+        self.serial.close()
+
+
+class SSHTransport (DeadlineTransport):
+    """The send/recv transport interface on the SSH session to a remote sercat.
+
+    Reads wait using the channel's timeout, see DeadlineTransport for the
+    timeouts.
+    """
+
+    def __init__ (self, session, inter_byte_timeout=DEFAULT_INTER_BYTE_TIMEOUT):
+        super(SSHTransport, self).__init__(inter_byte_timeout)
+        self.session = session
+
+    def send (self, data):
+        return self.session.send(data)
+
+    def recv_ready (self):
+        return self.session.recv_ready()
+
+    def recv (self, nbytes=4096):
+        view = memoryview(bytearray(nbytes))
+        return view[:self.recv_into(view, nbytes)].tobytes()
+
+    def recv_into (self, view, nbytes=0):
+        "Wait for data and copy up to nbytes of it into view"
+        if not nbytes:
+            nbytes = len(view)
+        # Data that has already arrived is read even if the deadline has passed.
+        timeout = None if self.session.recv_ready() else self._get_wait_time()
+        if timeout is not None and timeout <= 0:
+            raise OCMError(jerror.ETIMEOUT)
+        self.session.chan.settimeout(timeout)
+        try:
+            data = self.session.recv(nbytes)
+        except socket.timeout:
+            raise OCMError(jerror.ETIMEOUT)
+        if not data:
+            raise EOFError("sercat session closed")
+        view[:len(data)] = data
+        self.receiving = True
+        return len(data)
+
+    def close (self):
+        self.session.close()
+
+
+def open_serial (devname):
+    "Open the OCM serial port"
+    import serial
+    return serial.Serial(port=devname,
+                         timeout=0,
+                         baudrate=115200,
+                         parity=serial.PARITY_NONE,
+                         stopbits=serial.STOPBITS_ONE,
+                         xonxoff=False,
+                         rtscts=False,
+                         bytesize=serial.EIGHTBITS)
+
+
 class LocalOCM (OCM):
-    def __init__ (self, devname, debug=False):
-        import serial
-        self.serial = serial.Serial(port=devname,
-                                    timeout=0,
-                                    baudrate=115200,
-                                    parity=serial.PARITY_NONE,
-                                    stopbits=serial.STOPBITS_ONE,
-                                    xonxoff=False,
-                                    rtscts=False,
-                                    bytesize=serial.EIGHTBITS)
+    def __init__ (self, devname, debug=False, cache_ttl=DEFAULT_CACHE_TTL, pipeline_window=DEFAULT_PIPELINE_WINDOW,
+                  inter_byte_timeout=DEFAULT_INTER_BYTE_TIMEOUT, read_retries=DEFAULT_READ_RETRIES):
+        self.serial = open_serial(devname)
+        self.transport = SerialTransport(self.serial, inter_byte_timeout)
         # if debug:
         #     sys.stderr.write("sercat: Opening serial\n")
         # #syslog.syslog("sercat: Opening serial\n")
@@ -784,11 +1647,14 @@ class LocalOCM (OCM):
         # if debug:
         #     sys.stderr.write("sercat: Opened serial\n")
         # #syslog.syslog("sercat: Opened serial\n")
-        super(LocalOCM, self).__init__(self.serial, debug=debug)
+        super(LocalOCM, self).__init__(self.transport, debug=debug, cache_ttl=cache_ttl,
+                                       pipeline_window=pipeline_window, read_retries=read_retries)
 
 
 class RemoteOCM (OCM):
-    def __init__ (self, jdsu_host, devname, username=None, password=None, debug=False):
+    def __init__ (self, jdsu_host, devname, username=None, password=None, debug=False,
+                  cache_ttl=DEFAULT_CACHE_TTL, pipeline_window=DEFAULT_PIPELINE_WINDOW,
+                  inter_byte_timeout=DEFAULT_INTER_BYTE_TIMEOUT, read_retries=DEFAULT_READ_RETRIES):
         self.host = jdsu_host
 
         # Copy latest sercat
@@ -803,24 +1669,29 @@ class RemoteOCM (OCM):
                                          "/usr/bin/python -u sercat.py " + devname,
                                          username=username,
                                          password=password)
+        self.transport = SSHTransport(self.session, inter_byte_timeout)
         self.log_sercat_stderr()                            # Start the stderr logger.
 
-        super(RemoteOCM, self).__init__(self.session, debug=debug)
+        super(RemoteOCM, self).__init__(self.transport, debug=debug, cache_ttl=cache_ttl,
+                                        pipeline_window=pipeline_window, read_retries=read_retries)
 
     def log_sercat_stderr (self):
         import threading
 
         def threadmain ():
-            data = ""
+            data = b""
             while True:
-                data += self.session.recv_stderr()
+                # The channel timeout set for reading responses applies to stderr too.
                 try:
-                    while True:
-                        idx = data.index("\n")
-                        logger.warn("SERCAT (%s) STDERR: %s", self.host, data[:idx])
-                        data = data[idx + 1:]
-                except ValueError:
+                    chunk = self.session.recv_stderr()
+                except socket.timeout:
+                    continue
+                if not chunk:
                     break
+                data += chunk
+                while b"\n" in data:
+                    line, data = data.split(b"\n", 1)
+                    logger.warning("SERCAT (%s) STDERR: %s", self.host, line.decode("utf-8", "replace"))
 
         logger_thread = threading.Thread(target=threadmain)
         logger_thread.daemon = True
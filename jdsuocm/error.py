@@ -36,6 +36,10 @@ EFRAMECKSUM = 9
 EPROTOCOL = 10
 ESUCCESSHARDFAIL = 11
 EFAILHARDFAIL = 12
+
+# Local result codes, never returned by the device.
+ETIMEOUT = 0x100                                            # No response before the deadline
+EBADRESP = 0x101                                            # No valid response frame found
 error_string = {
     ENOERR: "ENOERR",
     EBADCMD: "EBADCMD",
@@ -50,6 +54,8 @@ error_string = {
     EPROTOCOL: "EPROTOCOL",
     ESUCCESSHARDFAIL: "ESUCCESSHARDFAIL",
     EFAILHARDFAIL: "EFAILHARDFAIL",
+    ETIMEOUT: "ETIMEOUT",
+    EBADRESP: "EBADRESP",
 }
 
 #--------------------
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import io
+import os
+
+try:
+    import numpy as np
+    from numpy.lib import format as npformat
+except ImportError:
+    np = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = None
+
+CSV_BUFFER_SIZE = 1 << 20
+
+if np is not None:
+    SCAN_DTYPE = np.dtype([ (str("timestamp"), "<M8[ms]"),
+                            (str("port"), "u1"),
+                            (str("frequency"), "<f8"),
+                            (str("power"), "<f8") ])
+
+
+def _tolist (values):
+    try:
+        return values.tolist()
+    except AttributeError:
+        return values
+
+
+def _text_column (values, fmt):
+    "Return the values as a list of text, values read from XML are already text"
+    values = _tolist(values)
+    if not values or not isinstance(values[0], (int, float)):
+        return values
+    return [ fmt % x for x in values ]
+
+
+def scan_columns (timestamp, port, frequency, power):
+    """Return the (timestamp, port, frequency, power) numpy columns of a port's scan,
+    the frequency and power may be text. An ITU scan (port None) is port 0."""
+    npoints = len(power)
+    if timestamp:
+        timestamp = np.datetime64(timestamp.rstrip("Z"), "ms")
+    else:
+        timestamp = np.datetime64("NaT", "ms")
+    return (np.full(npoints, timestamp, dtype=SCAN_DTYPE["timestamp"]),
+            np.full(npoints, port or 0, dtype=SCAN_DTYPE["port"]),
+            np.asarray(frequency, dtype=SCAN_DTYPE["frequency"]),
+            np.asarray(power, dtype=SCAN_DTYPE["power"]))
+
+
+class CSVScanWriter (object):
+    """Write scans as tab separated port, frequency and power rows, one file per port
+    named prefix-port.csv (prefix.csv without the port column for an ITU scan).
+
+    If `append` the rows are appended to the files and each starts with the
+    scan's timestamp so consecutive scans can be told apart.
+    """
+
+    def __init__ (self, prefix, append=False):
+        self.prefix = prefix
+        self.append = append
+        self.files = {}
+
+    def _get_file (self, port):
+        try:
+            return self.files[port]
+        except KeyError:
+            suffix = "-{}.csv".format(port) if port is not None else ".csv"
+            output = io.open(self.prefix + suffix, "a" if self.append else "w", buffering=CSV_BUFFER_SIZE)
+            self.files[port] = output
+            return output
+
+    def write_port (self, timestamp, port, frequency, power):
+        lead = "{}\t".format(timestamp) if self.append else ""
+        if port is not None:
+            lead += "{}\t".format(port)
+        frequency = _text_column(frequency, "%s")
+        power = _text_column(power, "%.2f")
+        self._get_file(port).write("".join([ lead + x + "\t" + y + "\n" for x, y in zip(frequency, power) ]))
+
+    def end_scan (self):
+        for output in self.files.values():
+            output.flush()
+
+    def close (self):
+        for output in self.files.values():
+            output.close()
+        self.files = {}
+
+
+class NpyScanWriter (object):
+    """Write scans to a prefix.npy file of SCAN_DTYPE rows, all ports in the one file.
+
+    Rows are written as they arrive and the row count in the header is updated on
+    close. If `append` the rows are added to the end of an existing file.
+    """
+
+    def __init__ (self, prefix, append=False):
+        if np is None:
+            raise ImportError("npy export requires numpy")
+        self.path = prefix + ".npy"
+        self.nrows = 0
+        self.version = (1, 0)
+        if append and os.path.exists(self.path):
+            self.output = io.open(self.path, "r+b")
+            self.version = npformat.read_magic(self.output)
+            if self.version == (1, 0):
+                shape, fortran_order, dtype = npformat.read_array_header_1_0(self.output)
+            else:
+                shape, fortran_order, dtype = npformat.read_array_header_2_0(self.output)
+            if dtype != SCAN_DTYPE or fortran_order or len(shape) != 1:
+                self.output.close()
+                raise ValueError("{} is not a scan export".format(self.path))
+            self.nrows = shape[0]
+            self.data_offset = self.output.tell()
+            self.output.seek(0, os.SEEK_END)
+        else:
+            self.output = io.open(self.path, "w+b")
+            self.output.write(self._get_header())
+            self.data_offset = self.output.tell()
+
+    def _get_header (self):
+        header = io.BytesIO()
+        hdict = { "descr": npformat.dtype_to_descr(SCAN_DTYPE), "fortran_order": False, "shape": (self.nrows,) }
+        if self.version == (1, 0):
+            npformat.write_array_header_1_0(header, hdict)
+        else:
+            npformat.write_array_header_2_0(header, hdict)
+        return header.getvalue()
+
+    def write_port (self, timestamp, port, frequency, power):
+        rows = np.empty(len(power), dtype=SCAN_DTYPE)
+        for name, column in zip(SCAN_DTYPE.names, scan_columns(timestamp, port, frequency, power)):
+            rows[name] = column
+        self.output.write(rows.tobytes())
+        self.nrows += len(rows)
+
+    def end_scan (self):
+        self.output.flush()
+
+    def close (self):
+        if self.output is None:
+            return
+        header = self._get_header()
+        if len(header) == self.data_offset:
+            self.output.seek(0)
+            self.output.write(header)
+        else:
+            # Header written without room to grow, rewrite the file.
+            self.output.seek(self.data_offset)
+            data = self.output.read()
+            self.output.seek(0)
+            self.output.write(header)
+            self.output.write(data)
+            self.output.truncate()
+        self.output.close()
+        self.output = None
+
+
+class ParquetScanWriter (object):
+    """Write scans to a prefix.parquet file with a row group per scan, all ports in the
+    one file.
+
+    Parquet files can't be added to, if `append` the rows of an existing file are
+    copied into the new one, which replaces it on close.
+    """
+
+    def __init__ (self, prefix, append=False):
+        if np is None or pyarrow is None:
+            raise ImportError("parquet export requires numpy and pyarrow")
+        self.path = prefix + ".parquet"
+        self.schema = pyarrow.schema([ ("timestamp", pyarrow.timestamp("ms")),
+                                       ("port", pyarrow.uint8()),
+                                       ("frequency", pyarrow.float64()),
+                                       ("power", pyarrow.float64()) ])
+        self.writer = pq.ParquetWriter(self.path + ".tmp", self.schema)
+        if append and os.path.exists(self.path):
+            self.writer.write_table(pq.read_table(self.path).cast(self.schema))
+        self.columns = []
+
+    def write_port (self, timestamp, port, frequency, power):
+        self.columns.append(scan_columns(timestamp, port, frequency, power))
+
+    def end_scan (self):
+        if not self.columns:
+            return
+        arrays = [ pyarrow.array(np.concatenate(column)) for column in zip(*self.columns) ]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.columns = []
+
+    def close (self):
+        if self.writer is None:
+            return
+        self.end_scan()
+        self.writer.close()
+        self.writer = None
+        os.rename(self.path + ".tmp", self.path)
+
+
+SCAN_WRITERS = {
+    "csv": CSVScanWriter,
+    "npy": NpyScanWriter,
+    "parquet": ParquetScanWriter,
+}
+
+
+def check_format (fmt):
+    "Raise ImportError if the modules needed to export in format `fmt` are missing"
+    if fmt != "csv" and np is None:
+        raise ImportError("{} export requires numpy".format(fmt))
+    if fmt == "parquet" and pyarrow is None:
+        raise ImportError("parquet export requires pyarrow")
+
+
+def open_scan_writer (fmt, prefix, append=False):
+    """Return a writer for scans in export format `fmt` to files starting with prefix.
+
+    The writer's write_port(timestamp, port, frequency, power) is called for each
+    port of a scan followed by end_scan(), and close() when done.
+    """
+    return SCAN_WRITERS[fmt](prefix, append)
+
+
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import logging
+import os
+import threading
+import time
+from jdsuocm.spectrum import POWER_SCALE, TAP_GAIN
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# The tap gain taken out of the stored powers of each kind of scan, so full scan
+# powers are stored as the OCM reports them.
+HISTORY_TAP_GAIN = {
+    "full": TAP_GAIN,
+    "full-125": TAP_GAIN,
+    "itu": 0,
+    "itu-high-resolution": 0,
+}
+
+DEFAULT_FLUSH_INTERVAL = 60.0                           # Seconds between writing memory mapped histories to disk
+
+HISTORY_MAGIC = b"JDSUHST1"
+HISTORY_HEADER_SIZE = 64
+
+if np is not None:
+    HISTORY_HEADER_DTYPE = np.dtype([ (str("magic"), "S8"),
+                                      (str("npoints"), "<u4"),
+                                      (str("capacity"), "<u4"),
+                                      (str("head"), "<u4"),
+                                      (str("count"), "<u4"),
+                                      (str("tap_gain"), "<f8") ])
+
+
+class PortHistory (object):
+    """A ring buffer of the most recent scans of a port.
+
+    Each scan is a timestamp and a row of int16 powers in 0.01dBm less the tap
+    gain, the frequencies are shared by all rows. The buffer is a single block of
+    memory (or a memory mapped file) laid out as a header, the frequencies, the
+    timestamps and the power rows. Use create() or open() to get one.
+    """
+
+    def __init__ (self, buf):
+        self.buf = buf
+        self.header = buf[:HISTORY_HEADER_DTYPE.itemsize].view(HISTORY_HEADER_DTYPE)
+        npoints = int(self.header["npoints"][0])
+        capacity = int(self.header["capacity"][0])
+        offset = HISTORY_HEADER_SIZE
+        self.frequency = buf[offset:offset + 8 * npoints].view("<f8")
+        offset += 8 * npoints
+        self.timestamps = buf[offset:offset + 8 * capacity].view("<f8")
+        offset += 8 * capacity
+        self.power = buf[offset:offset + 2 * capacity * npoints].view("<i2").reshape(capacity, npoints)
+        self.tap_gain = float(self.header["tap_gain"][0])
+        self.capacity = capacity
+        self.head = int(self.header["head"][0])
+        self.count = int(self.header["count"][0])
+
+    @staticmethod
+    def get_size (npoints, capacity):
+        return HISTORY_HEADER_SIZE + 8 * npoints + (8 + 2 * npoints) * capacity
+
+    @classmethod
+    def create (cls, frequency, tap_gain, capacity, path=None):
+        "Create an empty history of capacity scans of the frequencies, in the file path if given"
+        npoints = len(frequency)
+        size = cls.get_size(npoints, capacity)
+        if path is None:
+            buf = np.zeros(size, dtype=np.uint8)
+        else:
+            buf = np.memmap(path, dtype=np.uint8, mode="w+", shape=(size,))
+        header = buf[:HISTORY_HEADER_DTYPE.itemsize].view(HISTORY_HEADER_DTYPE)
+        header["magic"] = HISTORY_MAGIC
+        header["npoints"] = npoints
+        header["capacity"] = capacity
+        header["tap_gain"] = tap_gain
+        history = cls(buf)
+        history.frequency[:] = frequency
+        return history
+
+    @classmethod
+    def open (cls, path):
+        "Open the history kept in the file path, raises ValueError if it isn't valid"
+        buf = np.memmap(path, dtype=np.uint8, mode="r+")
+        if len(buf) < HISTORY_HEADER_SIZE:
+            raise ValueError("{} is not a scan history".format(path))
+        header = buf[:HISTORY_HEADER_DTYPE.itemsize].view(HISTORY_HEADER_DTYPE)
+        if header["magic"][0] != HISTORY_MAGIC:
+            raise ValueError("{} is not a scan history".format(path))
+        npoints, capacity = int(header["npoints"][0]), int(header["capacity"][0])
+        if len(buf) != cls.get_size(npoints, capacity) or header["head"][0] >= capacity:
+            raise ValueError("{} is not a valid scan history".format(path))
+        return cls(buf)
+
+    def matches (self, frequency, capacity):
+        "True if this history is of the frequencies with room for capacity scans"
+        return self.capacity == capacity and np.array_equal(self.frequency, np.asarray(frequency, dtype="<f8"))
+
+    def append (self, timestamp, dbm):
+        "Add the powers (in dBm with the tap gain) of a scan at timestamp, replacing the oldest if full"
+        words = np.round((np.asarray(dbm, dtype=np.float64) - self.tap_gain) * POWER_SCALE)
+        self.power[self.head] = np.clip(words, -32768, 32767)
+        self.timestamps[self.head] = timestamp
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.header["head"] = self.head
+        self.header["count"] = self.count
+
+    def _get_order (self):
+        "Return the row indices oldest first"
+        if self.count < self.capacity:
+            return np.arange(self.count)
+        return (np.arange(self.capacity) + self.head) % self.capacity
+
+    def get_window (self, start=None, end=None):
+        """Return the (timestamps, powers) of the scans from start to end (time.time()
+        values, None for no limit) in time order, the powers are a row of int16 words
+        per scan as the OCM reports them."""
+        order = self._get_order()
+        timestamps = self.timestamps[order]
+        if len(timestamps) > 1 and (np.diff(timestamps) < 0).any():
+            # The wall clock stepped back, the ring isn't in time order.
+            order = order[np.argsort(timestamps, kind="mergesort")]
+            timestamps = self.timestamps[order]
+        first = np.searchsorted(timestamps, start, "left") if start is not None else 0
+        last = np.searchsorted(timestamps, end, "right") if end is not None else len(timestamps)
+        return timestamps[first:last], self.power[order[first:last]]
+
+    def aggregate (self, interval, start=None, end=None):
+        """Return the (times, counts, minimums, means, maximums) of the scans from start to
+        end in each interval seconds, intervals are aligned to the epoch and empty ones
+        skipped. The minimums, means and maximums are a row of int16 words per interval."""
+        timestamps, power = self.get_window(start, end)
+        if not len(timestamps):
+            empty = np.empty((0, power.shape[1]), dtype=power.dtype)
+            return timestamps, np.empty(0, dtype=np.int64), empty, empty, empty
+        buckets = np.floor(timestamps / interval)
+        starts = np.concatenate(([ 0 ], np.flatnonzero(np.diff(buckets)) + 1))
+        counts = np.diff(np.append(starts, len(timestamps)))
+        minimums = np.minimum.reduceat(power, starts, axis=0)
+        maximums = np.maximum.reduceat(power, starts, axis=0)
+        sums = np.add.reduceat(power, starts, axis=0, dtype=np.int64)
+        means = np.round(sums / counts[:, np.newaxis]).astype(power.dtype)
+        return buckets[starts] * interval, counts, minimums, means, maximums
+
+    def flush (self):
+        if isinstance(self.buf, np.memmap):
+            self.buf.flush()
+
+
+class ScanHistory (object):
+    """The recent scans of a device kept in a fixed amount of memory.
+
+    size_mb megabytes are split evenly between a PortHistory for each of the kinds of
+    scan (keys of HISTORY_TAP_GAIN) and ports, each holds as many scans as fit. If
+    directory is given the histories are memory mapped files in it, named for the
+    device name, kind and port, so they survive a restart. A port's history starts
+    over if the frequencies it is scanned at change. The files are written to disk
+    at most every flush_interval seconds as scans are recorded and by flush().
+    """
+
+    def __init__ (self, size_mb, kinds, nports, directory=None, name="default",
+                  flush_interval=DEFAULT_FLUSH_INTERVAL):
+        if np is None:
+            raise ImportError("scan history requires numpy")
+        self.kinds = kinds
+        self.ring_size = int(size_mb * 1024 * 1024) // (len(kinds) * nports)
+        self.directory = directory
+        self.name = name
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.histories = {}
+
+        if directory is not None:
+            for kind in kinds:
+                for port in range(0, nports):
+                    path = self._get_path(kind, port)
+                    if not os.path.exists(path):
+                        continue
+                    try:
+                        self.histories[(kind, port)] = PortHistory.open(path)
+                    except ValueError as ex:
+                        logger.warning("Ignoring scan history: %s", str(ex))
+
+    def _get_path (self, kind, port):
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, "{}-{}-{}.hist".format(self.name.replace("/", "_"), kind, port))
+
+    def _get_capacity (self, npoints):
+        return max(1, (self.ring_size - PortHistory.get_size(npoints, 0)) // (8 + 2 * npoints))
+
+    def record (self, kind, timestamp, result):
+        "Record the (port, Spectrum) list of a scan of kind taken at timestamp"
+        for port, spectrum in result:
+            self.record_port(kind, timestamp, port, spectrum)
+
+    def record_port (self, kind, timestamp, port, spectrum):
+        "Record the Spectrum of a port from a scan of kind taken at timestamp"
+        with self.lock:
+            capacity = self._get_capacity(len(spectrum))
+            history = self.histories.get((kind, port))
+            if history is None or not history.matches(spectrum.frequency, capacity):
+                if history is not None:
+                    logger.info("%s: restarting %s scan history of port %d, frequencies or size changed",
+                                self.name, kind, port)
+                history = PortHistory.create(spectrum.frequency, HISTORY_TAP_GAIN[kind], capacity,
+                                             self._get_path(kind, port))
+                self.histories[(kind, port)] = history
+            history.append(timestamp, spectrum.dbm)
+            now = time.time()
+            if self.directory is not None and abs(now - self.last_flush) >= self.flush_interval:
+                self._flush()
+                self.last_flush = now
+
+    def get_window (self, kind, port, start=None, end=None):
+        """Return (frequency, tap gain, timestamps, powers) of the port's scans, see
+        PortHistory.get_window, or None if there are none."""
+        with self.lock:
+            history = self.histories.get((kind, port))
+            if history is None:
+                return None
+            return (history.frequency.copy(), history.tap_gain) + history.get_window(start, end)
+
+    def aggregate (self, kind, port, interval, start=None, end=None):
+        """Return (frequency, tap gain, times, counts, minimums, means, maximums) of the
+        port's scans, see PortHistory.aggregate, or None if there are none."""
+        with self.lock:
+            history = self.histories.get((kind, port))
+            if history is None:
+                return None
+            return (history.frequency.copy(), history.tap_gain) + history.aggregate(interval, start, end)
+
+    def flush (self):
+        "Write the memory mapped histories to disk"
+        with self.lock:
+            self._flush()
+
+    def _flush (self):
+        for history in self.histories.values():
+            history.flush()
+
+
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
@@ -19,14 +19,72 @@
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
 import argparse
+import json
 import logging
 import os
 import sys
+from collections import OrderedDict
 from paramiko import RSAKey
 import jdsuocm.device as device
 import jdsuocm.server as server
 
 
+def open_device (config, args):
+    """Open the device described by config, a dictionary keyed by the --device-* option
+    names without the "device-" prefix plus optional cache-ttl, pipeline-window,
+    read-retries, history-size and history-dir overrides, the serial device name and
+    overrides default to args."""
+    def get (key, default=None):
+        return config.get(key, default)
+
+    cache_ttl = get("cache-ttl", args.cache_ttl)
+    pipeline_window = get("pipeline-window", args.pipeline_window)
+    read_retries = get("read-retries", args.read_retries)
+    history_size = get("history-size", args.history_size)
+
+    if get("simulate"):
+        from jdsuocm.simulator import SimulatedOCM
+        ocm = SimulatedOCM(get("simulate"),
+                           debug=args.debug,
+                           cache_ttl=cache_ttl,
+                           pipeline_window=pipeline_window,
+                           read_retries=read_retries)
+    elif not get("host"):
+        ocm = device.LocalOCM(get("name", args.device_name),
+                              debug=args.debug,
+                              cache_ttl=cache_ttl,
+                              pipeline_window=pipeline_window,
+                              read_retries=read_retries)
+    else:
+        if get("key"):
+            password = RSAKey.from_private_key_file(get("key"))
+        else:
+            password = get("password")
+        ocm = device.RemoteOCM(get("host"),
+                               get("name", args.device_name),
+                               username=get("username"),
+                               password=password,
+                               debug=args.debug,
+                               cache_ttl=cache_ttl,
+                               pipeline_window=pipeline_window,
+                               read_retries=read_retries)
+    if history_size:
+        ocm.enable_history(history_size, get("history-dir", args.history_dir),
+                           get("device", server.DEFAULT_DEVICE_NAME))
+    return ocm
+
+
+def read_device_config (path):
+    """Read a JSON device config file, a list of objects (or {"devices": [...]}) each
+    with a "device" name for RPCs and the device-* option values for the device,
+    e.g., {"device": "ocm-1", "host": "jdsu-host", "name": "/dev/ttyUSB0"}."""
+    with open(os.path.expanduser(path)) as infile:
+        config = json.load(infile)
+    if isinstance(config, dict):
+        config = config["devices"]
+    return config
+
+
 def main (*margs):
     parser = argparse.ArgumentParser("JDSU-OCM Netconf Server")
 
@@ -39,6 +97,25 @@ def main (*margs):
     parser.add_argument("--device-username", help="The username to login with")
     parser.add_argument("--device-password", help="The password to login with")
     parser.add_argument("--device-key", help="SSH Private key to use")
+    parser.add_argument("--device-simulate", choices=[ "cal04", "cal02" ],
+                        help="Use a simulated 4-port (cal04) or TF-OCM (cal02) device")
+    parser.add_argument("--device-config",
+                        help="JSON file listing multiple devices to serve, replaces the other --device options")
+    parser.add_argument("--cache-ttl", type=float, default=device.DEFAULT_CACHE_TTL,
+                        help="Seconds to cache device temperature and fail register (default: %(default)s)")
+    parser.add_argument("--pipeline-window", type=int, default=device.DEFAULT_PIPELINE_WINDOW,
+                        help="Commands sent before waiting for responses in batches, 1 (the default) for lock-step")
+    parser.add_argument("--read-retries", type=int, default=device.DEFAULT_READ_RETRIES,
+                        help="Times a read command is retried after a lost or corrupt response")
+    parser.add_argument("--scan-interval", type=float,
+                        help="Seconds between background scans, RPCs with max-age are answered from these")
+    parser.add_argument("--change-threshold", type=float,
+                        help="Send spectrum-change notifications to subscribers for power changes of this many dB"
+                        " (and ITU channels added or dropped), use with --scan-interval for a steady event stream")
+    parser.add_argument("--history-size", type=float,
+                        help="Megabytes per device to keep a history of scans in for the scan-history RPC")
+    parser.add_argument("--history-dir",
+                        help="Directory to keep the scan history in so it survives restarts, otherwise in memory")
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose logging")
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug logging")
     args = parser.parse_args(*margs)
@@ -51,35 +128,50 @@ def main (*margs):
         logging.basicConfig(level=logging.WARNING)
     logger = logging.getLogger(__name__)
 
+    if args.device_config:
+        configs = read_device_config(args.device_config)
+    else:
+        configs = [ {
+            "name": args.device_name,
+            "host": args.device_host,
+            "username": args.device_username,
+            "password": args.device_password,
+            "key": args.device_key,
+            "simulate": args.device_simulate,
+        } ]
+
     # Mutually exclusive
-    if args.device_password and args.device_key:
-        logger.critical("Can't specify both --device-key and --device-password")
-        sys.exit(1)
+    for config in configs:
+        if config.get("password") and config.get("key"):
+            logger.critical("Can't specify both device key and device password")
+            sys.exit(1)
 
     if not args.server_host_key or not os.path.exists(os.path.expanduser(args.server_host_key)):
         logger.critical("Server host ssh key required.")
         sys.exit(1)
 
-    if not args.device_host:
-        jdsu = device.LocalOCM(args.device_name, debug=args.debug)
+    if args.device_config:
+        jdsu = OrderedDict()
+        for config in configs:
+            if config["device"] in jdsu:
+                logger.critical("Duplicate device %s in %s", config["device"], args.device_config)
+                sys.exit(1)
+            jdsu[config["device"]] = open_device(config, args)
     else:
-        if args.device_key:
-            password = RSAKey.from_private_key_file(args.device_key)
-        else:
-            password = args.device_password
-        jdsu = device.RemoteOCM(args.device_host,
-                                args.device_name,
-                                username=args.device_username,
-                                password=password,
-                                debug=args.debug)
+        jdsu = open_device(configs[0], args)
 
     ncserver = server.NetconfServer(jdsu,
                                     args.server_host_key,
                                     ssh_port=args.server_port,
                                     username=args.server_username,
                                     password=args.server_password,
-                                    debug=args.debug)
-    ncserver.join()
+                                    debug=args.debug,
+                                    scan_interval=args.scan_interval,
+                                    change_threshold=args.change_threshold)
+    try:
+        ncserver.join()
+    finally:
+        ncserver.close()
 
 if __name__ == "__main__":
     main()
@@ -19,83 +19,252 @@
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
 import argparse
+import base64
 import logging
 import io
 import sys
+import threading
+import time
+from lxml import etree
 from netconf import client
-from netconf import NSMAP, nsmap_update
+from netconf import NSMAP, nsmap_update, qmap
+from jdsuocm.export import SCAN_WRITERS, check_format, open_scan_writer
+from jdsuocm.spectrum import Spectrum
 
 
 nsmap_update({'j': "urn:TBD:params:xml:ns:yang:terastream:jdsu"})
 
+FREQUENCY_TAG = qmap("j") + "frequency"
+PORT_TAG = qmap("j") + "port"
+PORT_INDEX_TAG = qmap("j") + "port-index"
+POWER_DATA_TAG = qmap("j") + "power-data"
+POWER_TAG = qmap("j") + "power"
+TIMESTAMP_TAG = qmap("j") + "timestamp"
+
+
+def _number (text):
+    return float(text) if "." in text else int(text)
+
+
+def decode_packed_port (portelm):
+    "Decode a j:port element of a packed-scan reply into its port index and Spectrum"
+    def findtext (tag):
+        return portelm.findtext(tag, namespaces=NSMAP)
+
+    step = findtext("j:frequency-step")
+    frequency_data = findtext("j:frequency-data")
+    spectrum = Spectrum.from_packed(_number(findtext("j:start-frequency")),
+                                    _number(step) if step is not None else None,
+                                    base64.b64decode(findtext("j:power-data") or ""),
+                                    int(findtext("j:tap-gain")),
+                                    base64.b64decode(frequency_data) if frequency_data is not None else None)
+    return int(findtext("j:port-index")), spectrum
+
+
+def iter_scan_ports (reply):
+    """Walk a scan reply once yielding (timestamp, port, frequency, power) for each port.
+
+    `reply` is either the parsed reply or a file of its XML, which is then parsed
+    incrementally. The points of a port are yielded as lists of their text and a
+    packed port as the arrays of its Spectrum. An ITU scan has no ports, its
+    points are yielded with port None.
+    """
+    tags = (FREQUENCY_TAG, POWER_TAG, PORT_TAG, TIMESTAMP_TAG)
+    if hasattr(reply, "tag"):
+        events = etree.iterwalk(reply, events=("end",), tag=tags)
+    else:
+        events = etree.iterparse(reply, events=("end",), tag=tags)
+
+    timestamp = None
+    frequency, power = [], []
+    for unused, elm in events:
+        tag = elm.tag
+        if tag == FREQUENCY_TAG:
+            frequency.append(elm.text)
+        elif tag == POWER_TAG:
+            power.append(elm.text)
+        elif tag == PORT_TAG:
+            if elm.find(POWER_DATA_TAG) is not None:
+                port, spectrum = decode_packed_port(elm)
+                yield timestamp, port, spectrum.frequency, spectrum.dbm
+            else:
+                yield timestamp, int(elm.findtext(PORT_INDEX_TAG)), frequency, power
+            frequency, power = [], []
+            elm.clear()
+        elif tag == TIMESTAMP_TAG:
+            timestamp = elm.text
+    if power:
+        yield timestamp, None, frequency, power
+
+
+def get_scan_rpc (args):
+    "Return the XML of the scan RPC selected by the arguments"
+    device = "<device>{}</device>".format(args.device) if args.device else ""
+    # Only the selected ports are read from the OCM.
+    ports = "".join([ "<port-index>{}</port-index>".format(x) for x in args.scan_port or [] ])
+    if args.packed and not args.full_itu:
+        scan_type = "full-125" if args.full_125 else "full"
+        return """<packed-scan><scan-type>{}</scan-type>{}{}</packed-scan>""".format(scan_type, ports, device)
+    elif args.full_125:
+        return """<full-125-scan>{}{}</full-125-scan>""".format(ports, device)
+    elif args.full_itu:
+        return """<full-itu-scan><high-resolution>true</high-resolution>{}</full-itu-scan>""".format(device)
+    return """<full-scan>{}{}</full-scan>""".format(ports, device)
+
+
+def get_host_port (hostspec, default_port):
+    "Return the (host, port) of a host[:port] string"
+    if hostspec.count(":") == 1:
+        host, port = hostspec.split(":")
+        return host, int(port)
+    return hostspec, default_port
+
+
+def write_scan (writer, reply):
+    "Write all the ports of a scan reply with a writer from open_scan_writer"
+    for timestamp, port, frequency, power in iter_scan_ports(reply):
+        writer.write_port(timestamp, port, frequency, power)
+    writer.end_scan()
+
+
+def poll_scans (args, host, port, output_prefix, stop_event):
+    """Take the scans selected by args from the server at host and port and write them
+    to files starting with output_prefix, returns the number of scans that failed.
+
+    One NETCONF session is used for all the scans, it's reopened if a scan fails.
+    Without args.interval a single scan is taken, otherwise args.count scans (0 for
+    no limit) are taken every interval seconds. They are scheduled from the first
+    scan so the cadence doesn't drift, a scan that overruns the interval skips the
+    missed slots. If args.rotate is given new output files are started every rotate
+    seconds, named with their start time.
+    """
+    rpc = get_scan_rpc(args)
+    append = args.append or args.interval is not None
+    session = None
+    writer = None
+    rotation = None
+    failed = 0
+    taken = 0
+    deadline = time.time()
+    try:
+        while not stop_event.is_set():
+            try:
+                if session is None:
+                    session = client.NetconfSSHSession(host,
+                                                       username=args.username,
+                                                       password=args.password,
+                                                       port=port,
+                                                       debug=args.verbose)
+                unused, reply, unused = session.send_rpc(rpc)
+            except Exception as ex:
+                logging.error("%s: scan failed: %s", host, str(ex))
+                failed += 1
+                if session is not None:
+                    session.close()
+                    session = None
+            else:
+                if args.rotate and rotation != int(time.time() // args.rotate):
+                    if writer is not None:
+                        writer.close()
+                        writer = None
+                    rotation = int(time.time() // args.rotate)
+                if writer is None:
+                    prefix = output_prefix
+                    if rotation is not None:
+                        prefix += time.strftime("-%Y%m%dT%H%M%SZ", time.gmtime(rotation * args.rotate))
+                    writer = open_scan_writer(args.format, prefix, append)
+                write_scan(writer, reply)
+
+            taken += 1
+            if args.interval is None or (args.count and taken >= args.count):
+                break
+
+            deadline += args.interval
+            now = time.time()
+            if deadline < now:
+                missed = int((now - deadline) // args.interval) + 1
+                logging.warning("%s: scan overran the interval, skipping %d scans", host, missed)
+                deadline += missed * args.interval
+            stop_event.wait(deadline - now)
+    finally:
+        if writer is not None:
+            writer.close()
+        if session is not None:
+            session.close()
+    return failed
+
 
 def main (*margs):
     parser = argparse.ArgumentParser("JDSU-Scan to CSV")
 
     parser.add_argument("--full-125", action="store_true", help="Do 12.5GHz scan otherwise normal full.")
     parser.add_argument("--full-itu", action="store_true", help="Do ITU scan on single port.")
+    parser.add_argument("--append", action="store_true",
+                        help="Append to the output files, csv rows then start with the scan timestamp")
+    parser.add_argument("--count", type=int, default=0,
+                        help="The number of scans to take with --interval (default: no limit)")
+    parser.add_argument("--device", help="The device to scan on a server with multiple devices")
+    parser.add_argument("--format", choices=sorted(SCAN_WRITERS), default="csv",
+                        help="The output format, csv is a file per port (default: csv)")
     parser.add_argument("--host", default="localhost", help="The host to connect to (default: localhost)")
+    parser.add_argument("--hosts", nargs="+", metavar="HOST[:PORT]",
+                        help="Scan each of these hosts concurrently, the host is added to the output prefix")
+    parser.add_argument("--interval", type=float,
+                        help="Scan every interval seconds over the same session, output is appended")
+    parser.add_argument("--packed", action="store_true",
+                        help="Request the full or 12.5GHz scan with packed binary spectra")
     parser.add_argument("--port", type=int, default=9931, help="The port to connect to (default: 9931)")
-    parser.add_argument("--scan-port", type=int, default=None, help="The port to scan")
+    parser.add_argument("--rotate", type=float,
+                        help="With --interval start new output files every rotate seconds")
+    parser.add_argument("--scan-port", type=int, action="append",
+                        help="A port to scan, may be repeated (default: all ports)")
     parser.add_argument("--output-prefix", default="jdsu-scan",
-                        help="The Prefix of the csv file to output per port")
+                        help="The prefix of the output files")
     parser.add_argument("--username", default="admin", help="The username to login with")
     parser.add_argument("--password", default="admin", help="The password to login with")
     parser.add_argument("-v", "--verbose", action="store_true", help="The password to login with")
     args = parser.parse_args(*margs)
+    try:
+        check_format(args.format)
+    except ImportError as ex:
+        parser.error(str(ex))
+    if args.interval is not None and args.interval <= 0:
+        parser.error("--interval must be greater than 0")
+    if args.interval is None and (args.count or args.rotate):
+        parser.error("--count and --rotate require --interval")
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.WARNING)
 
-    session = client.NetconfSSHSession(args.host,
-                                       username=args.username,
-                                       password=args.password,
-                                       port=args.port,
-                                       debug=args.verbose)
-
-    try:
-        if args.full_125:
-            unused, reply, unused = session.send_rpc("""<full-125-scan/>""")
-        elif args.full_itu:
-            unused, reply, unused = session.send_rpc("""<full-itu-scan><high-resolution>true</high-resolution></full-itu-scan>""")
-        else:
-            unused, reply, unused = session.send_rpc("""<full-scan/>""")
-    except Exception as ex:
-        logging.error("Scan failed: %s", str(ex))
-        sys.exit(1)
-
-    if reply is None:
-        logging.error("Scan failed")
-    elif args.full_itu:
-        freqlist = reply.findall("*/j:point/j:frequency", namespaces=NSMAP)
-        freqlist = [ x.text for x in freqlist if x is not None and x.text]
-
-        powerlist = reply.findall("*/j:point/j:power", namespaces=NSMAP)
-        powerlist = [ x.text for x in powerlist if x is not None and x.text]
-
-        with open(args.output_prefix + ".csv", "w") as output:
-            for x, y in zip(freqlist, powerlist):
-                output.write("{}\t{}\n".format(x, y))
+    stop_event = threading.Event()
+    if not args.hosts:
+        failed = poll_scans(args, args.host, args.port, args.output_prefix, stop_event)
     else:
-        if args.scan_port is not None:
-            start, end = args.scan_port, args.scan_port + 1
-        else:
-            start, end = 0, 4
+        failures = []
 
-        for port in range(start, end):
-            xpath_prefix = "*/j:port[j:port-index='{}']/j:point/".format(port)
+        def poll_host (hostspec):
+            host, port = get_host_port(hostspec, args.port)
+            prefix = "{}-{}".format(args.output_prefix, hostspec.replace(":", "_"))
+            failures.append(poll_scans(args, host, port, prefix, stop_event))
 
-            freqlist = reply.findall(xpath_prefix + "j:frequency", namespaces=NSMAP)
-            freqlist = [ x.text for x in freqlist if x is not None and x.text]
+        threads = [ threading.Thread(name="Scan-" + x, target=poll_host, args=(x,)) for x in args.hosts ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+            raise
+        failed = sum(failures) + len(threads) - len(failures)
 
-            powerlist = reply.findall(xpath_prefix + "j:power", namespaces=NSMAP)
-            powerlist = [ x.text for x in powerlist if x is not None and x.text]
-
-            with open(args.output_prefix + "-" + str(port) + ".csv", "w") as output:
-                for x, y in zip(freqlist, powerlist):
-                    output.write("{}\t{}\t{}\n".format(port, x, y))
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
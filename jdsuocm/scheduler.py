@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import calendar
+import logging
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+def format_timestamp (timestamp):
+    "Format a time.time() value as a yang date-and-time string in UTC"
+    msecs = int((timestamp - int(timestamp)) * 1000)
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp)) + ".{:03d}Z".format(msecs)
+
+
+def parse_timestamp (text):
+    "Parse a yang date-and-time string in UTC into a time.time() value, raises ValueError if invalid"
+    text = text.strip()
+    for suffix in ("Z", "+00:00", "-00:00"):
+        if text.endswith(suffix):
+            text = text[:-len(suffix)]
+            break
+    else:
+        raise ValueError("date-and-time not in UTC: " + text)
+    seconds, unused, fraction = text.partition(".")
+    timestamp = calendar.timegm(time.strptime(seconds, "%Y-%m-%dT%H:%M:%S"))
+    if fraction:
+        timestamp += float("0." + fraction)
+    return timestamp
+
+
+class ScanResult (object):
+    "A scan result and the time the scan completed"
+    __slots__ = [ "timestamp", "result" ]
+
+    def __init__ (self, result, timestamp=None):
+        self.result = result
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def get_age (self, now=None):
+        "Age of the scan in milliseconds"
+        if now is None:
+            now = time.time()
+        return int((now - self.timestamp) * 1000)
+
+
+class LatestScanBuffer (object):
+    """Double buffered latest result of a scan.
+
+    The writer fills the back buffer and then flips the index so readers never
+    see a partially published result and never wait on the writer.
+    """
+
+    def __init__ (self):
+        self.buffers = [ None, None ]
+        self.current = 0
+
+    def publish (self, scan):
+        back = 1 - self.current
+        self.buffers[back] = scan
+        self.current = back
+
+    def latest (self):
+        return self.buffers[self.current]
+
+
+class ScanScheduler (object):
+    """Background thread running device scans on a fixed cadence.
+
+    Each scan is identified by a key (the same key used to coalesce in flight
+    RPCs) and is run as method(*args) with the device lock held. The latest
+    result of each is kept in a LatestScanBuffer.
+    """
+
+    def __init__ (self, device_lock, interval, debug=False, name="ScanScheduler"):
+        self.name = name
+        self.device_lock = device_lock
+        self.interval = interval
+        self.debug = debug
+        self.scans = []
+        self.latest_scans = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def add_scan (self, key, method, *args):
+        self.scans.append((key, method, args))
+        self.latest_scans[key] = LatestScanBuffer()
+
+    def publish (self, key, scan):
+        "Publish a scan result obtained outside the scheduler"
+        if key in self.latest_scans:
+            self.latest_scans[key].publish(scan)
+
+    def get_latest (self, key, max_age):
+        "Return the latest ScanResult for key if no older than max_age milliseconds else None"
+        try:
+            scan = self.latest_scans[key].latest()
+        except KeyError:
+            return None
+        if scan is None or scan.get_age() > max_age:
+            return None
+        return scan
+
+    def start (self):
+        self.thread = threading.Thread(name=self.name, target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop (self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run (self):
+        deadline = time.time()
+        while not self.stop_event.is_set():
+            for key, method, args in self.scans:
+                try:
+                    with self.device_lock:
+                        result = method(*args)
+                    self.latest_scans[key].publish(ScanResult(result))
+                except Exception as ex:
+                    logger.error("%s: background scan %s failed: %s: %s", self.name, str(key), str(ex),
+                                 traceback.format_exc())
+                if self.stop_event.is_set():
+                    return
+
+            # Schedule from the previous deadline so the cadence doesn't drift.
+            deadline += self.interval
+            now = time.time()
+            if deadline < now:
+                if self.debug:
+                    logger.debug("%s: background scans overran interval by %.3fs", self.name, now - deadline)
+                deadline = now
+            self.stop_event.wait(deadline - now)
+
+
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
@@ -17,13 +17,195 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, print_function, nested_scopes
+import argparse
+import errno
+import fcntl
+import os
 import select
 import serial
+import signal
 import sys
 import syslog
+import time
 
+# Largest chunk moved per read, also the most we buffer for a slow writer.
+BUFSIZE = 65536
 
-def main (devname, debug=False):
+
+class RelayStats (object):
+    "Byte and latency counters for the relay"
+
+    def __init__ (self):
+        self.start = time.time()
+        self.stdin_bytes = 0
+        self.stdin_reads = 0
+        self.serial_bytes = 0
+        self.serial_reads = 0
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.sent_time = None
+
+    def sent (self, nbytes):
+        self.stdin_bytes += nbytes
+        self.stdin_reads += 1
+        if self.sent_time is None:
+            self.sent_time = time.time()
+
+    def received (self, nbytes):
+        self.serial_bytes += nbytes
+        self.serial_reads += 1
+        # Latency is from the first command byte to the first response byte.
+        if self.sent_time is not None:
+            latency = time.time() - self.sent_time
+            self.sent_time = None
+            self.latency_count += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def __str__ (self):
+        avg = self.latency_total / self.latency_count if self.latency_count else 0.0
+        return ("sercat: up {:.1f}s stdin->serial {} bytes in {} reads serial->stdout {} bytes in {} reads "
+                "latency avg {:.2f}ms max {:.2f}ms over {}".format(time.time() - self.start,
+                                                                   self.stdin_bytes,
+                                                                   self.stdin_reads,
+                                                                   self.serial_bytes,
+                                                                   self.serial_reads,
+                                                                   avg * 1000,
+                                                                   self.latency_max * 1000,
+                                                                   self.latency_count))
+
+
+def dump_stats (stats, debug):
+    syslog.syslog(str(stats))
+    if debug:
+        sys.stderr.write(str(stats) + "\n")
+
+
+def set_nonblocking (fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def read_available (fd):
+    "Read whatever is available on `fd`, None if nothing was or b'' on EOF"
+    try:
+        return os.read(fd, BUFSIZE)
+    except OSError as error:
+        if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return None
+        raise
+
+
+def write_available (fd, buf):
+    "Write as much of `buf` to `fd` as it will take and remove it from `buf`"
+    try:
+        count = os.write(fd, bytes(buf))
+    except OSError as error:
+        if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return 0
+        raise
+    del buf[:count]
+    return count
+
+
+class SelectPoller (object):
+    def wait (self, readfds, writefds):
+        try:
+            readfds, writefds, unused = select.select(readfds, writefds, [])
+        except (select.error, OSError) as error:
+            if error.args[0] == errno.EINTR:
+                return [], []
+            raise
+        return readfds, writefds
+
+
+class EpollPoller (object):
+    def __init__ (self):
+        self.epoll = select.epoll()
+        self.registered = {}
+
+    def wait (self, readfds, writefds):
+        wanted = {}
+        for fd in readfds:
+            wanted[fd] = wanted.get(fd, 0) | select.EPOLLIN
+        for fd in writefds:
+            wanted[fd] = wanted.get(fd, 0) | select.EPOLLOUT
+        for fd in list(self.registered):
+            if fd not in wanted:
+                self.epoll.unregister(fd)
+                del self.registered[fd]
+        for fd, mask in wanted.items():
+            if fd not in self.registered:
+                self.epoll.register(fd, mask)
+            elif self.registered[fd] != mask:
+                self.epoll.modify(fd, mask)
+            self.registered[fd] = mask
+        try:
+            events = self.epoll.poll()
+        except (IOError, OSError) as error:
+            if error.args[0] == errno.EINTR:
+                return [], []
+            raise
+        readable = [ fd for fd, event in events if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR) ]
+        writable = [ fd for fd, event in events if event & (select.EPOLLOUT | select.EPOLLERR) ]
+        return readable, writable
+
+
+def relay (stdin_fd, stdout_fd, serial_fd, poller, stats, debug=False):
+    "Relay data between stdin/stdout and the serial port until EOF on stdin"
+    to_serial = bytearray()
+    to_stdout = bytearray()
+    stdin_eof = False
+    while True:
+        readfds = []
+        writefds = []
+        if not stdin_eof and len(to_serial) < BUFSIZE:
+            readfds.append(stdin_fd)
+        if len(to_stdout) < BUFSIZE:
+            readfds.append(serial_fd)
+        if to_serial:
+            writefds.append(serial_fd)
+        if to_stdout:
+            writefds.append(stdout_fd)
+        if stdin_eof and not to_serial and not to_stdout:
+            if debug:
+                sys.stderr.write("sercat: Exiting due to EOF on stdin\n")
+            return 0
+
+        readfds, writefds = poller.wait(readfds, writefds)
+
+        if stdin_fd in readfds:
+            inbuf = read_available(stdin_fd)
+            if inbuf is not None:
+                if not inbuf:
+                    stdin_eof = True
+                else:
+                    stats.sent(len(inbuf))
+                    to_serial += inbuf
+                    if debug:
+                        sys.stderr.write("sercat: Stdin read {} bytes\n".format(len(inbuf)))
+
+        if serial_fd in readfds:
+            outbuf = read_available(serial_fd)
+            if outbuf is not None:
+                if not outbuf:
+                    if debug:
+                        sys.stderr.write("Error read ready on serial but no chars!\n")
+                    return 1
+                stats.received(len(outbuf))
+                to_stdout += outbuf
+                if debug:
+                    sys.stderr.write("sercat: Serial read {} bytes\n".format(len(outbuf)))
+
+        # Try writing straight away rather than waiting another poll round.
+        if to_serial:
+            write_available(serial_fd, to_serial)
+        if to_stdout:
+            write_available(stdout_fd, to_stdout)
+
+
+def main (devname, debug=False, use_epoll=False):
     serdev = serial.Serial(port=devname,
                            timeout=0,
                            baudrate=115200,
@@ -32,70 +214,38 @@ def main (devname, debug=False):
                            xonxoff=False,
                            rtscts=False,
                            bytesize=serial.EIGHTBITS)
-    if debug:
-        sys.stderr.write("sercat: Opening serial\n")
-    #syslog.syslog("sercat: Opening serdev\n")
-    ### serial.open()
-    serdev.nonblocking()
     if debug:
         sys.stderr.write("sercat: Opened serial\n")
-    #syslog.syslog("sercat: Opened serial\n")
 
-    # try:
-    #    import fcntl
-    #    fcntl.fcntl(sys.stdin.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
-    # except Exception as error:
-    #    syslog.syslog("sercat: error with fcntl: %s\n", str(error))
+    stdin_fd = sys.stdin.fileno()
+    stdout_fd = sys.stdout.fileno()
+    serial_fd = serdev.fileno()
+    for fd in (stdin_fd, stdout_fd, serial_fd):
+        set_nonblocking(fd)
+
+    if use_epoll and hasattr(select, "epoll"):
+        poller = EpollPoller()
+    else:
+        poller = SelectPoller()
+
+    stats = RelayStats()
+    signal.signal(signal.SIGUSR1, lambda unused_signum, unused_frame: dump_stats(stats, debug))
 
+    status = 1
     try:
-        while True:
-            syslog.syslog("sercat: selecting\n")
-            readfds, unused, unused = select.select([ sys.stdin, serdev ], [], [])
-            if sys.stdin in readfds:
-                if debug:
-                    sys.stderr.write("sercat: Stdin read ready\n")
-                # syslog.syslog("sercat: Stdin read ready\n")
-                # inbuf = sys.stdin.read(1)
-                inbuf = sys.stdin.read(1)
-                if not inbuf:
-                    # syslog.syslog("sercat: Exiting cleanly due to EOF on stdin")
-                    if debug:
-                        sys.stderr.write("Exiting due to EOF on stdin\n")
-                    sys.exit(0)
-                if debug:
-                    sys.stderr.write("sercat: Stdin read {} bytes\n".format(len(inbuf)))
-                # syslog.syslog("sercat: Stdin read {} bytes\n".format(len(inbuf)))
-                outcount = serdev.write(inbuf)
-                if debug:
-                    sys.stderr.write("sercat: Serial wrote {} bytes\n".format(outcount))
-                # syslog.syslog("sercat: Serial wrote {} bytes\n".format(outcount))
-                assert outcount == len(inbuf)
-            if serdev in readfds:
-                if debug:
-                    sys.stderr.write("sercat: Serial read ready\n")
-                # syslog.syslog("sercat: Serial read ready\n")
-                n = serdev.inWaiting()
-                if not n:
-                    # syslog.syslog("sercat: Error read ready on serial but no chars!")
-                    if debug:
-                        sys.stderr.write("Error read ready on serial but no chars!\n")
-                    sys.exit(1)
-                else:
-                    if debug:
-                        sys.stderr.write("sercat: Serial reading {} bytes\n".format(n))
-                    # syslog.syslog("sercat: Serial reading {} bytes\n".format(n))
-                    outbuf = serdev.read(n)
-                    if debug:
-                        sys.stderr.write("sercat: Serial read {} bytes\n".format(len(outbuf)))
-                    # syslog.syslog("sercat: Serial read {} bytes\n".format(len(outbuf)))
-                    sys.stdout.write(outbuf)
-                    if debug:
-                        sys.stderr.write("sercat: Stdout wrote {} bytes\n".format(len(outbuf)))
-                    # syslog.syslog("sercat: Stdout wrote {} bytes\n".format(len(outbuf)))
+        status = relay(stdin_fd, stdout_fd, serial_fd, poller, stats, debug)
     except Exception as error:
-        syslog.syslog("sercat: error in try: %s\n", str(error))
+        syslog.syslog("sercat: error in relay: {}\n".format(error))
+    finally:
+        dump_stats(stats, debug)
+    sys.exit(status)
 
 
 if __name__ == "__main__":
     # Could process all the serial settings here..
-    main(sys.argv[1])
+    parser = argparse.ArgumentParser("sercat")
+    parser.add_argument("devname", help="The serial port device")
+    parser.add_argument("--epoll", action="store_true", help="Use epoll rather than select")
+    parser.add_argument("-d", "--debug", action="store_true", help="Debug output on stderr")
+    args = parser.parse_args()
+    main(args.devname, args.debug, args.epoll)
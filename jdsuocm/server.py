@@ -18,35 +18,383 @@
 # limitations under the License.
 #
 from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import base64
+import io
 import logging
 import os
 import threading
+import time
 import traceback
+from collections import OrderedDict, deque
+from xml.sax.saxutils import escape
 
 import netconf.util as ncutil
 import netconf.error as ncerror
 import netconf.server as server
 from netconf import nsmap_update, NSMAP, qmap
+from lxml import etree
 
 import jdsuocm.error as jerror
+from jdsuocm.chanpower import channel_powers, profile_channels
+from jdsuocm.detect import ChangeDetector
+from jdsuocm.scheduler import ScanResult, ScanScheduler, format_timestamp, parse_timestamp
+from jdsuocm.spectrum import TAP_GAIN
 
-nsmap_update({'j': "urn:TBD:params:xml:ns:yang:terastream:jdsu"})
+nsmap_update({'j': "urn:TBD:params:xml:ns:yang:terastream:jdsu",
+              'ncevent': "urn:ietf:params:xml:ns:netconf:notification:1.0"})
+
+NOTIFICATION_CAPABILITY = "urn:ietf:params:netconf:capability:notification:1.0"
+NOTIFICATION_STREAM = "NETCONF"
 
 
 logger = logging.getLogger(__name__)
 
+# Scan replies are written as text straight from the decoded values rather than built
+# one element at a time, these are the templates.
+SCAN_POINT_XML = "<j:point><j:frequency>%s</j:frequency><j:power>%.2f</j:power></j:point>"
+SCAN_PRESENCE_POINT_XML = ("<j:point><j:frequency>%s</j:frequency><j:power>%.2f</j:power>"
+                           "<j:channel-presence>%d</j:channel-presence></j:point>")
 
-class NetconfServer (object):
-    NCFILTER = qmap("nc") + "filter"
 
-    def __init__ (self, device, host_key, ssh_port=830, username=None, password=None, debug=False):
-        #-----------------
-        # Open the device
-        #-----------------
+def write_scan_start (output, scan):
+    "Write the start of a scan reply with the timestamp and age of the scan"
+    output.write('<data xmlns:j="{}"><j:timestamp>{}</j:timestamp><j:age>{}</j:age>'.format(
+        NSMAP['j'], format_timestamp(scan.timestamp), scan.get_age()))
+
+
+def write_scan_end (output):
+    output.write("</data>")
+
+
+def write_port_spectrum (output, port, spectrum):
+    "Write the j:port element of a port's Spectrum"
+    output.write("<j:port><j:port-index>%d</j:port-index>" % port)
+    output.write("".join([ SCAN_POINT_XML % point for point in zip(*spectrum.tolists()) ]))
+    output.write("</j:port>")
+
+
+def write_port_packed (output, port, spectrum):
+    "Write the j:port element of a port's Spectrum with the powers (and frequencies if uneven) packed"
+    frequency = spectrum.tolists()[0]
+    step = spectrum.get_step()
+    output.write("<j:port><j:port-index>%d</j:port-index>" % port)
+    output.write("<j:start-frequency>%s</j:start-frequency>" % (frequency[0] if frequency else 0))
+    if step is not None:
+        output.write("<j:frequency-step>%s</j:frequency-step>" % step)
+    output.write("<j:point-count>%d</j:point-count>" % len(spectrum))
+    output.write("<j:tap-gain>%d</j:tap-gain>" % TAP_GAIN)
+    output.write("<j:power-data>%s</j:power-data>" % base64.b64encode(spectrum.pack_power()).decode("ascii"))
+    if step is None:
+        output.write("<j:frequency-data>%s</j:frequency-data>" %
+                     base64.b64encode(spectrum.pack_frequency()).decode("ascii"))
+    output.write("</j:port>")
+
+
+def write_history_port (output, port, frequency, tap_gain, timestamps, columns):
+    """Write the scan-history j:port element of a port's scans.
+
+    frequency and timestamps are numpy arrays and columns a list of (tag, values)
+    with a value for each timestamp, either a count or a numpy row of int16 power
+    words which are packed like power-data."""
+    step_set = set(( y - x for x, y in zip(frequency[:-1].tolist(), frequency[1:].tolist()) ))
+    output.write("<j:port><j:port-index>%d</j:port-index>" % port)
+    output.write("<j:start-frequency>%.15g</j:start-frequency>" % (frequency[0] if len(frequency) else 0))
+    if len(step_set) <= 1:
+        output.write("<j:frequency-step>%.15g</j:frequency-step>" % (step_set.pop() if step_set else 0))
+    else:
+        offsets = (frequency - frequency[0]).astype(">u2")
+        output.write("<j:frequency-data>%s</j:frequency-data>" % base64.b64encode(offsets.tobytes()).decode("ascii"))
+    output.write("<j:point-count>%d</j:point-count>" % len(frequency))
+    output.write("<j:tap-gain>%d</j:tap-gain>" % tap_gain)
+    for idx, timestamp in enumerate(timestamps.tolist()):
+        output.write("<j:scan><j:timestamp>%s</j:timestamp>" % format_timestamp(timestamp))
+        for tag, values in columns:
+            if tag == "count":
+                value = "%d" % values[idx]
+            else:
+                value = base64.b64encode(values[idx].astype(">i2").tobytes()).decode("ascii")
+            output.write("<j:%s>%s</j:%s>" % (tag, value, tag))
+        output.write("</j:scan>")
+    output.write("</j:port>")
+
+
+def write_itu_points (output, points, power_only):
+    "Write the j:point elements of an ITU scan, power_only leaves out any channel presence"
+    if power_only:
+        output.write("".join([ SCAN_POINT_XML % (x[0], x[-1].dBm) for x in points ]))
+    else:
+        output.write("".join([ SCAN_PRESENCE_POINT_XML % (freq, power.dBm, presence)
+                               for freq, presence, power in points ]))
+
+
+def write_port_channels (output, port, centres, widths, powers):
+    "Write the channel-power j:port element of a port's chanpower.ChannelPowers, NaN values are left out"
+    output.write("<j:port><j:port-index>%d</j:port-index>" % port)
+    columns = [ ("power", "%.2f", powers.power.tolist()),
+                ("peak-power", "%.2f", powers.peak.tolist()),
+                ("peak-frequency", "%.3f", powers.peak_frequency.tolist()),
+                ("osnr", "%.2f", powers.osnr.tolist()) ]
+    for idx, (centre, width) in enumerate(zip(centres, widths)):
+        output.write("<j:channel><j:centre-frequency>%.3f</j:centre-frequency><j:width>%.3f</j:width>" %
+                     (centre, width))
+        for tag, fmt, values in columns:
+            if values[idx] == values[idx]:
+                output.write("<j:" + tag + ">" + fmt % values[idx] + "</j:" + tag + ">")
+        output.write("</j:channel>")
+    output.write("</j:port>")
+
+
+def write_spectrum_change (output, device_name, kind, timestamp, changes):
+    "Write a spectrum-change notification body for the detect.SpectrumChange list of a scan"
+    output.write('<spectrum-change xmlns="{}"><device>{}</device><scan-type>{}</scan-type>'
+                 '<timestamp>{}</timestamp>'.format(NSMAP['j'], escape(device_name), kind,
+                                                    format_timestamp(timestamp)))
+    for change in changes:
+        output.write("<change>")
+        if change.port is not None:
+            output.write("<port-index>%d</port-index>" % change.port)
+        output.write("<frequency>%.15g</frequency><change-type>%s</change-type><power>%.2f</power>"
+                     "<previous-power>%.2f</previous-power></change>" %
+                     (change.frequency, change.change, change.power, change.previous))
+    output.write("</spectrum-change>")
+
+
+def histogram_elm (tag, histogram):
+    "Return an element for a stats.Histogram"
+    elm = ncutil.elm(tag)
+    elm.append(ncutil.leaf_elm("j:count", histogram.count))
+    hdict = histogram.as_dict()
+    elm.append(ncutil.leaf_elm("j:min", hdict["min_usec"]))
+    elm.append(ncutil.leaf_elm("j:max", hdict["max_usec"]))
+    elm.append(ncutil.leaf_elm("j:mean", hdict["mean_usec"]))
+    for bound, count in hdict["buckets"]:
+        bucket_elm = ncutil.subelm(elm, "j:bucket")
+        bucket_elm.append(ncutil.leaf_elm("j:upper-bound", bound if bound is not None else "infinity"))
+        bucket_elm.append(ncutil.leaf_elm("j:count", count))
+    return elm
+
+
+def statistics_elm (stats, cmdnames=None):
+    "Return the j:statistics element for a stats.DeviceStats, only for `cmdnames` if given"
+    elm = ncutil.elm("j:statistics")
+    with stats.lock:
+        for cmdname in sorted(stats.commands):
+            if cmdnames and cmdname not in cmdnames:
+                continue
+            cstats = stats.commands[cmdname]
+            cmd_elm = ncutil.subelm(elm, "j:command")
+            cmd_elm.append(ncutil.leaf_elm("j:name", cmdname))
+            cmd_elm.append(ncutil.leaf_elm("j:count", cstats.count))
+            cmd_elm.append(ncutil.leaf_elm("j:request-bytes", cstats.request_bytes))
+            cmd_elm.append(ncutil.leaf_elm("j:response-bytes", cstats.response_bytes))
+            for error, count in sorted(cstats.errors.items()):
+                error_elm = ncutil.subelm(cmd_elm, "j:error")
+                error_elm.append(ncutil.leaf_elm("j:code", jerror.get_error_result(error)))
+                error_elm.append(ncutil.leaf_elm("j:count", count))
+            cmd_elm.append(histogram_elm("j:send-time", cstats.send))
+            cmd_elm.append(histogram_elm("j:first-byte-time", cstats.first_byte))
+            cmd_elm.append(histogram_elm("j:transfer-time", cstats.transfer))
+    return elm
+
+
+DEFAULT_DEVICE_NAME = "default"
+ALL_PORTS = 0b1111                                      # Instance bitmap of all ports of a 4-port OCM
+
+
+class TextReply (object):
+    """The data of an rpc-reply already written as XML text.
+
+    A ReplySession sends the text as is, iterating it gives the parsed element."""
+
+    def __init__ (self, text):
+        self.text = text
+
+    def __iter__ (self):
+        return iter([ etree.fromstring(self.text) ])
+
+
+class ReplySession (server.NetconfServerSession):
+    """A NETCONF server session that sends TextReply data without building a tree of it.
+
+    Messages are written whole under the session's write lock, so notifications sent
+    from other threads never land inside a reply.
+    """
+
+    def __init__ (self, channel, ncserver, extra_args, debug):
+        self.write_lock = threading.Lock()
+        self.after_reply = []
+        super(ReplySession, self).__init__(channel, ncserver, extra_args, debug)
+
+    def send_message (self, msg):
+        with self.write_lock:
+            super(ReplySession, self).send_message(msg)
+
+    def call_after_reply (self, func):
+        "Call func once the reply to the RPC being handled has been sent"
+        self.after_reply.append(func)
+
+    def _send_rpc_reply (self, rpc_reply, origmsg):
+        if not isinstance(rpc_reply, TextReply):
+            super(ReplySession, self)._send_rpc_reply(rpc_reply, origmsg)
+        else:
+            reply = etree.Element(qmap('nc') + "rpc-reply", attrib=origmsg.attrib, nsmap=origmsg.nsmap)
+            empty = etree.tounicode(reply)
+            assert empty.endswith("/>")
+            end = "</{}:rpc-reply>".format(reply.prefix) if reply.prefix else "</rpc-reply>"
+            self.send_message(empty[:-2] + ">" + rpc_reply.text + end)
+        after_reply, self.after_reply = self.after_reply, []
+        for func in after_reply:
+            func()
+
+
+class NetconfSSHServer (server.NetconfSSHServer):
+    "A NETCONF SSH server whose sessions are ReplySessions"
+
+    # netconf's server gives sshutil its own session class, which it keeps in this attribute.
+    server_session_class = property(lambda self: ReplySession, lambda self, value: None)
+
+
+class PendingResult (object):
+    "The result of an in flight device method, published to every caller waiting on it"
+
+    def __init__ (self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def publish (self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.event.set()
+
+    def wait (self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class PendingScan (object):
+    """The ports of an in flight streamed scan, published to every caller waiting on
+    it as they are read from the device."""
+
+    def __init__ (self):
+        self.cond = threading.Condition()
+        self.scan = ScanResult([])
+        self.done = False
+        self.error = None
+
+    def add_port (self, port, value):
+        with self.cond:
+            if not self.scan.result:
+                self.scan.timestamp = time.time()
+            self.scan.result.append((port, value))
+            self.cond.notify_all()
+
+    def publish (self, error=None):
+        "Mark the scan finished, with the error that ended it if any"
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def iter_ports (self):
+        "Yield each (port, value) of the scan as it's read, raises the error if the scan fails"
+        idx = 0
+        while True:
+            with self.cond:
+                while idx == len(self.scan.result) and not self.done:
+                    self.cond.wait()
+                if idx == len(self.scan.result):
+                    if self.error is not None:
+                        raise self.error
+                    return
+                port, value = self.scan.result[idx]
+            idx += 1
+            yield port, value
+
+    def wait (self):
+        for unused in self.iter_ports():
+            pass
+        return self.scan.result
+
+
+class NotificationSender (object):
+    """The sessions subscribed with create-subscription and the notifications
+    waiting to be sent to them.
+
+    Notifications are sent from a thread of their own so a slow subscriber never
+    holds up a device. Subscriptions end when the session closes or at the
+    subscription's stop time.
+    """
+
+    def __init__ (self, debug=False):
         self.debug = debug
+        self.cond = threading.Condition()
+        self.pending = deque()
+        # Stop time (or None) by session
+        self.subscriptions = {}
+        self.thread = threading.Thread(name="NotificationSender", target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
 
-        host_key_path = os.path.expanduser(host_key)
-        assert os.path.exists(host_key_path)
+    def is_subscribed (self, session):
+        with self.cond:
+            return session in self.subscriptions
+
+    def subscribe (self, session, stop_time=None):
+        with self.cond:
+            self.subscriptions[session] = stop_time
+
+    def send (self, event_time, body):
+        "Queue the notification content body of an event at event_time for the subscribers"
+        with self.cond:
+            if not self.subscriptions:
+                return
+            self.pending.append((event_time, body))
+            self.cond.notify()
+
+    def _run (self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                event_time, body = self.pending.popleft()
+                subscriptions = list(self.subscriptions.items())
+
+            msg = '<notification xmlns="{}"><eventTime>{}</eventTime>{}</notification>'.format(
+                NSMAP['ncevent'], format_timestamp(event_time), body)
+            for session, stop_time in subscriptions:
+                if stop_time is not None and event_time > stop_time:
+                    self._unsubscribe(session)
+                    continue
+                try:
+                    if not session.is_active():
+                        self._unsubscribe(session)
+                        continue
+                    session.send_message(msg)
+                except Exception as ex:
+                    logger.info("%s: ending subscription after send failed: %s", str(session), str(ex))
+                    self._unsubscribe(session)
+
+    def _unsubscribe (self, session):
+        if self.debug:
+            logger.debug("%s: subscription ended", str(session))
+        with self.cond:
+            self.subscriptions.pop(session, None)
+
+
+class DeviceWorker (object):
+    """A device served by the NetconfServer and the state kept for it.
+
+    Each device has its own lock, in flight table and background scan
+    scheduler so that RPCs for different devices run concurrently.
+    """
+
+    def __init__ (self, name, device, scan_interval=None, debug=False):
+        self.name = name
+        self.device = device
+        self.debug = debug
 
         idn = device.get_idn_data()
 
@@ -59,9 +407,176 @@ class NetconfServer (object):
             self.nports = 1
             self.is_tfm = True
 
-        self.device = device
         self.device_lock = threading.Lock()
 
+        # In flight coalesced device methods by key.
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+
+        #-------------------------------------
+        # Start the background scan scheduler
+        #-------------------------------------
+
+        self.scheduler = None
+        if scan_interval:
+            self.scheduler = ScanScheduler(self.device_lock, scan_interval, debug=debug,
+                                           name="ScanScheduler-" + name)
+            if self.is_tfm:
+                self.add_scheduled_scan(self.device.get_itu_scan, False)
+            else:
+                self.add_scheduled_scan(self.device.get_full_scan, ALL_PORTS, True)
+                self.add_scheduled_scan(self.device.get_full_125_scan, ALL_PORTS, True)
+            self.scheduler.start()
+
+    def __str__ (self):
+        return "DeviceWorker({})".format(self.name)
+
+    def method_key (self, method, *args):
+        return (method.__name__,) + args
+
+    def add_scheduled_scan (self, method, *args):
+        self.scheduler.add_scan(self.method_key(method, *args), method, *args)
+
+    def run_method (self, method, *args, **kwargs):
+        with self.device_lock:
+            return method(*args, **kwargs)
+
+    def run_coalesced_method (self, method, *args):
+        """Run a device method, if the same method with the same arguments is already in
+        flight wait for and return its result rather than running the device again.
+        The result is shared between callers and must not be modified."""
+        key = self.method_key(method, *args)
+        with self.inflight_lock:
+            pending = self.inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = PendingResult()
+                self.inflight[key] = pending
+
+        if owner:
+            result = error = None
+            try:
+                with self.device_lock:
+                    result = method(*args)
+            except Exception as ex:
+                error = ex
+            finally:
+                # Out of flight before it's published so later callers run the method again
+                # rather than getting this result once it has been returned.
+                with self.inflight_lock:
+                    del self.inflight[key]
+                pending.publish(result, error)
+        elif self.debug:
+            logger.debug("%s: coalesced %s with in flight call", str(self), str(key))
+
+        return pending.wait()
+
+    def run_scan_method (self, max_age, method, *args, **kwargs):
+        """Return a ScanResult for the scan method, if max_age (in milliseconds) is given
+        and the background scheduler has a scan that new return it immediately.
+
+        If `stream` is given, a (iter_method, on_port) pair, on_port(scan, port, value)
+        is called for each (port, value) of the result. If the device is scanned it's
+        with iter_method in a thread of its own, which hands each port to the callers
+        as soon as it's read. Callers process a port outside of the device lock while
+        the rest are still arriving, an error raised by on_port is only raised to its
+        caller. `scan` is the ScanResult being filled in.
+        """
+        stream = kwargs.get("stream")
+        key = self.method_key(method, *args)
+        scan = None
+        if max_age is not None and self.scheduler is not None:
+            scan = self.scheduler.get_latest(key, max_age)
+            if scan is not None:
+                return self._replay_scan(scan, stream)
+
+        if stream is None:
+            scan = ScanResult(self.run_coalesced_method(method, *args))
+        else:
+            iter_method, on_port = stream
+            with self.inflight_lock:
+                pending = self.inflight.get(key)
+                if pending is None:
+                    pending = PendingScan()
+                    self.inflight[key] = pending
+                    thread = threading.Thread(name="ScanReader-" + self.name, target=self._read_scan,
+                                              args=(key, pending, iter_method, args))
+                    thread.daemon = True
+                    thread.start()
+                elif self.debug:
+                    logger.debug("%s: coalesced %s with in flight call", str(self), str(key))
+
+            if isinstance(pending, PendingScan):
+                for port, value in pending.iter_ports():
+                    on_port(pending.scan, port, value)
+                scan = pending.scan
+            else:
+                # Coalesced with an unstreamed call of the method
+                scan = self._replay_scan(ScanResult(pending.wait()), stream)
+
+        if self.scheduler is not None:
+            self.scheduler.publish(key, scan)
+        return scan
+
+    def _read_scan (self, key, pending, iter_method, args):
+        "Read a streamed scan from the device handing each port to pending"
+        error = None
+        try:
+            with self.device_lock:
+                for port, value in iter_method(*args):
+                    pending.add_port(port, value)
+        except Exception as ex:
+            error = ex
+        finally:
+            # Out of flight before it's published, as in run_coalesced_method.
+            with self.inflight_lock:
+                del self.inflight[key]
+            pending.publish(error)
+
+    @staticmethod
+    def _replay_scan (scan, stream):
+        if stream is not None:
+            for port, value in scan.result:
+                stream[1](scan, port, value)
+        return scan
+
+
+class NetconfServer (object):
+    NCFILTER = qmap("nc") + "filter"
+
+    def __init__ (self, device, host_key, ssh_port=830, username=None, password=None, debug=False,
+                  scan_interval=None, change_threshold=None):
+        """Serve device over NETCONF, device may also be a dictionary of devices by
+        name in which case RPCs select the device with a device parameter.
+
+        If change_threshold is given each scan is checked for changes of at least
+        that many dB (and ITU channels added or dropped), which are sent as
+        spectrum-change notifications to create-subscription subscribers."""
+        #------------------
+        # Open the devices
+        #------------------
+        self.debug = debug
+
+        host_key_path = os.path.expanduser(host_key)
+        assert os.path.exists(host_key_path)
+
+        if not isinstance(device, dict):
+            device = { DEFAULT_DEVICE_NAME: device }
+        self.workers = OrderedDict()
+        for name, ocm in device.items():
+            self.workers[name] = DeviceWorker(name, ocm, scan_interval, debug)
+        self.multi_device = len(self.workers) > 1
+
+        #-------------------------------------------
+        # Notify subscribers of changes in the scans
+        #-------------------------------------------
+
+        self.notifications = None
+        if change_threshold:
+            self.notifications = NotificationSender(debug)
+            for worker in self.workers.values():
+                self._add_change_detector(worker, ChangeDetector(change_threshold))
+
         #-----------------------
         # Start the server.
         #-----------------------
@@ -69,50 +584,203 @@ class NetconfServer (object):
         self.controller = server.SSHUserPassController(username=username,
                                                        password=password)
 
-        self.server = server.NetconfSSHServer(server_ctl=self.controller,
-                                              port=ssh_port,
-                                              host_key=host_key_path,
-                                              server_methods=self,
-                                              debug=debug)
+        self.server = NetconfSSHServer(server_ctl=self.controller,
+                                       port=ssh_port,
+                                       host_key=host_key_path,
+                                       server_methods=self,
+                                       debug=debug)
         logger.info("Listening on port %d", self.server.port)
 
     def join (self):
         "Wait on server to terminate"
         self.server.join()
 
+    def close (self):
+        "Stop the server and the background scans and write any scan history to disk"
+        thread = self.server.thread
+        if thread is not None and thread.is_alive():
+            self.server.close()
+        for worker in self.workers.values():
+            if worker.scheduler is not None:
+                worker.scheduler.stop()
+            if getattr(worker.device, "history", None) is not None:
+                worker.device.history.flush()
+
     def nc_append_capabilities (self, caps):
         ncutil.subelm(caps, "capability").text = NSMAP['j']
+        if self.notifications is not None:
+            ncutil.subelm(caps, "capability").text = NOTIFICATION_CAPABILITY
+
+    def _add_change_detector (self, worker, detector):
+        def on_scan (kind, timestamp, result):
+            # Checked even without subscribers to keep the baseline current.
+            changes = detector.check(kind, result)
+            if changes:
+                output = io.StringIO()
+                write_spectrum_change(output, worker.name, kind, timestamp, changes)
+                self.notifications.send(timestamp, output.getvalue())
+        worker.device.add_scan_listener(on_scan)
+
+    def _device_error (self, rpc, ex):
+        if isinstance(ex, jerror.OCMError):
+            return ncerror.RPCServerError(rpc,
+                                          ncerror.RPCERR_TYPE_APPLICATION,
+                                          ncerror.RPCERR_TAG_OPERATION_FAILED,
+                                          message=str(ex))
+        return ncerror.RPCServerError(rpc,
+                                      ncerror.RPCERR_TYPE_APPLICATION,
+                                      ncerror.RPCERR_TAG_OPERATION_FAILED,
+                                      app_tag="unexpected-error",
+                                      message=str(ex))
 
-    def _run_device_method (self, rpc, method, *args, **kwargs):
+    def _run_device_method (self, rpc, worker, method, *args, **kwargs):
         try:
-            with self.device_lock:
-                return method(*args, **kwargs)
-        except jerror.OCMError as err:
-            raise ncerror.RPCServerError(rpc,
-                                         ncerror.RPCERR_TYPE_APPLICATION,
-                                         ncerror.RPCERR_TAG_OPERATION_FAILED,
-                                         message=str(err))
+            return worker.run_method(method, *args, **kwargs)
         except Exception as ex:
-            raise ncerror.RPCServerError(rpc,
-                                         ncerror.RPCERR_TYPE_APPLICATION,
-                                         ncerror.RPCERR_TAG_OPERATION_FAILED,
-                                         app_tag="unexpected-error",
-                                         message=str(ex))
+            raise self._device_error(rpc, ex)
+
+    def _run_scan_method (self, rpc, worker, max_age, method, *args, **kwargs):
+        try:
+            return worker.run_scan_method(max_age, method, *args, **kwargs)
+        except Exception as ex:
+            raise self._device_error(rpc, ex)
+
+    def _run_port_scan (self, rpc, worker, max_age, method_name, instance, write_port):
+        """Run the named full scan method on the instance ports and write its reply with
+        write_port(output, port, spectrum), each port is written as soon as it has been
+        read from the device while the rest are still arriving."""
+        output = io.StringIO()
+
+        def on_port (scan, port, spectrum):
+            if not output.tell():
+                write_scan_start(output, scan)
+            if instance & (1 << port):
+                write_port(output, port, spectrum)
+
+        method = getattr(worker.device, method_name)
+        scan = None
+        if instance != ALL_PORTS and max_age is not None and worker.scheduler is not None:
+            # A new enough background scan of all ports has the ports already.
+            scan = worker.scheduler.get_latest(worker.method_key(method, ALL_PORTS, True), max_age)
+            if scan is not None:
+                for port, spectrum in scan.result:
+                    on_port(scan, port, spectrum)
+        if scan is None:
+            stream = (getattr(worker.device, method_name.replace("get_", "iter_", 1)), on_port)
+            scan = self._run_scan_method(rpc, worker, max_age, method, instance, True, stream=stream)
+        if not output.tell():
+            write_scan_start(output, scan)
+        write_scan_end(output)
+        return self._scan_reply(output)
+
+    def _rpc_get_worker (self, rpc, params):
+        "Return the DeviceWorker named by the device parameter, optional if there is only one"
+        for param in params:
+            if ncutil.filter_tag_match("device", param.tag):
+                name = param.text.strip() if param.text else ""
+                if name not in self.workers:
+                    raise ncerror.RPCSvrBadElement(rpc, param, message="unknown device " + name)
+                return self.workers[name]
+        if self.multi_device:
+            raise ncerror.RPCSvrMissingElement(rpc, "device")
+        return next(iter(self.workers.values()))
+
+    @staticmethod
+    def _scan_reply (output):
+        """Return the reply of a scan written to output, it's sent as the text
+        rather than parsed into a tree only to be serialized again."""
+        return TextReply(output.getvalue())
+
+    def _rpc_check_params (self, rpc, params, allowed):
+        for param in params:
+            if etree.QName(param.tag).localname not in allowed:
+                logging.error("%s: unexpected rpc parameter %s", str(self), str(param.tag))
+                raise ncerror.RPCSvrErrBadMsg(rpc)
+
+    def _rpc_param_get_uint (self, rpc, tag, default, params):
+        for param in params:
+            if ncutil.filter_tag_match(tag, param.tag):
+                try:
+                    value = int(param.text.strip())
+                    if value < 0:
+                        raise ValueError()
+                    return value
+                except (AttributeError, ValueError):
+                    raise ncerror.RPCSvrBadElement(rpc, param, message="invalid unsigned value for " + tag)
+        return default
+
+    def _rpc_param_get_instance (self, rpc, worker, params):
+        "Return the instance bitmap of the port-index parameters, all ports if none are given"
+        instance = 0
+        for param in params:
+            if ncutil.filter_tag_match("port-index", param.tag):
+                try:
+                    port = int(param.text.strip())
+                    if not 0 <= port < worker.nports:
+                        raise ValueError()
+                except (AttributeError, ValueError):
+                    raise ncerror.RPCSvrBadElement(rpc, param, message="invalid port-index")
+                instance |= 1 << port
+        return instance if instance else ALL_PORTS
+
+    def _rpc_param_get_enum (self, rpc, tag, default, allowed, params):
+        for param in params:
+            if ncutil.filter_tag_match(tag, param.tag):
+                value = param.text.strip() if param.text else ""
+                if value not in allowed:
+                    raise ncerror.RPCSvrBadElement(rpc, param, message="invalid value for " + tag)
+                return value
+        return default
+
+    def _rpc_param_get_timestamp (self, rpc, tag, params):
+        for param in params:
+            if ncutil.filter_tag_match(tag, param.tag):
+                try:
+                    return parse_timestamp(param.text.strip())
+                except (AttributeError, ValueError):
+                    raise ncerror.RPCSvrBadElement(rpc, param, message="invalid UTC date-and-time for " + tag)
+        return None
+
+    def _rpc_param_get_channels (self, rpc, params):
+        "Return the (centre, width) list of the channel parameters"
+        channels = []
+        for param in params:
+            if not ncutil.filter_tag_match("channel", param.tag):
+                continue
+            centre, width = None, 50.0
+            for elm in param:
+                tag = etree.QName(elm.tag).localname
+                if tag not in ("centre-frequency", "width"):
+                    raise ncerror.RPCSvrBadElement(rpc, elm, message="unexpected channel parameter")
+                try:
+                    value = float(elm.text.strip())
+                    if not value > 0:
+                        raise ValueError()
+                except (AttributeError, ValueError):
+                    raise ncerror.RPCSvrBadElement(rpc, elm, message="invalid value for " + tag)
+                if tag == "width":
+                    width = value
+                else:
+                    centre = value
+            if centre is None:
+                raise ncerror.RPCSvrMissingElement(rpc, "centre-frequency")
+            channels.append((centre, width))
+        return channels
 
     def _rpc_param_get_frequency (self, rpc, params):
         for param in params:
-            if ncutil.filter_tag_match("j:frequency", param.tag):
+            if ncutil.filter_tag_match("frequency", param.tag):
                 break
         else:
-            raise ncerror.RPCSvrMissingElement(rpc, ncutil.elm("j:frequency"))
+            raise ncerror.RPCSvrMissingElement(rpc, "frequency")
 
-        freq = param.strip()
         try:
-            freq = int(freq.text)
-            if not (190000 <= freq <= 198000):
-                raise ncerror.RPCSvrBadElement(rpc, freq, message="Frequency not in range [190000, 198000]")
-        except ValueError:
-            raise ncerror.RPCSvrBadElement(rpc, freq, message="Frequency not an integer")
+            freq = int(param.text.strip())
+        except (AttributeError, ValueError):
+            raise ncerror.RPCSvrBadElement(rpc, param, message="Frequency not an integer")
+        if not (190000 <= freq <= 198000):
+            raise ncerror.RPCSvrBadElement(rpc, param, message="Frequency not in range [190000, 198000]")
+        return freq
 
     def _rpc_param_get_boolean (self, rpc, tag, default, params):
         for param in params:
@@ -131,63 +799,60 @@ class NetconfServer (object):
 
     def rpc_activate (self, unused, rpc, *params):
         # Input values
-        if params:
-            raise ncerror.RPCSvrErrBadMsg(rpc)
+        self._rpc_check_params(rpc, params, [ "device" ])
+        worker = self._rpc_get_worker(rpc, params)
 
-        self._run_device_method(rpc, self.device.activate)
+        self._run_device_method(rpc, worker, worker.device.activate)
         return ncutil.elm("ok")
 
     def rpc_self_test (self, unused, rpc, *params):
         # Input values
-        if params:
-            raise ncerror.RPCSvrErrBadMsg(rpc)
+        self._rpc_check_params(rpc, params, [ "device" ])
+        worker = self._rpc_get_worker(rpc, params)
 
-        self._run_device_method(rpc, self.device.self_test)
+        self._run_device_method(rpc, worker, worker.device.self_test)
         return ncutil.elm("ok")
 
     def rpc_reset (self, unused, rpc, *params):
         # Input values
-        if params:
-            raise ncerror.RPCSvrErrBadMsg(rpc)
+        self._rpc_check_params(rpc, params, [ "device" ])
+        worker = self._rpc_get_worker(rpc, params)
 
-        self._run_device_method(rpc, self.device.reset)
+        self._run_device_method(rpc, worker, worker.device.reset)
         return ncutil.elm("ok")
 
     def rpc_frequency_power (self, unused, rpc, *params):
-        if len(params) > 1:
-            # XXX need a function to look for unknown elements and raise exc for those.
-            # XXX really need a better error for not handled params
-            raise ncerror.RPCSvrInvalidValue(rpc, message="Too many parameter")
+        self._rpc_check_params(rpc, params, [ "frequency", "device" ])
+        worker = self._rpc_get_worker(rpc, params)
 
         freq = self._rpc_param_get_frequency(rpc, params)
-        power = self._run_device_method(rpc, self.device.get_freq_power, freq)
+        power = self._run_device_method(rpc, worker, worker.device.get_freq_power, freq)
         result = ncutil.elm("data")
         result.append(ncutil.leaf_elm("j:power", "{:.2f}".format(power.dBm)))
         return result
 
     def rpc_full_itu_scan (self, unused_session, rpc, *params):
-        # No input values yet
         try:
-            if len(params) > 2:
-                raise ncerror.RPCSvrInvalidValue(rpc, message="Too many parameters")
+            self._rpc_check_params(rpc, params, [ "high-resolution", "detect-presence", "max-age", "device" ])
+            worker = self._rpc_get_worker(rpc, params)
             # XXX Should be able to use "j:high-resolution" but it fails
             hires = self._rpc_param_get_boolean(rpc, "high-resolution", False, params)
             power_only = not self._rpc_param_get_boolean(rpc, "detect-presence", False, params)
-            if power_only:
-                points = self._run_device_method(rpc, self.device.get_itu_power_scan, hires)
-            else:
-                points = self._run_device_method(rpc, self.device.get_itu_scan, hires)
-
-            result = ncutil.elm("data")
-            for tup in points:
-                ptelm = ncutil.subelm(result, "j:point")
-                ptelm.append(ncutil.leaf_elm("j:frequency", tup[0]))
-                if power_only:
-                    ptelm.append(ncutil.leaf_elm("j:power", "{:.2f}".format(tup[1].dBm)))
-                else:
-                    ptelm.append(ncutil.leaf_elm("j:power", "{:.2f}".format(tup[2].dBm)))
-                    ptelm.append(ncutil.leaf_elm("j:channel-presence", tup[1]))
-            return result
+            max_age = self._rpc_param_get_uint(rpc, "max-age", None, params)
+            scan = None
+            if power_only and max_age is not None and worker.scheduler is not None:
+                # Only the scan with presence is scheduled, it has the powers too.
+                key = worker.method_key(worker.device.get_itu_scan, hires)
+                scan = worker.scheduler.get_latest(key, max_age)
+            if scan is None:
+                method = worker.device.get_itu_power_scan if power_only else worker.device.get_itu_scan
+                scan = self._run_scan_method(rpc, worker, max_age, method, hires)
+
+            output = io.StringIO()
+            write_scan_start(output, scan)
+            write_itu_points(output, scan.result, power_only)
+            write_scan_end(output)
+            return self._scan_reply(output)
         except jerror.OCMError as ocmerr:
             logger.error("Got OCM error in full itu scan: %s: %s", str(ocmerr),
                          traceback.format_exc())
@@ -196,34 +861,135 @@ class NetconfServer (object):
                          traceback.format_exc())
             raise
 
-    def _rpc_full_scan (self, method, rpc, *params):
-        # No input values yet
-        if params:
-            logging.error("%s: _rpc_full_scan got unexpected params", str(self))
-            raise ncerror.RPCSvrErrBadMsg(rpc)
+    def _rpc_full_scan (self, method_name, rpc, *params):
+        self._rpc_check_params(rpc, params, [ "max-age", "port-index", "device" ])
+        worker = self._rpc_get_worker(rpc, params)
+        max_age = self._rpc_param_get_uint(rpc, "max-age", None, params)
+        instance = self._rpc_param_get_instance(rpc, worker, params)
 
-        rv = self._run_device_method(rpc, method)
-
-        result = ncutil.elm("data")
-        for port, points in rv:
-            portelm = ncutil.elm("j:port")
-            result.append(portelm)
-            portelm.append(ncutil.leaf_elm("j:port-index", port))
-            for freq, power in points:
-                ptelm = ncutil.subelm(portelm, "j:point")
-                ptelm.append(ncutil.leaf_elm("j:frequency", freq))
-                ptelm.append(ncutil.leaf_elm("j:power", "{:.2f}".format(power.dBm)))
-        return result
+        return self._run_port_scan(rpc, worker, max_age, method_name, instance, write_port_spectrum)
 
     def rpc_full_scan (self, unused_session, rpc, *params):
-        return self._rpc_full_scan(self.device.get_full_scan, rpc, *params)
-    # No input values yet
-        if params:
-            raise ncerror.RPCSvrErrBadMsg(rpc)
-
+        return self._rpc_full_scan("get_full_scan", rpc, *params)
 
     def rpc_full_125_scan (self, unused_session, rpc, *params):
-        return self._rpc_full_scan(self.device.get_full_125_scan, rpc, *params)
+        return self._rpc_full_scan("get_full_125_scan", rpc, *params)
+
+    def rpc_packed_scan (self, unused_session, rpc, *params):
+        self._rpc_check_params(rpc, params, [ "scan-type", "max-age", "port-index", "device" ])
+        worker = self._rpc_get_worker(rpc, params)
+        methods = {
+            "full": "get_full_scan",
+            "full-125": "get_full_125_scan",
+        }
+        scan_type = self._rpc_param_get_enum(rpc, "scan-type", "full", methods, params)
+        max_age = self._rpc_param_get_uint(rpc, "max-age", None, params)
+        instance = self._rpc_param_get_instance(rpc, worker, params)
+
+        # Same key as the XML scans so background and in flight scans are shared.
+        return self._run_port_scan(rpc, worker, max_age, methods[scan_type], instance, write_port_packed)
+
+    def rpc_channel_power (self, unused_session, rpc, *params):
+        self._rpc_check_params(rpc, params, [ "max-age", "port-index", "profile-index", "channel", "device" ])
+        worker = self._rpc_get_worker(rpc, params)
+        if worker.is_tfm:
+            raise ncerror.RPCServerError(rpc, ncerror.RPCERR_TYPE_APPLICATION,
+                                         ncerror.RPCERR_TAG_OPERATION_NOT_SUPPORTED,
+                                         message="channel-power requires a 4 port OCM")
+        max_age = self._rpc_param_get_uint(rpc, "max-age", None, params)
+        instance = self._rpc_param_get_instance(rpc, worker, params)
+        profile_id = self._rpc_param_get_uint(rpc, "profile-index", None, params)
+        channels = self._rpc_param_get_channels(rpc, params)
+        if profile_id is not None:
+            if channels or not 1 <= profile_id <= 16:
+                raise ncerror.RPCSvrInvalidValue(rpc, message="profile-index must be 1 to 16 and without channels")
+            profile = self._run_device_method(rpc, worker, worker.device.get_channel_profile, profile_id)
+            channels = profile_channels(profile)
+            if not channels:
+                raise ncerror.RPCSvrInvalidValue(rpc, message="profile has no channels")
+        elif not channels:
+            raise ncerror.RPCSvrMissingElement(rpc, "channel")
+        centres, widths = [ list(x) for x in zip(*channels) ]
+
+        def write_port (output, port, spectrum):
+            write_port_channels(output, port, centres, widths, channel_powers(spectrum, centres, widths))
+
+        # Same key as full-125-scan so background and in flight scans are shared.
+        return self._run_port_scan(rpc, worker, max_age, "get_full_125_scan", instance, write_port)
+
+    def rpc_create_subscription (self, session, rpc, *params):
+        self._rpc_check_params(rpc, params, [ "stream", "filter", "startTime", "stopTime" ])
+        if self.notifications is None:
+            raise ncerror.RPCServerError(rpc, ncerror.RPCERR_TYPE_APPLICATION,
+                                         ncerror.RPCERR_TAG_OPERATION_NOT_SUPPORTED,
+                                         message="Change notifications are not enabled")
+        for param in params:
+            tag = etree.QName(param.tag).localname
+            if tag == "stream" and (param.text or "").strip() != NOTIFICATION_STREAM:
+                raise ncerror.RPCSvrBadElement(rpc, param, message="unknown stream")
+            elif tag in ("filter", "startTime"):
+                # There is no replay, and the notifications are already only of changes.
+                raise ncerror.RPCServerError(rpc, ncerror.RPCERR_TYPE_PROTOCOL,
+                                             ncerror.RPCERR_TAG_OPERATION_NOT_SUPPORTED,
+                                             message=tag + " is not supported")
+        stop_time = self._rpc_param_get_timestamp(rpc, "stopTime", params)
+        if self.notifications.is_subscribed(session):
+            raise ncerror.RPCServerError(rpc, ncerror.RPCERR_TYPE_PROTOCOL, ncerror.RPCERR_TAG_IN_USE,
+                                         message="Session already has a subscription")
+        # Notifications start once the ok has been sent.
+        session.call_after_reply(lambda: self.notifications.subscribe(session, stop_time))
+        return ncutil.elm("ok")
+
+    def rpc_scan_history (self, unused_session, rpc, *params):
+        self._rpc_check_params(rpc, params, [ "scan-type", "port-index", "start-time", "end-time", "duration",
+                                              "interval", "device" ])
+        worker = self._rpc_get_worker(rpc, params)
+        history = worker.device.history
+        if history is None:
+            raise ncerror.RPCServerError(rpc, ncerror.RPCERR_TYPE_APPLICATION,
+                                         ncerror.RPCERR_TAG_OPERATION_NOT_SUPPORTED,
+                                         message="Scan history is not enabled for " + worker.name)
+        scan_type = self._rpc_param_get_enum(rpc, "scan-type", history.kinds[0], history.kinds, params)
+        instance = self._rpc_param_get_instance(rpc, worker, params)
+        start = self._rpc_param_get_timestamp(rpc, "start-time", params)
+        end = self._rpc_param_get_timestamp(rpc, "end-time", params)
+        duration = self._rpc_param_get_uint(rpc, "duration", None, params)
+        if duration is not None and start is None:
+            start = (end if end is not None else time.time()) - duration
+        interval = self._rpc_param_get_uint(rpc, "interval", None, params)
+        if interval == 0:
+            raise ncerror.RPCSvrInvalidValue(rpc, message="interval must be at least 1 second")
+
+        output = io.StringIO()
+        output.write("<data xmlns:j=\"{}\">".format(NSMAP["j"]))
+        for port in range(0, worker.nports):
+            if not instance & (1 << port):
+                continue
+            if interval is None:
+                window = history.get_window(scan_type, port, start, end)
+                if window is None:
+                    continue
+                frequency, tap_gain, timestamps, powers = window
+                columns = [ ("power-data", powers) ]
+            else:
+                window = history.aggregate(scan_type, port, interval, start, end)
+                if window is None:
+                    continue
+                frequency, tap_gain, timestamps, counts, minimums, means, maximums = window
+                columns = [ ("count", counts.tolist()),
+                            ("min-power-data", minimums),
+                            ("mean-power-data", means),
+                            ("max-power-data", maximums) ]
+            write_history_port(output, port, frequency, tap_gain, timestamps, columns)
+        output.write("</data>")
+        return self._scan_reply(output)
+
+    @staticmethod
+    def _filter_find (filter_elm, tag):
+        found = filter_elm.find(tag)
+        if found is None:
+            found = filter_elm.find("j:" + tag, namespaces=NSMAP)
+        return found
 
     def rpc_get_config (self, unused_session, rpc, source_elm, unused_filter_elm):
         assert source_elm is not None
@@ -231,43 +997,79 @@ class NetconfServer (object):
             raise ncerror.RPCSvrMissingElement(rpc, ncutil.elm("nc:running"))
 
         config = ncutil.elm("data")
+        if not self.multi_device:
+            self._get_device_config(rpc, next(iter(self.workers.values())), config)
+            return config
 
-        if self.is_tfm:
+        for name, worker in self.workers.items():
+            device_elm = ncutil.subelm(config, "j:device")
+            device_elm.append(ncutil.leaf_elm("j:name", name))
+            self._get_device_config(rpc, worker, device_elm)
+        return config
+
+    def _get_device_config (self, rpc, worker, config):
+        if worker.is_tfm:
             profile_elm = ncutil.elm("j:scan-profile")
             config.append(profile_elm)
+            device = worker.device
             profile_elm.append(ncutil.leaf_elm("j:channel-spacing",
-                                               self.device.get_channel_spacing()))
+                                               self._run_device_method(rpc, worker, device.get_channel_spacing)))
             profile_elm.append(ncutil.leaf_elm("j:frequency-start",
-                                               self.device.get_start_freq()))
+                                               self._run_device_method(rpc, worker, device.get_start_freq)))
             profile_elm.append(ncutil.leaf_elm("j:frequency-end",
-                                               self.device.get_stop_freq()))
+                                               self._run_device_method(rpc, worker, device.get_stop_freq)))
         else:
-            for idx in range(1, 17):
+            profiles = self._run_device_method(rpc, worker, worker.device.get_channel_profiles, range(1, 17))
+            for idx, channels in enumerate(profiles, 1):
                 profile_elm = ncutil.elm("j:channel-profile")
                 config.append(profile_elm)
                 profile_elm.append(ncutil.leaf_elm("j:profile-index", idx))
 
-                channels = self.device.get_channel_profile(idx)
                 for freqs, freqe in channels:
                     channel_elm = ncutil.subelm(profile_elm, "j:channel")
                     range_elm = ncutil.subelm(channel_elm, "j:range")
                     range_elm.append(ncutil.leaf_elm("j:frequency-start", freqs))
                     range_elm.append(ncutil.leaf_elm("j:frequency-end", freqe))
-        return config
 
     def rpc_get (self, unused_session, unused_rpc, filter_elm):
         data = ncutil.elm("data")
+        if not self.multi_device:
+            return self._get_device_info(next(iter(self.workers.values())), filter_elm, data)
 
+        # Each device's info is under its entry in the device list.
+        fdevice = None
+        if filter_elm is not None and filter_elm.getchildren():
+            fdevice = self._filter_find(filter_elm, "device")
+            if fdevice is None:
+                return data
+
+        for name, worker in self.workers.items():
+            finfo_parent = None
+            if fdevice is not None:
+                fname = self._filter_find(fdevice, "name")
+                if fname is not None and fname.text and fname.text.strip() != name:
+                    continue
+                if [ felm for felm in fdevice.getchildren() if felm is not fname ]:
+                    finfo_parent = fdevice
+            device_elm = ncutil.subelm(data, "j:device")
+            device_elm.append(ncutil.leaf_elm("j:name", name))
+            self._get_device_info(worker, finfo_parent, device_elm)
+        return data
+
+    def _get_device_info (self, worker, filter_elm, data):
+        device = worker.device
         get_data_methods = {
-            ncutil.qname("j:ocm-type").text: self.device.get_device_type,
-            ncutil.qname("j:oper-mode").text: self.device.get_oper_mode,
-            ncutil.qname("j:ident-data").text: self.device.get_idn_string,
-            ncutil.qname("j:device-info").text: self.device.get_module_info,
-            ncutil.qname("j:application-version").text: self.device.get_app_version,
-            ncutil.qname("j:temp").text: self.device.get_temp_int,
+            ncutil.qname("j:ocm-type").text: device.get_device_type,
+            ncutil.qname("j:oper-mode").text: device.get_oper_mode,
+            ncutil.qname("j:ident-data").text: device.get_idn_string,
+            ncutil.qname("j:device-info").text: device.get_module_info,
+            ncutil.qname("j:application-version").text: device.get_app_version,
+            ncutil.qname("j:temp").text: device.get_temp_int,
+            ncutil.qname("j:cache-hits").text: lambda: device.cache_hits,
+            ncutil.qname("j:cache-misses").text: lambda: device.cache_misses,
         }
-        if not self.device.get_device_type().startswith("tf"):
-            get_data_methods[ncutil.qname("j:safe-version").text] = self.device.get_safe_version
+        if not device.get_device_type().startswith("tf"):
+            get_data_methods[ncutil.qname("j:safe-version").text] = device.get_safe_version
 
         infonode = ncutil.elm("j:info")
         # infonode = etree.Element(ncutil.qname("j:info"), nsmap={ 'j': NSMAP['j'] })
@@ -280,26 +1082,38 @@ class NetconfServer (object):
         def get_all_values ():
             leaf_elms = []
             for key, valuef in get_data_methods.items():
-                leaf_elms.append(ncutil.leaf_elm(key, valuef()))
+                leaf_elms.append(ncutil.leaf_elm(key, worker.run_method(valuef)))
             return leaf_elms
 
-        # No filter children return info only
+        # No filter children return info and statistics
         if not children:
             ncutil.filter_leaf_values(None, infonode, get_all_values(), data)
+            data.append(statistics_elm(device.stats))
             return data
 
+        # Look for statistics filter, selecting commands by name.
+        fstats = self._filter_find(filter_elm, "statistics")
+        if fstats is not None:
+            cmdnames = set()
+            for fcmd in fstats.getchildren():
+                fname = self._filter_find(fcmd, "name")
+                if fname is not None and fname.text and fname.text.strip():
+                    cmdnames.add(fname.text.strip())
+            data.append(statistics_elm(device.stats, cmdnames))
+
         # Look for info filter.
-        finfo = filter_elm.find("info") or filter_elm.find("j:info", namespaces=NSMAP)
+        rv = None
+        finfo = self._filter_find(filter_elm, "info")
         if finfo is not None:
             children = finfo.getchildren()
             if not children:
-                leaf_elms = get_all_values()
+                rv = ncutil.filter_leaf_values(None, infonode, get_all_values(), data)
             else:
                 leaf_elms = []
                 for felm in children:
                     tag = felm.tag
                     if tag in get_data_methods:
-                        leaf_elms.append(ncutil.leaf_elm(tag, get_data_methods[tag]()))
+                        leaf_elms.append(ncutil.leaf_elm(tag, worker.run_method(get_data_methods[tag])))
                         rv = ncutil.filter_leaf_values(finfo, infonode, leaf_elms, data)
                         # Some selector doesn't match return empty.
             if rv is False:
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import collections
+import logging
+import random
+import struct
+import threading
+import time
+from opticalutil.dwdm import frequency_to_wavelen_precise
+import jdsuocm.device as device
+import jdsuocm.error as jerror
+
+logger = logging.getLogger(__name__)
+
+SIM_IDN = {
+    "cal04": "JDSU,OCM4,C-Band,hw10,cal04,appfw01.04.02",
+    "cal02": "JDSU,TFOCM,50GHz,hw46,cal02,appfw03.08.94",
+}
+
+# Channel plan of the simulated line, 50GHz ITU grid in GHz.
+SIM_CHANNELS = list(range(191350, 196100 + 1, 50))
+SIM_NOISE_DBM = -60.0                                       # At the tap
+
+# Rough device processing times in seconds, pass as latency for realistic timing.
+REALISTIC_LATENCY = {
+    'FULL-SPECTRUM-SCAN': 0.8,
+    'FULL-12-SCAN': 1.6,
+    'FULL-12-CH-SCAN': 1.8,
+    'SCAN-SPEC-DENSITY': 1.8,
+    'FULL-ITU-SCAN': 0.9,
+    'FULL-ITU-POWER-SCAN': 0.6,
+    'GET-SINGLE-POWER': 0.05,
+    'RESET': 0.5,
+    'START-SELF-TEST': 0.2,
+    'default': 0.005,
+}
+
+
+def _words (fmt, *values):
+    return struct.pack(">" + fmt, *values)
+
+
+def _string_words (value):
+    return struct.pack(">{}H".format(len(value)), *[ ord(x) for x in value ])
+
+
+class OCMSimulator (object):
+    """A simulated OCM behind the send/recv/recv_ready transport interface.
+
+    Command frames written with send() are parsed, checksum verified and
+    answered with checksummed response frames. The response bytes become
+    readable after the command's processing latency and then at the given
+    baudrate (None for no delay). `latency` is either seconds for all commands
+    or a dictionary of seconds by command name with the "default" key used for
+    the rest.
+    """
+
+    def __init__ (self, caltype="cal04", baudrate=None, latency=0, seed=0):
+        assert caltype in SIM_IDN
+        self.caltype = caltype
+        self.byte_time = 10 / baudrate if baudrate else 0       # 8N1 is 10 bits per byte
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.txbuf = bytearray()
+        self.responses = collections.deque()                 # [ first byte time, data, offset ]
+        self.busy_until = 0
+        self.closed = False
+
+        self.commands = dict(device.commands_common)
+        if caltype == "cal04":
+            self.commands.update(device.commands_4port)
+            self.nports = 4
+        else:
+            self.commands.update(device.commands_1port)
+            self.nports = 1
+
+        # Decode table keyed on (command, object, parameter) with instance or None for tagged instances.
+        self.decode = {}
+        for name, cmdinfo in self.commands.items():
+            inst = cmdinfo[2] if cmdinfo[2] >= 0 else None
+            self.decode[(cmdinfo[0], cmdinfo[1], inst, cmdinfo[3])] = name
+
+        self.profiles = {}
+        for profile_id in range(1, 17):
+            self.profiles[profile_id] = [ ((freq * 10) - 125 - device.FULL_SCAN_FREQ_BASE,
+                                           (freq * 10) + 125 - device.FULL_SCAN_FREQ_BASE)
+                                          for freq in SIM_CHANNELS[profile_id - 1::16] ]
+
+        # Per port channel powers at the tap, None if not present.
+        self.channel_power = []
+        for unused in range(self.nports):
+            self.channel_power.append([ self.random.uniform(-38, -30) if self.random.random() < 0.7 else None
+                                        for unused in SIM_CHANNELS ])
+
+    #--------------------
+    # Transport interface
+    #--------------------
+
+    def send (self, data):
+        with self.cond:
+            self.txbuf += data
+            now = time.time() + len(data) * self.byte_time
+            while len(self.txbuf) >= 4:
+                clen = struct.unpack_from(">H", self.txbuf, 2)[0]
+                flen = (clen + 2) * 2
+                if len(self.txbuf) < flen:
+                    break
+                frame = bytes(self.txbuf[:flen])
+                del self.txbuf[:flen]
+                name, response = self._handle_frame(frame)
+                start = max(now, self.busy_until) + self._get_latency(name)
+                self.busy_until = start + len(response) * self.byte_time
+                self.responses.append([ start, response, 0 ])
+            self.cond.notify_all()
+        return len(data)
+
+    def recv_ready (self):
+        with self.lock:
+            return self._available(time.time()) > 0
+
+    def recv (self, nbytes=4096):
+        view = memoryview(bytearray(nbytes))
+        return view[:self.recv_into(view, nbytes)].tobytes()
+
+    def recv_into (self, view, nbytes=0):
+        "Block until data is available and then copy up to nbytes of it into view"
+        if not nbytes:
+            nbytes = len(view)
+        with self.cond:
+            while True:
+                now = time.time()
+                available = self._available(now)
+                if available:
+                    break
+                if self.closed:
+                    return 0
+                if self.responses:
+                    self.cond.wait(max(self._next_byte_time() - now, 0.0001))
+                else:
+                    self.cond.wait()
+
+            count = 0
+            while count < nbytes and self.responses:
+                response = self.responses[0]
+                ready = self._ready_len(response, now) - response[2]
+                if ready <= 0:
+                    break
+                ready = min(ready, nbytes - count)
+                view[count:count + ready] = response[1][response[2]:response[2] + ready]
+                response[2] += ready
+                count += ready
+                if response[2] == len(response[1]):
+                    self.responses.popleft()
+            return count
+
+    def close (self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def _ready_len (self, response, now):
+        if now < response[0]:
+            return 0
+        if not self.byte_time:
+            return len(response[1])
+        return min(len(response[1]), int((now - response[0]) / self.byte_time) + 1)
+
+    def _available (self, now):
+        total = 0
+        for response in self.responses:
+            ready = self._ready_len(response, now) - response[2]
+            if ready <= 0:
+                break
+            total += ready
+        return total
+
+    def _next_byte_time (self):
+        response = self.responses[0]
+        return response[0] + response[2] * self.byte_time
+
+    def _get_latency (self, name):
+        if not isinstance(self.latency, dict):
+            return self.latency
+        return self.latency.get(name, self.latency.get("default", 0))
+
+    #-------------------
+    # Command processing
+    #-------------------
+
+    def _handle_frame (self, frame):
+        words = struct.unpack(">{}H".format(len(frame) // 2), frame)
+        if len(words) < device.MINCMDLEN + 2:
+            # Too short for a command, answered as a bad frame.
+            return None, self._response(words[0], jerror.EFRAMECKSUM)
+        msgid, unused_clen, cmd, obj, inst, param = words[:6]
+        if (sum(words[:-1]) & 0xFFFF) != words[-1]:
+            return None, self._response(msgid, jerror.EFRAMECKSUM)
+        name = self.decode.get((cmd, obj, inst, param))
+        if name is None:
+            name = self.decode.get((cmd, obj, None, param))
+        if name is None:
+            return None, self._response(msgid, jerror.EBADCMD)
+
+        handler = getattr(self, "_cmd_" + name.lower().replace("-", "_"), None)
+        if handler is None:
+            handler = self._cmd_no_data
+        try:
+            result, data = handler(inst, frame[12:-2])
+        except (AssertionError, KeyError, struct.error):
+            result, data = jerror.EVALRANGE, b""
+        return name, self._response(msgid, result, data)
+
+    @staticmethod
+    def _response (msgid, result, data=b""):
+        mlen = len(data) // 2 + 2
+        cksum = msgid + mlen + result
+        if data:
+            cksum += sum(struct.unpack(">{}H".format(len(data) // 2), data))
+        return struct.pack(">HHH", msgid, mlen, result) + data + struct.pack(">H", cksum & 0xFFFF)
+
+    def _instance_ports (self, inst):
+        for bits, value in device.instance_map_4port.items():
+            if value == inst:
+                return device.instance_to_ports(bits)
+        raise KeyError(inst)
+
+    def _tap_dbm (self, port, freq):
+        "Power in dBm at the tap of `port` for frequency `freq` in GHz"
+        power = SIM_NOISE_DBM
+        idx = int(round((freq - SIM_CHANNELS[0]) / 50))
+        if 0 <= idx < len(SIM_CHANNELS) and self.channel_power[port][idx] is not None:
+            offset = abs(freq - SIM_CHANNELS[idx])
+            if offset <= 18.75:
+                power = max(power, self.channel_power[port][idx] - (offset / 6.25) ** 2 * 1.5)
+        return power + self.random.uniform(-0.05, 0.05)
+
+    def _cmd_no_data (self, unused_inst, unused_data):
+        return jerror.ENOERR, b""
+
+    def _cmd_get_idn_msg (self, unused_inst, unused_data):
+        return jerror.ENOERR, _string_words(SIM_IDN[self.caltype])
+
+    def _cmd_get_module_temp (self, unused_inst, unused_data):
+        return jerror.ENOERR, _words("H", 350 + self.random.randint(-5, 5))
+
+    def _cmd_read_fail_reg (self, unused_inst, unused_data):
+        return jerror.ENOERR, _words("H", 0)
+
+    def _cmd_read_fail_reg_temp (self, unused_inst, unused_data):
+        return jerror.ENOERR, _words("HH", 0, 350)
+
+    def _cmd_get_app_version (self, unused_inst, unused_data):
+        return jerror.ENOERR, _words("3H", 1, 4, 2)
+
+    def _cmd_get_safe_version (self, unused_inst, unused_data):
+        return jerror.ENOERR, _words("3H", 1, 0, 7)
+
+    def _cmd_get_calib_version (self, unused_inst, unused_data):
+        return jerror.ENOERR, _words("3H", 2, 1, 0)
+
+    def _cmd_get_module_info (self, unused_inst, unused_data):
+        return jerror.ENOERR, _string_words("SIMULATED-OCM\0\0\0")
+
+    def _cmd_read_prev_cmd (self, unused_inst, unused_data):
+        # RESP_11W counts the checksum word, so 10 data words.
+        return jerror.ENOERR, _words("10H", *([ 0 ] * 10))
+
+    def _cmd_read_profile (self, inst, unused_data):
+        channels = self.profiles[inst]
+        freqs = [ freq for channel in channels for freq in channel ]
+        return jerror.ENOERR, _words("H{}H".format(len(freqs)), len(channels), *freqs)
+
+    def _cmd_set_profile (self, inst, data):
+        nchan = struct.unpack_from(">H", data)[0]
+        freqs = struct.unpack_from(">{}H".format(nchan * 2), data, 2)
+        self.profiles[inst] = list(zip(freqs[::2], freqs[1::2]))
+        return jerror.ENOERR, b""
+
+    def _cmd_full_spectrum_scan (self, inst, unused_data):
+        ports = self._instance_ports(inst)
+        data = [ _words("H", len(ports)) ]
+        for port in ports:
+            npoints = len(SIM_CHANNELS)
+            points = []
+            for freq in SIM_CHANNELS:
+                points.append(freq * 10 - device.FULL_SCAN_FREQ_BASE)
+                points.append(int(round(self._tap_dbm(port, freq) * 100)))
+            data.append(_words("H" + "Hh" * npoints, npoints, *points))
+        return jerror.ENOERR, b"".join(data)
+
+    def _cmd_full_12_scan (self, inst, unused_data):
+        ports = self._instance_ports(inst)
+        npoints = device.FULL_125_NPOINTS
+        data = [ _words("H", len(ports)) ]
+        for port in ports:
+            powers = [ int(round(self._tap_dbm(port, device.FULL_125_START_FREQ + device.FULL_125_STEP_FREQ * x) * 100))
+                       for x in range(npoints) ]
+            data.append(_words("H{}h".format(npoints), npoints, *powers))
+        return jerror.ENOERR, b"".join(data)
+
+    def _cmd_full_12_ch_scan (self, inst, unused_data):
+        ports = self._instance_ports(inst)
+        data = [ _words("H", len(ports)) ]
+        full125 = self._cmd_full_12_scan(inst, b"")[1]
+        offset = 2
+        for port in ports:
+            chans = []
+            for idx, freq in enumerate(SIM_CHANNELS):
+                present = self.channel_power[port][idx] is not None
+                chans.extend([ freq * 10 - device.FULL_SCAN_FREQ_BASE,
+                               int(round(self._tap_dbm(port, freq) * 100)),
+                               1 if present else 0 ])
+            data.append(_words("H" + "HhH" * len(SIM_CHANNELS), len(SIM_CHANNELS), *chans))
+            plen = 2 + device.FULL_125_NPOINTS * 2
+            data.append(full125[offset:offset + plen])
+            offset += plen
+        return jerror.ENOERR, b"".join(data)
+
+    def _cmd_scan_spec_density (self, inst, unused_data):
+        ports = self._instance_ports(inst)
+        data = [ _words("H", len(ports)) ]
+        for port in ports:
+            points = []
+            for freq in SIM_CHANNELS:
+                avg = self._tap_dbm(port, freq)
+                points.extend([ freq * 10 - device.FULL_SCAN_FREQ_BASE,
+                                int(round(avg * 100)),
+                                int(round((avg + self.random.uniform(0, 0.5)) * 100)) ])
+            data.append(_words("H" + "Hhh" * len(SIM_CHANNELS), len(SIM_CHANNELS), *points))
+        return jerror.ENOERR, b"".join(data)
+
+    def _itu_freqs (self):
+        return range(device.TFOCM_DEFAULT_START_FREQ, device.TFOCM_DEFAULT_STOP_FREQ, 50)
+
+    def _itu_powers (self, scale):
+        return [ int(round((self._tap_dbm(0, freq) + 20) * scale)) for freq in self._itu_freqs() ]
+
+    def _cmd_full_itu_scan (self, unused_inst, data):
+        hires = struct.unpack(">H", data[:2])[0] == 2
+        wavelens = [ frequency_to_wavelen_precise(freq) for freq in self._itu_freqs() ]
+        if hires:
+            freqwords = []
+            for wavelen in wavelens:
+                val = int(wavelen * 1000)
+                freqwords.extend([ (val >> 16) & 0xFFFF, val & 0xFFFF ])
+        else:
+            freqwords = [ int(round((wavelen - 1500.0) * 100)) for wavelen in wavelens ]
+        presence = [ 1 if power > SIM_NOISE_DBM + 30 else 0 for power in self._itu_powers(1) ]
+        powers = self._itu_powers(100 if hires else 10)
+        return jerror.ENOERR, (_words("{}H".format(len(freqwords)), *freqwords) +
+                               _words("{}H".format(len(presence)), *presence) +
+                               _words("{}h".format(len(powers)), *powers))
+
+    def _cmd_full_itu_power_scan (self, unused_inst, data):
+        hires = struct.unpack(">H", data[:2])[0] == 2
+        powers = self._itu_powers(100 if hires else 10)
+        return jerror.ENOERR, _words("{}h".format(len(powers)), *powers)
+
+    def _cmd_get_single_power (self, unused_inst, data):
+        unused_mode, msw, lsw, resolution = struct.unpack(">HHHH", data)
+        wavelen = ((msw << 16) + lsw) / 1000
+        freq = 299792458 / wavelen
+        # High resolution (2) is in 0.01dB like the high resolution ITU scans, otherwise 0.1dB.
+        scale = 100 if resolution == 2 else 10
+        return jerror.ENOERR, _words("h", int(round((self._tap_dbm(0, freq) + 20) * scale)))
+
+    def _cmd_get_raw_power_data (self, unused_inst, unused_data):
+        return jerror.ENOERR, _words("512h", *[ int(SIM_NOISE_DBM * 100) ] * 512)
+
+    def _cmd_get_start_freq (self, unused_inst, unused_data):
+        return jerror.ENOERR, _words("L", device.TFOCM_DEFAULT_START_FREQ)
+
+    def _cmd_get_stop_freq (self, unused_inst, unused_data):
+        return jerror.ENOERR, _words("L", device.TFOCM_DEFAULT_STOP_FREQ)
+
+    def _cmd_get_chan_spacing (self, unused_inst, unused_data):
+        return jerror.ENOERR, _words("H", 50)
+
+
+class SimulatedOCM (device.OCM):
+    "An OCM driver attached to an OCMSimulator rather than a real device"
+
+    def __init__ (self, caltype="cal04", baudrate=None, latency=0, seed=0, debug=False,
+                  cache_ttl=device.DEFAULT_CACHE_TTL, pipeline_window=device.DEFAULT_PIPELINE_WINDOW,
+                  read_retries=device.DEFAULT_READ_RETRIES):
+        self.simulator = OCMSimulator(caltype, baudrate, latency, seed)
+        super(SimulatedOCM, self).__init__(self.simulator,
+                                           debug=debug,
+                                           cache_ttl=cache_ttl,
+                                           pipeline_window=pipeline_window,
+                                           read_retries=read_retries)
+
+
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
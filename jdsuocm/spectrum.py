@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import struct
+from opticalutil.power import Power
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TAP_GAIN = 20                                               # Tap is 1% so add 20dB
+POWER_SCALE = 100                                           # OCM power words are in 0.01dBm
+
+
+def _tolist (values):
+    try:
+        return values.tolist()
+    except AttributeError:
+        return values
+
+
+class Spectrum (object):
+    """The power spectrum of a single OCM port.
+
+    The frequencies and powers (in dBm, tap gain already applied) are kept as
+    arrays, numpy arrays if numpy is available otherwise lists. Power objects are
+    only created when the spectrum is iterated, iterating yields the same
+    (frequency, power) tuples as the list based scan API.
+    """
+    __slots__ = [ "frequency", "dbm" ]
+
+    def __init__ (self, frequency, dbm):
+        assert len(frequency) == len(dbm)
+        self.frequency = frequency
+        self.dbm = dbm
+
+    def __len__ (self):
+        return len(self.dbm)
+
+    def __iter__ (self):
+        for freq, dbm in zip(_tolist(self.frequency), _tolist(self.dbm)):
+            yield freq, Power(dbm)
+
+    def __getitem__ (self, idx):
+        return _tolist(self.frequency[idx]), Power(_tolist(self.dbm[idx]))
+
+    def __repr__ (self):
+        return "Spectrum({} points)".format(len(self))
+
+    def points (self):
+        "Return the spectrum as a list of (frequency, power) tuples"
+        return list(self)
+
+    def tolists (self):
+        "Return the frequencies and dBm values as python lists"
+        return _tolist(self.frequency), _tolist(self.dbm)
+
+    def get_step (self):
+        "Return the frequency step if the frequencies are evenly spaced otherwise None"
+        frequency = _tolist(self.frequency)
+        if len(frequency) < 2:
+            return 0
+        step = frequency[1] - frequency[0]
+        for idx in range(2, len(frequency)):
+            if frequency[idx] - frequency[idx - 1] != step:
+                return None
+        return step
+
+    def pack_power (self, tap_gain=TAP_GAIN):
+        "Return the powers as big-endian int16 words of 0.01dBm less tap_gain, i.e., as the OCM sends them"
+        if np is not None:
+            words = np.round((np.asarray(self.dbm) - tap_gain) * POWER_SCALE)
+            return words.astype(">i2").tobytes()
+        words = [ int(round((x - tap_gain) * POWER_SCALE)) for x in self.dbm ]
+        return struct.pack(">{}h".format(len(words)), *words)
+
+    def pack_frequency (self):
+        "Return the frequencies as big-endian uint16 offsets from the first frequency"
+        frequency = _tolist(self.frequency)
+        if not frequency:
+            return b""
+        start = frequency[0]
+        return struct.pack(">{}H".format(len(frequency)), *[ int(x - start) for x in frequency ])
+
+    @classmethod
+    def from_packed (cls, start, step, power_data, tap_gain=TAP_GAIN, frequency_data=None):
+        "Create a Spectrum from pack_power() data and either a frequency step or pack_frequency() data"
+        npoints = len(power_data) // 2
+        if np is not None:
+            dbm = np.frombuffer(power_data, dtype=">i2", count=npoints) / POWER_SCALE + tap_gain
+            if frequency_data is not None:
+                frequency = start + np.frombuffer(frequency_data, dtype=">u2", count=npoints).astype(np.uint32)
+            else:
+                frequency = start + step * np.arange(npoints)
+        else:
+            dbm = [ x / POWER_SCALE + tap_gain for x in struct.unpack(">{}h".format(npoints), power_data) ]
+            if frequency_data is not None:
+                frequency = [ start + x for x in struct.unpack(">{}H".format(npoints), frequency_data) ]
+            else:
+                frequency = [ start + step * x for x in range(npoints) ]
+        return cls(frequency, dbm)
+
+
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
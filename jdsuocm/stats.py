@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import threading
+from jdsuocm.error import get_error_result
+
+# Histogram buckets are powers of 2 microseconds, the last bucket counts anything larger.
+HISTOGRAM_BUCKETS = 27                                      # 2^26us is ~67s
+
+
+class Histogram (object):
+    "A histogram of durations in power of 2 microsecond buckets"
+
+    def __init__ (self):
+        self.counts = [ 0 ] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add (self, seconds):
+        usecs = int(seconds * 1000000)
+        bucket = min(max(usecs, 0).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def get_mean (self):
+        return self.total / self.count if self.count else 0.0
+
+    def get_buckets (self):
+        "Return a list of (upper bound in microseconds or None for unbounded, count) for non-empty buckets"
+        buckets = []
+        for bucket, count in enumerate(self.counts):
+            if count:
+                bound = (1 << bucket) if bucket < HISTOGRAM_BUCKETS - 1 else None
+                buckets.append((bound, count))
+        return buckets
+
+    def as_dict (self):
+        return {
+            "count": self.count,
+            "min_usec": int(self.min * 1000000) if self.min is not None else 0,
+            "max_usec": int(self.max * 1000000) if self.max is not None else 0,
+            "mean_usec": int(self.get_mean() * 1000000),
+            "buckets": self.get_buckets(),
+        }
+
+
+class CommandStats (object):
+    """Statistics for a single command.
+
+    send is the time to write the command frame, first_byte the time from then
+    until the response starts (i.e., the device processing time) and transfer
+    the time to read the rest of the response.
+    """
+
+    def __init__ (self, cmdname):
+        self.cmdname = cmdname
+        self.count = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.errors = {}
+        self.send = Histogram()
+        self.first_byte = Histogram()
+        self.transfer = Histogram()
+
+    def as_dict (self):
+        return {
+            "count": self.count,
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+            "errors": dict([ (get_error_result(error), count) for error, count in self.errors.items() ]),
+            "send": self.send.as_dict(),
+            "first_byte": self.first_byte.as_dict(),
+            "transfer": self.transfer.as_dict(),
+        }
+
+
+class DeviceStats (object):
+    "Statistics for each command run on a device, by command name"
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.commands = {}
+
+    def record (self, cmdname, request_bytes, response_bytes, error, sent=None, first_byte=None, done=None):
+        """Record a command run, `sent`, `first_byte` and `done` are the durations from
+        the start of the send until it completed, the response started and ended, or
+        None if the command never got that far."""
+        with self.lock:
+            try:
+                stats = self.commands[cmdname]
+            except KeyError:
+                stats = self.commands[cmdname] = CommandStats(cmdname)
+            stats.count += 1
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+            if error:
+                stats.errors[error] = stats.errors.get(error, 0) + 1
+            if sent is None:
+                return
+            stats.send.add(sent)
+            if first_byte is not None:
+                stats.first_byte.add(first_byte - sent)
+                if done is not None:
+                    stats.transfer.add(done - first_byte)
+
+    def get (self, cmdname):
+        return self.commands.get(cmdname)
+
+    def clear (self):
+        with self.lock:
+            self.commands.clear()
+
+    def as_dict (self):
+        with self.lock:
+            return dict([ (cmdname, stats.as_dict()) for cmdname, stats in self.commands.items() ])
+
+
+__version__ = '1.0'
+__docformat__ = "restructuredtext en"
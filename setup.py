@@ -36,7 +36,9 @@ setup (name='jdsuocm',
        author_email='chopps@gmail.com',
        license='Apache License, Version 2.0',
        install_requires=required,
+       extras_require={ "numpy": [ "numpy" ], "parquet": [ "numpy", "pyarrow" ] },
        url='https://github.com/choppsv1/jdsu-ocm',
-       entry_points={ "console_scripts": [ "jdsu-scan = jdsuocm.scan:main",
+       entry_points={ "console_scripts": [ "jdsu-bench = jdsuocm.bench:main",
+                                           "jdsu-scan = jdsuocm.scan:main",
                                            "jdsu-server = jdsuocm.main:main" ]},
        packages=['jdsuocm'])
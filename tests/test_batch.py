@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import struct
+import time
+from jdsuocm import device
+from jdsuocm import error as jerror
+from jdsuocm.error import OCMError
+from jdsuocm.simulator import OCMSimulator, SimulatedOCM
+
+
+class DeadlineSimulator (OCMSimulator):
+    "A simulator with a transport deadline, recv_into raises ETIMEOUT once it passes"
+
+    deadline = None
+
+    def set_deadline (self, deadline):
+        self.deadline = deadline
+
+    def recv_into (self, view, nbytes=0):
+        with self.cond:
+            while not self._available(time.time()):
+                if self.deadline is not None and time.time() > self.deadline:
+                    raise OCMError(jerror.ETIMEOUT)
+                self.cond.wait(0.01)
+        return OCMSimulator.recv_into(self, view, nbytes)
+
+
+class DroppingSimulator (DeadlineSimulator):
+    "Silently drops frames sent while a response is pending"
+
+    def send (self, data):
+        with self.cond:
+            if self.responses:
+                return len(data)
+        return OCMSimulator.send(self, data)
+
+
+class RejectingSimulator (OCMSimulator):
+    "Answers frames sent while a response is pending with a checksum error"
+
+    def send (self, data):
+        with self.cond:
+            if self.responses:
+                msgid = struct.unpack_from(">H", data)[0]
+                self.responses.append([ time.time(), self._response(msgid, jerror.EFRAMECKSUM), 0 ])
+                self.cond.notify_all()
+                return len(data)
+        return OCMSimulator.send(self, data)
+
+
+class ReversingSimulator (OCMSimulator):
+    "Returns the pending responses newest first"
+
+    def recv_into (self, view, nbytes=0):
+        with self.cond:
+            if len(self.responses) > 1 and not self.responses[0][2]:
+                self.responses.rotate(1)
+        return OCMSimulator.recv_into(self, view, nbytes)
+
+
+#---------------------
+# run_cmd_batch_status
+#---------------------
+
+def profile_batch ():
+    return [ ("READ-PROFILE", b"", profile_id) for profile_id in range(1, 17) ]
+
+
+def lockstep_results ():
+    ocm = SimulatedOCM("cal04")
+    results = []
+    for cmd in profile_batch():
+        error, data = ocm.run_cmd_status(*cmd)
+        results.append((error, bytes(data)))
+    return results
+
+
+def test_batch_demux ():
+    ocm = device.OCM(ReversingSimulator("cal04"), pipeline_window=8)
+    results = ocm.run_cmd_batch_status(profile_batch() + [ ("NO-SUCH-COMMAND", b"", None) ])
+    assert results[:-1] == lockstep_results()
+    assert results[-1] == (jerror.EBADCMD, b"")
+    assert ocm.pipeline_window == 8
+
+
+def test_batch_lockstep ():
+    ocm = SimulatedOCM("cal04")
+    assert ocm.pipeline_window == 1
+    assert ocm.run_cmd_batch_status(profile_batch()) == lockstep_results()
+
+
+def test_batch_fallback_rejected ():
+    ocm = device.OCM(RejectingSimulator("cal04"), pipeline_window=8)
+    assert ocm.run_cmd_batch_status(profile_batch()) == lockstep_results()
+    assert ocm.pipeline_window == 1
+
+
+def test_batch_fallback_lost ():
+    sim = DroppingSimulator("cal04", latency=0.001)
+    ocm = device.OCM(sim, pipeline_window=8)
+    ocm.deadlines = dict([ (x, 0.1) for x in ocm.deadlines ])
+    assert ocm.run_cmd_batch_status(profile_batch()) == lockstep_results()
+    assert ocm.pipeline_window == 1
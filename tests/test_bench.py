@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+from jdsuocm import device
+from jdsuocm.bench import ReplayTransport, record_response
+from jdsuocm.simulator import SimulatedOCM
+
+
+def test_replay ():
+    ocm = SimulatedOCM("cal04")
+    response = record_response(ocm, "GET-MODULE-TEMP")
+    transport = ReplayTransport(response)
+    for unused in range(3):
+        msgid = device.send_cmd(transport, ocm.templates, "GET-MODULE-TEMP")
+        frame = transport.recv(len(response))
+        assert device.check_frame(frame, [ msgid ]) == len(frame)
+        assert frame[2:-2] == response[2:-2]
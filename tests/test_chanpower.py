@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import math
+from jdsuocm.chanpower import channel_powers, profile_channels
+from jdsuocm.spectrum import Spectrum
+
+FREQUENCY = [ 191000 + 12.5 * x for x in range(41) ]
+
+
+def close (value, expected):
+    return abs(value - expected) < 0.001
+
+
+def test_profile_channels ():
+    assert profile_channels([ (1913375, 1913625), (1914000, 1914500) ]) == [ (191350.0, 25.0), (191425.0, 50.0) ]
+
+
+def test_flat_spectrum ():
+    powers = channel_powers(Spectrum(FREQUENCY, [ -30.0 ] * len(FREQUENCY)), [ 191250.0 ], [ 50.0 ])
+    # 50GHz is four 12.5GHz slices
+    assert close(powers.power[0], -30 + 10 * math.log10(4))
+    assert close(powers.peak[0], -30.0)
+    assert math.isnan(powers.osnr[0])
+
+
+def test_channel ():
+    dbm = [ -20.0 if 191237.5 <= x <= 191262.5 else -60.0 for x in FREQUENCY ]
+    powers = channel_powers(Spectrum(FREQUENCY, dbm), [ 191250.0, 191400.0 ], [ 50.0, 50.0 ])
+    # The edge slices are half in the channel.
+    total_mw = 3 * 0.01 + 2 * 0.5 * 1e-6
+    assert close(powers.power[0], 10 * math.log10(total_mw))
+    assert (powers.peak[0], powers.peak_frequency[0]) == (-20.0, 191237.5)
+    assert close(powers.osnr[0], 10 * math.log10((total_mw - 4 * 1e-6) / 1e-6))
+    assert close(powers.power[1], -60 + 10 * math.log10(4))
+
+
+def test_channel_outside_scan ():
+    powers = channel_powers(Spectrum(FREQUENCY, [ -30.0 ] * len(FREQUENCY)), [ 196000.0 ], [ 50.0 ])
+    assert all([ math.isnan(x[0]) for x in powers ])
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+from opticalutil.power import Power
+from jdsuocm.detect import ChangeDetector
+from jdsuocm.spectrum import Spectrum
+
+FREQUENCY = [ 191000.0, 191006.25, 191012.5 ]
+
+
+def check (detector, dbm, port=0, frequency=FREQUENCY):
+    return detector.check("full-125", [ (port, Spectrum(frequency, dbm)) ])
+
+
+def test_baseline ():
+    detector = ChangeDetector(3.0)
+    assert check(detector, [ -60.0, -30.0, -60.0 ]) == []
+    assert check(detector, [ -60.0, -30.0, -60.0 ], port=1) == []
+    assert check(detector, [ -60.0, -30.0, -60.0 ]) == []
+
+
+def test_power_change ():
+    detector = ChangeDetector(3.0)
+    check(detector, [ -60.0, -30.0, -60.0 ])
+    assert check(detector, [ -60.0, -32.0, -59.0 ]) == []
+    changes = check(detector, [ -60.0, -40.0, -59.0 ])
+    assert [ (x.port, x.frequency, x.change, x.power, x.previous) for x in changes ] == [
+        (0, 191006.25, "power", -40.0, -30.0) ]
+    # Reported against the new power only.
+    assert check(detector, [ -60.0, -41.0, -59.0 ]) == []
+
+
+def test_power_drift ():
+    detector = ChangeDetector(3.0)
+    check(detector, [ -60.0, -30.0, -60.0 ])
+    assert check(detector, [ -60.0, -31.5, -60.0 ]) == []
+    changes = check(detector, [ -60.0, -33.0, -60.0 ])
+    assert [ (x.frequency, x.previous) for x in changes ] == [ (191006.25, -30.0) ]
+
+
+def test_frequency_change ():
+    detector = ChangeDetector(3.0)
+    check(detector, [ -60.0, -30.0, -60.0 ])
+    assert check(detector, [ -60.0, -60.0, -60.0 ], frequency=[ x + 1 for x in FREQUENCY ]) == []
+
+
+def test_itu_presence ():
+    detector = ChangeDetector(3.0)
+
+    def points (presence, dbm):
+        return [ (freq, present, Power(power)) for freq, present, power in zip(FREQUENCY, presence, dbm) ]
+
+    assert detector.check("itu", points([ 1, 0, 1 ], [ -10.0, -40.0, -10.0 ])) == []
+    changes = detector.check("itu", points([ 1, 1, 0 ], [ -11.0, -12.0, -40.0 ]))
+    assert sorted([ (x.port, x.frequency, x.change) for x in changes ]) == [
+        (None, 191006.25, "added"), (None, 191012.5, "dropped") ]
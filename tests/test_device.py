@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import struct
+import time
+from jdsuocm import device
+from jdsuocm.simulator import SimulatedOCM
+
+
+#---------
+# Decoders
+#---------
+
+def test_decode_module_info ():
+    words = [ ord(x) for x in "OCM-1\0\0\0" ]
+    assert device.decode_module_info(struct.pack(">8H", *words)) == "OCM-1"
+    assert device.decode_module_info(struct.pack(">2H", 1, 0xFFFF)) == "0001 ffff"
+
+
+#------
+# Scans
+#------
+
+def check_iter_scan (get_name, iter_name, asarray):
+    # Same seed so both simulators return the same scan.
+    whole = getattr(SimulatedOCM("cal04"), get_name)(0b1010, asarray)
+    ports = list(getattr(SimulatedOCM("cal04"), iter_name)(0b1010, asarray))
+    assert [ port for port, unused in ports ] == [ port for port, unused in whole ] == [ 1, 3 ]
+    for (unused, value), (unused, expected) in zip(ports, whole):
+        if asarray:
+            value, expected = value.tolists(), expected.tolists()
+        assert value == expected
+
+
+def test_iter_full_scan ():
+    check_iter_scan("get_full_scan", "iter_full_scan", False)
+    check_iter_scan("get_full_scan", "iter_full_scan", True)
+
+
+def test_iter_full_125_scan ():
+    check_iter_scan("get_full_125_scan", "iter_full_125_scan", False)
+    check_iter_scan("get_full_125_scan", "iter_full_125_scan", True)
+
+
+def test_iter_scan_abandoned ():
+    ocm = SimulatedOCM("cal04")
+    for unused in ocm.iter_full_scan():
+        break
+    assert [ port for port, unused in ocm.get_full_scan(0b0001) ] == [ 0 ]
+
+
+#------
+# Cache
+#------
+
+def test_cache_ttl ():
+    ocm = SimulatedOCM("cal04", cache_ttl=0.05)
+    ocm.get_app_version()
+    ocm.get_temp()
+    ocm.get_temp()
+    ocm.get_app_version()
+    assert ocm.stats.commands["GET-MODULE-TEMP"].count == 1
+    assert ocm.stats.commands["GET-APP-VERSION"].count == 1
+    assert ocm.cache_hits == 2
+
+    time.sleep(0.1)
+    ocm.get_temp()
+    ocm.get_app_version()
+    assert ocm.stats.commands["GET-MODULE-TEMP"].count == 2
+    assert ocm.stats.commands["GET-APP-VERSION"].count == 1
+
+    ocm.reset()
+    ocm.get_app_version()
+    assert ocm.stats.commands["GET-APP-VERSION"].count == 2
+
+
+def test_cache_off ():
+    ocm = SimulatedOCM("cal04", cache_ttl=0)
+    ocm.get_temp()
+    ocm.get_temp()
+    assert ocm.stats.commands["GET-MODULE-TEMP"].count == 2
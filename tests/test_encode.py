@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import struct
+from jdsuocm import device
+from jdsuocm.simulator import OCMSimulator
+
+
+def test_encode_no_data ():
+    template = device.CommandTemplate("GET-MODULE-TEMP", device.commands_common["GET-MODULE-TEMP"])
+    cmd, obj, inst, param = device.commands_common["GET-MODULE-TEMP"][:4]
+    words = (1, 5, cmd, obj, inst, param, (1 + 5 + cmd + obj + inst + param) & 0xFFFF)
+    assert template.encode(1) == struct.pack(">7H", *words)
+
+
+def test_encode_data ():
+    cmdinfo = device.commands_1port["FULL-ITU-SCAN"]
+    template = device.CommandTemplate("FULL-ITU-SCAN", cmdinfo)
+    cmd, obj, inst, param = cmdinfo[:4]
+    words = (0xFFFF, 6, cmd, obj, inst, param, 1, (0xFFFF + 6 + cmd + obj + inst + param + 1) & 0xFFFF)
+    assert template.encode(0xFFFF, struct.pack(">H", 1)) == struct.pack(">8H", *words)
+
+
+def test_encode_inst_map ():
+    cmdinfo = device.commands_4port["FULL-SPECTRUM-SCAN"]
+    template = device.CommandTemplate("FULL-SPECTRUM-SCAN", cmdinfo)
+    cmd, obj, unused, param = cmdinfo[:4]
+    inst = device.instance_map_4port[0b0101]
+    words = (2, 5, cmd, obj, inst, param, (2 + 5 + cmd + obj + inst + param) & 0xFFFF)
+    assert template.encode(2, instance=0b0101) == struct.pack(">7H", *words)
+
+
+def test_encode_tagged_instance ():
+    cmdinfo = device.commands_4port["READ-PROFILE"]
+    template = device.CommandTemplate("READ-PROFILE", cmdinfo)
+    cmd, obj, unused, param = cmdinfo[:4]
+    words = (3, 5, cmd, obj, 12, param, (3 + 5 + cmd + obj + 12 + param) & 0xFFFF)
+    assert template.encode(3, instance=12) == struct.pack(">7H", *words)
+
+
+def test_encode_matches_simulator ():
+    # Every template encodes a frame the simulator decodes and checksums as the same command.
+    sim = OCMSimulator("cal04")
+    for cmdname, template in device.compile_commands(sim.commands).items():
+        if template.has_data:
+            continue
+        instance = None if template.inst_tag is None else 0b1111 if template.inst_tag == device.INST_MAP_TAG else 1
+        name, response = sim._handle_frame(template.encode(9, instance=instance))
+        assert name == cmdname
+        assert device.check_frame(response, [ 9 ]) == len(response)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import struct
+from jdsuocm import device
+from jdsuocm import error as jerror
+from jdsuocm.error import OCMError
+from jdsuocm.simulator import OCMSimulator
+
+
+def make_frame (msgid, result=0, data=b""):
+    return OCMSimulator._response(msgid, result, data)
+
+
+class BytesTransport (object):
+    "A transport that returns fixed bytes, raising ETIMEOUT when they run out"
+
+    def __init__ (self, data):
+        self.data = bytearray(data)
+
+    def recv_into (self, view, nbytes=0):
+        if not self.data:
+            raise OCMError(jerror.ETIMEOUT)
+        count = min(nbytes or len(view), len(self.data))
+        view[:count] = self.data[:count]
+        del self.data[:count]
+        return count
+
+
+#------------
+# check_frame
+#------------
+
+def test_check_frame ():
+    frame = make_frame(7, 0, struct.pack(">HH", 1, 2))
+    assert device.check_frame(frame) == len(frame)
+    assert device.check_frame(frame, [ 7 ]) == len(frame)
+    assert device.check_frame(frame, [ 8 ]) == -1
+    assert device.check_frame(frame[:-1]) == 0
+    assert device.check_frame(frame[:4]) == 0
+    assert device.check_frame(b"xx" + frame, offset=2) == len(frame)
+
+
+def test_check_frame_bad_cksum ():
+    frame = bytearray(make_frame(7, 0, struct.pack(">HH", 1, 2)))
+    frame[-1] ^= 1
+    assert device.check_frame(frame) == -1
+
+
+#---------------
+# ResponseReader
+#---------------
+
+def test_reader_read ():
+    first = make_frame(1, 0, struct.pack(">H", 10))
+    second = make_frame(2, jerror.EVALRANGE)
+    reader = device.ResponseReader(BytesTransport(first + second))
+    msgid, result, data = reader.read()
+    assert (msgid, result, data.tobytes()) == (1, 0, struct.pack(">H", 10))
+    msgid, result, data = reader.read()
+    assert (msgid, result, data.tobytes()) == (2, jerror.EVALRANGE, b"")
+    assert reader.resyncs == 0
+
+
+def test_reader_dropped_byte ():
+    first = make_frame(1, 0, struct.pack(">HHH", 10, 11, 12))
+    second = make_frame(2, 0, struct.pack(">H", 20))
+    reader = device.ResponseReader(BytesTransport(first[:8] + first[9:] + second))
+    msgid, result, data = reader.read([ 1, 2 ])
+    assert (msgid, result, data.tobytes()) == (2, 0, struct.pack(">H", 20))
+    assert reader.resyncs == 1
+    assert reader.skipped_bytes == len(first) - 1
+
+
+def test_reader_bad_cksum ():
+    first = bytearray(make_frame(1, 0, struct.pack(">H", 10)))
+    first[-1] ^= 1
+    second = make_frame(2)
+    reader = device.ResponseReader(BytesTransport(bytes(first) + second))
+    msgid, unused, unused = reader.read([ 1, 2 ])
+    assert msgid == 2
+    assert reader.resyncs == 1
+
+
+def test_reader_resync_garbage ():
+    # A bogus header claiming a long frame is followed by garbage before the frame.
+    garbage = struct.pack(">HH", 1, 20000) + b"\xff" * 40000
+    frame = make_frame(1, 0, struct.pack(">H", 10))
+    reader = device.ResponseReader(BytesTransport(garbage + frame + make_frame(2)))
+    msgid, unused, data = reader.read([ 1 ])
+    assert (msgid, data.tobytes()) == (1, struct.pack(">H", 10))
+    assert reader.skipped_bytes == len(garbage)
+    assert reader.read([ 2 ])[0] == 2
+
+
+def test_reader_stale_msgid ():
+    stale = make_frame(5, 0, struct.pack(">H", 50))
+    frame = make_frame(6, 0, struct.pack(">H", 60))
+    reader = device.ResponseReader(BytesTransport(stale + frame))
+    msgid, unused, data = reader.read([ 6 ])
+    assert (msgid, data.tobytes()) == (6, struct.pack(">H", 60))
+    assert reader.resyncs == 0
+
+
+def test_reader_no_frame ():
+    reader = device.ResponseReader(BytesTransport(b"\xff" * 64))
+    try:
+        reader.read([ 1 ])
+    except OCMError as ex:
+        assert ex.error == jerror.ETIMEOUT
+    else:
+        assert False, "read of garbage returned a frame"
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import os
+import shutil
+import tempfile
+import numpy as np
+from jdsuocm.history import PortHistory, ScanHistory
+from jdsuocm.spectrum import Spectrum, TAP_GAIN
+
+FREQUENCY = [ 191000.0, 191050.0, 191100.0 ]
+
+
+def make_spectrum (dbm):
+    return Spectrum(np.array(FREQUENCY), np.array([ dbm ] * len(FREQUENCY)))
+
+
+def test_window ():
+    history = PortHistory.create(FREQUENCY, TAP_GAIN, 4)
+    for idx in range(6):
+        history.append(100.0 + idx, [ TAP_GAIN - idx ] * 3)
+    # Only the newest 4 are kept.
+    timestamps, power = history.get_window()
+    assert timestamps.tolist() == [ 102.0, 103.0, 104.0, 105.0 ]
+    assert power[:, 0].tolist() == [ -200, -300, -400, -500 ]
+
+    timestamps, power = history.get_window(103, 104)
+    assert timestamps.tolist() == [ 103.0, 104.0 ]
+    timestamps, power = history.get_window(200)
+    assert not len(timestamps)
+
+
+def test_window_clock_step_back ():
+    history = PortHistory.create(FREQUENCY, 0, 8)
+    for timestamp in (100.0, 101.0, 102.0, 50.0, 51.0):
+        history.append(timestamp, [ timestamp ] * 3)
+    timestamps, unused = history.get_window(51, 101)
+    assert timestamps.tolist() == [ 51.0, 100.0, 101.0 ]
+
+
+def test_aggregate ():
+    history = PortHistory.create(FREQUENCY, 0, 8)
+    for timestamp, dbm in ((100.0, -10), (104.0, -20), (110.0, -30), (125.0, -40)):
+        history.append(timestamp, [ dbm ] * 3)
+    times, counts, minimums, means, maximums = history.aggregate(10)
+    assert times.tolist() == [ 100.0, 110.0, 120.0 ]
+    assert counts.tolist() == [ 2, 1, 1 ]
+    assert minimums[:, 0].tolist() == [ -2000, -3000, -4000 ]
+    assert means[:, 0].tolist() == [ -1500, -3000, -4000 ]
+    assert maximums[:, 0].tolist() == [ -1000, -3000, -4000 ]
+
+
+def test_persist ():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        history = ScanHistory(1, ("full",), 1, tmpdir, flush_interval=0)
+        history.record("full", 100.0, [ (0, make_spectrum(-10)) ])
+        history.record("full", 101.0, [ (0, make_spectrum(-11)) ])
+        assert os.listdir(tmpdir) == [ "default-full-0.hist" ]
+
+        reopened = ScanHistory(1, ("full",), 1, tmpdir)
+        frequency, tap_gain, timestamps, power = reopened.get_window("full", 0)
+        assert frequency.tolist() == FREQUENCY
+        assert tap_gain == TAP_GAIN
+        assert timestamps.tolist() == [ 100.0, 101.0 ]
+        assert power[:, 0].tolist() == [ -3000, -3100 ]
+        assert reopened.get_window("full", 1) is None
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import io
+from lxml import etree
+from netconf import NSMAP
+from jdsuocm.scan import decode_packed_port
+from jdsuocm.server import write_port_packed
+from jdsuocm.spectrum import Spectrum
+
+
+def packed_port (port, spectrum):
+    output = io.StringIO()
+    write_port_packed(output, port, spectrum)
+    return etree.fromstring('<data xmlns:j="{}">{}</data>'.format(NSMAP["j"], output.getvalue()))[0]
+
+
+def check_round_trip (spectrum):
+    port, decoded = decode_packed_port(packed_port(3, spectrum))
+    assert port == 3
+    frequency, dbm = spectrum.tolists()
+    decoded_frequency, decoded_dbm = decoded.tolists()
+    assert decoded_frequency == frequency
+    assert all([ abs(x - y) < 0.0051 for x, y in zip(decoded_dbm, dbm) ])
+
+
+def test_round_trip_step ():
+    check_round_trip(Spectrum([ 191000 + 6.25 * x for x in range(8) ], [ -60.0, -45.123, -30.5, -12.004, 0.0,
+                                                                         3.2, -1.99, -80.0 ]))
+
+
+def test_round_trip_uneven ():
+    spectrum = Spectrum([ 1913500, 1914000, 1915500 ], [ -30.0, -31.0, -32.0 ])
+    assert packed_port(0, spectrum).find("j:frequency-step", namespaces=NSMAP) is None
+    check_round_trip(spectrum)
+
+
+def test_pack_power ():
+    spectrum = Spectrum([ 1, 2 ], [ -10.0, 20.5 ])
+    assert spectrum.pack_power() == b"\xf4\x48\x00\x32"                 # -30.00 and 0.50 dBm at the tap
+    assert Spectrum.from_packed(1, 1, spectrum.pack_power()).tolists() == ([ 1, 2 ], [ -10.0, 20.5 ])
+
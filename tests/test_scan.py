@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import argparse
+from lxml import etree
+from jdsuocm.scan import get_scan_rpc
+
+
+def scan_args (**kwargs):
+    args = dict(device=None, scan_port=None, packed=False, full_itu=False, full_125=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_scan_rpc_ports ():
+    rpc = etree.fromstring(get_scan_rpc(scan_args(scan_port=[ 1, 3 ])))
+    assert rpc.tag == "full-scan"
+    assert [ x.text for x in rpc.iter("port-index") ] == [ "1", "3" ]
+
+    rpc = etree.fromstring(get_scan_rpc(scan_args(scan_port=[ 0 ], packed=True, full_125=True, device="a")))
+    assert (rpc.tag, rpc.findtext("scan-type"), rpc.findtext("device")) == ("packed-scan", "full-125", "a")
+    assert [ x.text for x in rpc.iter("port-index") ] == [ "0" ]
+
+
+def test_scan_rpc_all_ports ():
+    rpc = etree.fromstring(get_scan_rpc(scan_args(full_125=True)))
+    assert rpc.tag == "full-125-scan"
+    assert rpc.find("port-index") is None
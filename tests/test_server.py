@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import netconf.error as ncerror
+from lxml import etree
+from netconf import NSMAP, qmap
+from paramiko import RSAKey
+from jdsuocm.scan import decode_packed_port
+from jdsuocm.server import DeviceWorker, NetconfServer, write_port_spectrum
+from jdsuocm.simulator import SimulatedOCM
+from jdsuocm.spectrum import Spectrum
+
+tmpdir = None
+
+
+def setup_module ():
+    global tmpdir                                       # pylint: disable=W0603
+    tmpdir = tempfile.mkdtemp()
+    RSAKey.generate(1024).write_private_key_file(os.path.join(tmpdir, "host_key"))
+
+
+def teardown_module ():
+    shutil.rmtree(tmpdir)
+
+
+def make_server (device, **kwargs):
+    return NetconfServer(device, os.path.join(tmpdir, "host_key"), ssh_port=0, username="admin", password="admin",
+                         **kwargs)
+
+
+def param (tag, text):
+    elm = etree.Element(tag)
+    elm.text = text
+    return elm
+
+
+def get_points (reply):
+    data = etree.fromstring(reply.text)
+    return [ [ x.text for x in point ] for point in data.iter("{*}point") ]
+
+
+def get_port_points (reply):
+    "Return a dictionary of the point text lists of each port in a scan reply"
+    data = etree.fromstring(reply.text)
+    ports = {}
+    for port in data.iter("{*}port"):
+        ports[int(port.findtext("{*}port-index"))] = [ [ x.text for x in point ] for point in port.iter("{*}point") ]
+    return ports
+
+
+#-------------------
+# Coalesced scanning
+#-------------------
+
+def stream_scan (worker, on_port):
+    device = worker.device
+    return worker.run_scan_method(None, device.get_full_scan, 0b1111, True, stream=(device.iter_full_scan, on_port))
+
+
+def test_stream_outside_device_lock ():
+    worker = DeviceWorker("test", SimulatedOCM("cal04"))
+    temps = []
+
+    def on_port (unused_scan, unused_port, unused_value):
+        # Would deadlock if on_port were called holding the device lock.
+        temps.append(worker.run_method(worker.device.get_temp))
+
+    scan = stream_scan(worker, on_port)
+    assert [ port for port, unused in scan.result ] == [ 0, 1, 2, 3 ]
+    assert len(temps) == 4
+
+
+def test_stream_caller_error ():
+    worker = DeviceWorker("test", SimulatedOCM("cal04", latency=0.05))
+    errors = []
+
+    def fail (unused_scan, unused_port, unused_value):
+        raise ValueError("caller error")
+
+    def run_failing ():
+        try:
+            stream_scan(worker, fail)
+        except ValueError as ex:
+            errors.append(ex)
+
+    thread = threading.Thread(target=run_failing)
+    thread.start()
+    time.sleep(0.01)
+    ports = []
+    scan = stream_scan(worker, lambda scan, port, value: ports.append(port))
+    thread.join()
+    assert len(errors) == 1
+    assert ports == [ 0, 1, 2, 3 ]
+    assert len(scan.result) == 4
+
+
+def test_sequential_scans_read_device ():
+    worker = DeviceWorker("test", SimulatedOCM("cal04"))
+    for unused in range(50):
+        stream_scan(worker, lambda scan, port, value: None)
+        worker.run_coalesced_method(worker.device.get_full_125_scan, 0b0001)
+    assert worker.device.stats.commands["FULL-SPECTRUM-SCAN"].count == 50
+    assert worker.device.stats.commands["FULL-12-SCAN"].count == 50
+
+
+#-----------------
+# Background scans
+#-----------------
+
+def wait_latest (scheduler, key):
+    "Return the first background scan of key"
+    end = time.time() + 5
+    while scheduler.get_latest(key, 10000) is None and time.time() < end:
+        time.sleep(0.01)
+    scan = scheduler.get_latest(key, 10000)
+    assert scan is not None
+    return scan
+
+
+def test_itu_power_scan_from_background ():
+    ocm = SimulatedOCM("cal02")
+    server = make_server(ocm, scan_interval=0.05)
+    try:
+        scan = wait_latest(server.workers["default"].scheduler, ("get_itu_scan", False))
+
+        reply = server.rpc_full_itu_scan(None, None, param("max-age", "10000"))
+        points = get_points(reply)
+        assert "FULL-ITU-POWER-SCAN" not in ocm.stats.commands
+        assert len(points) == len(scan.result)
+        assert all([ len(x) == 2 for x in points ])
+    finally:
+        server.close()
+
+
+#--------------
+# Multi devices
+#--------------
+
+def test_device_routing ():
+    devices = { "a": SimulatedOCM("cal04"), "b": SimulatedOCM("cal02") }
+    server = make_server(devices)
+    try:
+        assert sorted(get_port_points(server.rpc_full_scan(None, None, param("device", "a")))) == [ 0, 1, 2, 3 ]
+        assert "FULL-SPECTRUM-SCAN" not in devices["b"].stats.commands
+
+        points = get_points(server.rpc_full_itu_scan(None, None, param("device", "b")))
+        assert len(points) == 128
+        assert "FULL-ITU-POWER-SCAN" not in devices["a"].stats.commands
+    finally:
+        server.close()
+
+
+def test_device_param_errors ():
+    server = make_server({ "a": SimulatedOCM("cal04"), "b": SimulatedOCM("cal04") })
+    rpc = etree.Element(qmap("nc") + "rpc")
+    try:
+        for params, tag in [ ((), "missing-element"), ((param("device", "c"),), "bad-element") ]:
+            try:
+                server.rpc_full_scan(None, rpc, *params)
+            except ncerror.RPCServerError as ex:
+                reply = ex.get_reply_msg()
+                assert "<nc:error-tag>{}</nc:error-tag>".format(tag) in reply
+                assert "device" in reply
+            else:
+                assert False, "scan without a known device did not fail"
+    finally:
+        server.close()
+
+
+def test_single_device_param ():
+    server = make_server(SimulatedOCM("cal04"))
+    try:
+        assert len(get_port_points(server.rpc_full_scan(None, None))) == 4
+        assert len(get_port_points(server.rpc_full_scan(None, None, param("device", "default")))) == 4
+    finally:
+        server.close()
+
+
+#---------------
+# Port selection
+#---------------
+
+def test_scan_ports ():
+    ocm = SimulatedOCM("cal04")
+    server = make_server(ocm)
+    try:
+        reply = server.rpc_full_scan(None, None, param("port-index", "1"), param("port-index", "3"))
+        assert sorted(get_port_points(reply)) == [ 1, 3 ]
+        # Only the selected ports are read from the device.
+        stats = ocm.stats.commands["FULL-SPECTRUM-SCAN"]
+        selected = stats.response_bytes
+        server.rpc_full_scan(None, None)
+        assert stats.response_bytes - selected > selected
+
+        reply = server.rpc_full_125_scan(None, None, param("port-index", "0"))
+        assert sorted(get_port_points(reply)) == [ 0 ]
+    finally:
+        server.close()
+
+
+def test_scan_ports_invalid ():
+    server = make_server(SimulatedOCM("cal04"))
+    rpc = etree.Element(qmap("nc") + "rpc")
+    try:
+        for value in [ "4", "-1", "one" ]:
+            try:
+                server.rpc_full_scan(None, rpc, param("port-index", value))
+            except ncerror.RPCServerError as ex:
+                assert "invalid port-index" in ex.get_reply_msg()
+            else:
+                assert False, "scan of port-index {} did not fail".format(value)
+    finally:
+        server.close()
+
+
+def test_scan_ports_from_background ():
+    ocm = SimulatedOCM("cal04")
+    server = make_server(ocm, scan_interval=3600)
+    try:
+        scan = wait_latest(server.workers["default"].scheduler, ("get_full_scan", 0b1111, True))
+        count = ocm.stats.commands["FULL-SPECTRUM-SCAN"].count
+        reply = server.rpc_full_scan(None, None, param("port-index", "2"), param("max-age", "10000"))
+        ports = get_port_points(reply)
+        assert sorted(ports) == [ 2 ]
+        assert ocm.stats.commands["FULL-SPECTRUM-SCAN"].count == count
+        assert len(ports[2]) == len(dict(scan.result)[2])
+    finally:
+        server.close()
+
+
+#---------------------
+# Change notifications
+#---------------------
+
+def test_change_notification ():
+    ocm = SimulatedOCM("cal04")
+    server = make_server(ocm, change_threshold=3)
+    sent = []
+    server.notifications.send = lambda timestamp, body: sent.append(body)
+    try:
+        server.rpc_full_scan(None, None, param("port-index", "1"))
+        assert sent == []
+        ocm.simulator.channel_power[1] = [ -20.0 ] * len(ocm.simulator.channel_power[1])
+        server.rpc_full_scan(None, None, param("port-index", "1"))
+        assert len(sent) == 1
+        body = etree.fromstring(sent[0])
+        assert body.findtext("{*}device") == "default"
+        assert body.findtext("{*}scan-type") == "full"
+        changes = body.findall("{*}change")
+        assert changes
+        assert all([ x.findtext("{*}port-index") == "1" for x in changes ])
+        assert all([ x.findtext("{*}change-type") == "power" for x in changes ])
+    finally:
+        server.close()
+
+
+#--------------
+# Channel power
+#--------------
+
+def channel_param (centre, width):
+    elm = etree.Element("channel")
+    elm.append(param("centre-frequency", centre))
+    elm.append(param("width", width))
+    return elm
+
+
+def get_channels (reply):
+    "Return a dictionary of the centre frequency and power text of the channels of each port"
+    data = etree.fromstring(reply.text)
+    ports = {}
+    for port in data.iter("{*}port"):
+        ports[int(port.findtext("{*}port-index"))] = [ (x.findtext("{*}centre-frequency"), x.findtext("{*}power"))
+                                                       for x in port.iter("{*}channel") ]
+    return ports
+
+
+def test_channel_power ():
+    ocm = SimulatedOCM("cal04")
+    server = make_server(ocm)
+    try:
+        reply = server.rpc_channel_power(None, None, param("port-index", "2"), channel_param("191350", "50"),
+                                         channel_param("191400", "50"))
+        channels = get_channels(reply)
+        assert sorted(channels) == [ 2 ]
+        assert [ x[0] for x in channels[2] ] == [ "191350.000", "191400.000" ]
+        assert all([ x[1] is not None for x in channels[2] ])
+
+        reply = server.rpc_channel_power(None, None, param("profile-index", "1"))
+        profile = ocm.get_channel_profile(1)
+        channels = get_channels(reply)
+        assert sorted(channels) == [ 0, 1, 2, 3 ]
+        assert [ float(x[0]) for x in channels[0] ] == [ (start + end) / 20 for start, end in profile ]
+    finally:
+        server.close()
+
+
+def test_channel_power_errors ():
+    rpc = etree.Element(qmap("nc") + "rpc")
+    server = make_server({ "a": SimulatedOCM("cal04"), "b": SimulatedOCM("cal02") })
+    try:
+        for params, tag in [ ((param("device", "a"),), "missing-element"),
+                             ((param("device", "a"), param("profile-index", "17")), "invalid-value"),
+                             ((param("device", "a"), channel_param("191350", "0")), "bad-element"),
+                             ((param("device", "b"), channel_param("191350", "50")), "operation-not-supported") ]:
+            try:
+                server.rpc_channel_power(None, rpc, *params)
+            except ncerror.RPCServerError as ex:
+                assert "<nc:error-tag>{}</nc:error-tag>".format(tag) in ex.get_reply_msg()
+            else:
+                assert False, "channel-power did not fail with {}".format(tag)
+    finally:
+        server.close()
+
+
+#-------------
+# Scan replies
+#-------------
+
+def test_write_port_spectrum ():
+    output = io.StringIO()
+    write_port_spectrum(output, 2, Spectrum([ 191000.0, 191006.25 ], [ -30.004, -12.5 ]))
+    port = etree.fromstring('<data xmlns:j="{}">{}</data>'.format(NSMAP["j"], output.getvalue()))[0]
+    assert port.findtext("j:port-index", namespaces=NSMAP) == "2"
+    points = [ [ x.text for x in point ] for point in port.iter("{*}point") ]
+    assert points == [ [ "191000.0", "-30.00" ], [ "191006.25", "-12.50" ] ]
+
+
+def test_full_scan_reply ():
+    ocm = SimulatedOCM("cal04")
+    server = make_server(ocm)
+    try:
+        reply = server.rpc_full_scan(None, None)
+        data = etree.fromstring(reply.text)
+        assert data.findtext("j:timestamp", namespaces=NSMAP)
+        ports = get_port_points(reply)
+        expected = ocm.get_full_scan()
+        assert sorted(ports) == [ port for port, unused in expected ]
+        for port, points in expected:
+            assert [ int(x[0]) for x in ports[port] ] == [ freq for freq, unused in points ]
+            assert all([ abs(float(x[1]) - float(y.dBm)) < 0.2 for x, (unused, y) in zip(ports[port], points) ])
+    finally:
+        server.close()
+
+
+def test_packed_scan_reply ():
+    ocm = SimulatedOCM("cal04")
+    server = make_server(ocm)
+    try:
+        data = etree.fromstring(server.rpc_packed_scan(None, None).text)
+        ports = dict([ decode_packed_port(x) for x in data.iter("{*}port") ])
+        expected = ocm.get_full_scan(asarray=True)
+        assert sorted(ports) == [ port for port, unused in expected ]
+        for port, spectrum in expected:
+            assert ports[port].tolists()[0] == spectrum.tolists()[0]
+            assert all([ abs(x - y) < 0.2 for x, y in zip(ports[port].tolists()[1], spectrum.tolists()[1]) ])
+    finally:
+        server.close()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import struct
+from jdsuocm import device
+from jdsuocm import error as jerror
+from jdsuocm.simulator import OCMSimulator, SimulatedOCM
+
+# Data for the commands that take it, the rest send four words.
+COMMAND_DATA = {
+    "GET-SINGLE-POWER": struct.pack(">HHHH", 2, 1550120 >> 16, 1550120 & 0xFFFF, 2),
+    "SET-PROFILE": struct.pack(">HHH", 1, 13375, 13625),
+}
+
+TAG_INSTANCES = {
+    device.INST_MAP_TAG: 0b1111,
+    device.PROFILE_ID_TAG: 1,
+    device.PORT_NUM_TAG: 1,
+}
+
+
+def check_commands (caltype, commands):
+    ocm = SimulatedOCM(caltype)
+    for cmdname, cmdinfo in sorted(commands.items()):
+        data = COMMAND_DATA.get(cmdname, struct.pack(">HHHH", 2, 2, 2, 2)) if cmdinfo[4] else b""
+        error, rdata = ocm.run_cmd_status(cmdname, data, TAG_INSTANCES.get(cmdinfo[2]))
+        assert error == jerror.ENOERR, "{}: {}".format(cmdname, jerror.get_error_result(error))
+        rlen = ocm.templates[cmdname].resp_data_len
+        assert rlen is None or len(rdata) == rlen, "{}: {} bytes".format(cmdname, len(rdata))
+
+
+def test_commands_common_4port ():
+    check_commands("cal04", device.commands_common)
+
+
+def test_commands_4port ():
+    check_commands("cal04", device.commands_4port)
+
+
+def test_commands_common_1port ():
+    check_commands("cal02", device.commands_common)
+
+
+def test_commands_1port ():
+    check_commands("cal02", device.commands_1port)
+
+
+def test_bad_cksum ():
+    ocm = SimulatedOCM("cal04")
+    frame = bytearray(device.encode_cmd(ocm.templates, "GET-MODULE-TEMP")[1])
+    frame[-1] ^= 1
+    unused, response = ocm.simulator._handle_frame(bytes(frame))
+    assert struct.unpack_from(">HHH", response)[2] == jerror.EFRAMECKSUM
+
+
+def test_short_frame ():
+    sim = OCMSimulator("cal04")
+    sim.send(struct.pack(">HHH", 9, 1, 10))                  # clen 1, shorter than any command
+    response = sim.recv(4096)
+    assert struct.unpack(">HHHH", response) == (9, 2, jerror.EFRAMECKSUM, (9 + 2 + jerror.EFRAMECKSUM) & 0xFFFF)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+from jdsuocm import device
+from jdsuocm.simulator import SimulatedOCM
+from jdsuocm.spectrum import Spectrum
+
+
+def as_dbm (points):
+    return [ (freq, power.dBm) for freq, power in points ]
+
+
+def check_decode (cmdname, decode):
+    instance = 0b0110
+    data = bytes(SimulatedOCM("cal04").run_cmd(cmdname, instance=instance))
+    points = decode(data, instance, False)
+    spectra = decode(data, instance, True)
+    assert [ port for port, unused in spectra ] == [ port for port, unused in points ] == [ 1, 2 ]
+    for (unused, spectrum), (unused, port_points) in zip(spectra, points):
+        assert isinstance(spectrum, Spectrum)
+        assert len(spectrum) == len(port_points)
+        assert as_dbm(spectrum) == as_dbm(port_points)
+        assert as_dbm([ spectrum[0] ]) == as_dbm(port_points[:1])
+
+
+def test_decode_full_scan ():
+    check_decode("FULL-SPECTRUM-SCAN", device.decode_full_scan)
+
+
+def test_decode_full_125_scan ():
+    check_decode("FULL-12-SCAN", device.decode_full_125_scan)
+
+
+def test_get_full_scan_asarray ():
+    ocm = SimulatedOCM("cal04")
+    points = ocm.get_full_scan(0b0001)
+    spectra = ocm.get_full_scan(0b0001, asarray=True)
+    assert len(points) == len(spectra) == 1
+    frequency, dbm = spectra[0][1].tolists()
+    assert frequency == [ freq for freq, unused in points[0][1] ]
+    assert len(dbm) == len(frequency)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-#
+#
+# Copyright (c) 2015-2016, Deutsche Telekom AG.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from __future__ import absolute_import, division, unicode_literals, print_function, nested_scopes
+import socket
+import time
+from jdsuocm import device
+from jdsuocm import error as jerror
+from jdsuocm.simulator import OCMSimulator
+
+
+class SimulatorChannel (object):
+    def __init__ (self):
+        self.timeout = None
+
+    def settimeout (self, timeout):
+        self.timeout = timeout
+
+
+class SimulatorSession (object):
+    "The parts of an SSH session to sercat used by SSHTransport, in front of an OCMSimulator"
+
+    def __init__ (self, simulator):
+        self.simulator = simulator
+        self.chan = SimulatorChannel()
+
+    def send (self, data):
+        return self.simulator.send(data)
+
+    def recv_ready (self):
+        return self.simulator.recv_ready()
+
+    def recv (self, nbytes):
+        sim = self.simulator
+        with sim.cond:
+            end = None if self.chan.timeout is None else time.time() + self.chan.timeout
+            while not sim._available(time.time()):
+                if end is not None and time.time() >= end:
+                    raise socket.timeout()
+                sim.cond.wait(0.001)
+        return sim.recv(nbytes)
+
+
+def test_ssh_late_reply ():
+    sim = OCMSimulator("cal04", latency={ "GET-MODULE-TEMP": 0.3, "default": 0 })
+    ocm = device.OCM(device.SSHTransport(SimulatorSession(sim)), read_retries=0)
+    ocm.deadlines["GET-MODULE-TEMP"] = 0.1
+    error, unused = ocm.run_cmd_status("GET-MODULE-TEMP")
+    assert error == jerror.ETIMEOUT
+
+    # The late response is drained and discarded rather than failing the next command.
+    time.sleep(0.3)
+    assert sim.recv_ready()
+    error, data = ocm.run_cmd_status("GET-APP-VERSION")
+    assert error == jerror.ENOERR
+    assert len(data) == ocm.templates["GET-APP-VERSION"].resp_data_len
+    assert not sim.recv_ready()
+
+
+def test_ssh_timeout ():
+    sim = OCMSimulator("cal04", latency={ "GET-MODULE-TEMP": 10, "default": 0 })
+    ocm = device.OCM(device.SSHTransport(SimulatorSession(sim)), read_retries=0)
+    ocm.deadlines["GET-MODULE-TEMP"] = 0.05
+    start = time.time()
+    error, unused = ocm.run_cmd_status("GET-MODULE-TEMP")
+    assert error == jerror.ETIMEOUT
+    assert time.time() - start < 1
+